@@ -0,0 +1,323 @@
+"""
+End-to-end benchmark of the API, on the in-memory data backend.
+
+Runs study scenarios concurrently against the app, through Quart's test client. Each scenario drives
+the routes of every blueprint: the owner creates a study and edits it (study), participants join it
+by request or invitation (participants), browse studies, profiles and messages (web), every party
+downloads its auth key and sends CLI updates (cli), and all of them connect to the signaling
+websocket and exchange a message with each other (signaling), before the study is restarted
+and deleted. It reports latency percentiles per route, and the Firestore operations of each route.
+
+Users are authenticated with JWTs signed by a key generated for the run, and the GCP and email
+calls are replaced by no-op stand-ins. Routes that only proxy to GCP (e.g. results files,
+start_protocol, create_cp0) are not benchmarked.
+
+Usage:
+    python -m benchmarks.api_bench --studies 50 --participants 2 --concurrency 10 --updates 20
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from quart.typing import TestClientProtocol
+
+from src import auth, create_app, signaling
+from src.api_utils import get_allowed_origins
+from src.utils import constants
+from src.utils.memory_firestore import MemoryClient, operation_label
+from src.web import participants, study
+
+KID = "api-bench"
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class NoopCompute:
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    def __getattr__(self, name: str):
+        return lambda *args, **kwargs: []
+
+
+async def noop_email(*args, **kwargs) -> int:
+    return 202
+
+
+class Benchmark:
+    def __init__(
+        self, num_studies: int, num_participants: int, concurrency: int, num_updates: int, firestore_latency: float
+    ) -> None:
+        self.num_studies = num_studies
+        self.num_participants = num_participants
+        self.concurrency = concurrency
+        self.num_updates = num_updates
+        self.firestore_latency = firestore_latency
+
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.tokens: Dict[str, str] = {}
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        # websockets are subject to CORS
+        self.origin = get_allowed_origins()[-1]
+
+    def install_stand_ins(self) -> None:
+        constants.DATA_BACKEND = "memory"
+        constants.TERRA = ""
+        auth.PUBLIC_KEYS[KID] = self.private_key.public_key()
+        study.GoogleCloudCompute = NoopCompute
+        participants.email = noop_email
+
+    def headers(self, user_id: str) -> Dict[str, str]:
+        if user_id not in self.tokens:
+            claims = {
+                "sub": user_id,
+                "aud": constants.AZURE_B2C_CLIENT_ID,
+                "exp": int(time.time()) + 24 * 3600,
+                "given_name": "Bench",
+                "family_name": user_id,
+                "emails": [f"{user_id}@example.com"],
+            }
+            self.tokens[user_id] = jwt.encode(claims, self.private_key, algorithm="RS256", headers={"kid": KID})
+        return {auth.AUTH_HEADER: auth.BEARER_PREFIX + self.tokens[user_id]}
+
+    async def call(
+        self, client: TestClientProtocol, route: str, path: str, headers: Dict[str, str], **kwargs
+    ) -> Optional[dict]:
+        """Requests `path`, and records its latency and Firestore operations under `route`."""
+        method, _ = route.split(" ", 1)
+        token = operation_label.set(route)
+        start = time.perf_counter()
+        try:
+            response = await client.open(path, method=method, headers=headers, **kwargs)
+            body = await response.get_data()
+        finally:
+            self.latencies.setdefault(route, []).append(time.perf_counter() - start)
+            operation_label.reset(token)
+        if response.status_code >= 400:
+            self.errors[route] = self.errors.get(route, 0) + 1
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            return {"data": body.decode()}
+
+    async def run_study(self, client: TestClientProtocol, db: MemoryClient, i: int) -> None:
+        owner = f"owner-{i}-{uuid.uuid4().hex[:8]}"
+        others = [f"user-{i}-{j}-{uuid.uuid4().hex[:8]}" for j in range(self.num_participants)]
+        h = self.headers(owner)
+
+        # study
+        created = await self.call(
+            client,
+            "POST /api/create_study",
+            "/api/create_study",
+            h,
+            json={
+                "study_type": "MPC-GWAS",
+                "title": f"Benchmark {owner}",
+                "demo_study": False,
+                "private_study": i % 2 == 0,
+                "description": "A benchmark study",
+                "study_information": "Created by the API benchmark",
+            },
+        )
+        if not created:
+            return
+        study_id = created["study_id"]
+        q = f"?study_id={study_id}"
+        await self.call(client, "GET /api/study", f"/api/study{q}", h)
+        await self.call(
+            client,
+            "POST /api/study_information",
+            f"/api/study_information{q}",
+            h,
+            json={"description": "An updated description", "information": "Updated information"},
+        )
+        await self.call(client, "POST /api/parameters", f"/api/parameters{q}", h, json={"NUM_SNPS": 1000, "NUM_CPUS": 4})
+
+        # participants, half of them by request and the others by invitation
+        for j, user_id in enumerate(others):
+            uh = self.headers(user_id)
+            if j % 2 == 0:
+                await self.call(
+                    client, "POST /api/request_join_study", f"/api/request_join_study{q}", uh, json={"message": "Hi"}
+                )
+                await self.call(client, "POST /api/approve_join_study", f"/api/approve_join_study{q}&userId={user_id}", h)
+            else:
+                await self.call(client, "GET /api/my_studies", "/api/my_studies", uh)  # creates the user
+                await self.call(
+                    client,
+                    "POST /api/invite_participant",
+                    "/api/invite_participant",
+                    h,
+                    json={"study_id": study_id, "invitee_email": f"{user_id}@example.com", "message": "Join us"},
+                )
+                await self.call(client, "POST /api/accept_invitation", f"/api/accept_invitation{q}", uh)
+
+        # web
+        async def browse(user_id: str) -> None:
+            uh = self.headers(user_id)
+            await self.call(client, "GET /api/public_studies", "/api/public_studies?fields=summary", uh)
+            await self.call(client, "GET /api/my_studies", "/api/my_studies", uh)
+            await self.call(client, "GET /api/study", f"/api/study{q}", uh)
+            await self.call(client, "GET /api/profile/<id>", f"/api/profile/{owner}", uh)
+            await self.call(
+                client,
+                "POST /api/profile/<id>",
+                f"/api/profile/{user_id}",
+                uh,
+                json={"displayName": f"Bench {user_id}", "about": "Benchmarking"},
+            )
+            await self.call(
+                client, "POST /api/send_message", "/api/send_message", uh, json={"study_id": study_id, "message": "Hello"}
+            )
+            await self.call(client, "GET /api/study_messages", f"/api/study_messages{q}", uh)
+            await self.call(
+                client, "POST /api/update_notifications", "/api/update_notifications", uh, json={"notification": "Hi"}
+            )
+
+        await asyncio.gather(*(browse(user_id) for user_id in [owner] + others))
+
+        # cli, from every party, including the computing party 0 (whose auth key is set up with the study)
+        auth_keys = [await self.download_auth_key(client, user_id, q) for user_id in [owner] + others]
+        doc = (await db.collection("studies").document(study_id).get()).to_dict() or {}
+        auth_keys.insert(0, doc["personal_parameters"][auth.get_cp0_id()]["AUTH_KEY"]["value"])
+
+        async def cli(auth_key: str) -> None:
+            kh = {auth.AUTH_HEADER: auth_key}
+            await self.call(client, "GET /api/get_username", "/api/get_username", kh)
+            await self.call(client, "GET /api/get_study_options", "/api/get_study_options", kh)
+            await self.call(client, "GET /api/get_doc_ref_dict", "/api/get_doc_ref_dict", kh)
+            for k in range(self.num_updates):
+                msg = ["status=running", f"task=step {k}", f"PORTS={k}"][k % 3]
+                await self.call(
+                    client, "GET /api/update_firestore", f"/api/update_firestore?msg=update_firestore::{msg}", kh
+                )
+
+        await asyncio.gather(*(cli(auth_key) for auth_key in auth_keys if auth_key))
+
+        # signaling
+        await self.signal(client, study_id, auth_keys)
+
+        # and clean up
+        await self.call(client, "GET /api/restart_study", f"/api/restart_study{q}", h)
+        if others:
+            await self.call(
+                client, "POST /api/remove_participant", "/api/remove_participant", h, json={"study_id": study_id, "userId": others[-1]}
+            )
+        await self.call(client, "DELETE /api/delete_study", f"/api/delete_study{q}", h)
+
+    async def download_auth_key(self, client: TestClientProtocol, user_id: str, q: str) -> str:
+        res = await self.call(client, "GET /api/download_auth_key", f"/api/download_auth_key{q}", self.headers(user_id))
+        return res["data"] if res else ""
+
+    async def signal(self, client: TestClientProtocol, study_id: str, auth_keys: List[str]) -> None:
+        route = "WS /api/ice"
+        connected = asyncio.Barrier(len(auth_keys))
+
+        async def party(pid: int, auth_key: str) -> None:
+            headers = {auth.AUTH_HEADER: auth_key, signaling.STUDY_ID_HEADER: study_id, "Origin": self.origin}
+            token = operation_label.set(route)
+            start = time.perf_counter()
+            try:
+                async with client.websocket("/api/ice", headers=headers) as ws:
+                    await connected.wait()
+                    for target in range(len(auth_keys)):
+                        if target != pid:
+                            await ws.send_json({"type": "candidate", "data": "bench", "targetPID": target})
+                    for _ in range(len(auth_keys) - 1):
+                        await ws.receive_json()
+            except Exception:
+                self.errors[route] = self.errors.get(route, 0) + 1
+            finally:
+                self.latencies.setdefault(route, []).append(time.perf_counter() - start)
+                operation_label.reset(token)
+
+        await asyncio.wait_for(asyncio.gather(*(party(pid, key) for pid, key in enumerate(auth_keys))), timeout=60)
+
+    async def run(self) -> dict:
+        self.install_stand_ins()
+        app = create_app()
+        db: MemoryClient = app.config["DATABASE"]
+        db.latency = self.firestore_latency
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_study(client: TestClientProtocol, i: int) -> None:
+            async with semaphore:
+                await self.run_study(client, db, i)
+
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            start = time.perf_counter()
+            await asyncio.gather(*(run_study(client, i) for i in range(self.num_studies)))
+            end = time.perf_counter()
+
+        operations = db.operation_counts()
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            routes[route] = {
+                "requests": len(latencies),
+                "errors": self.errors.get(route, 0),
+                "latency_ms": {
+                    "mean": statistics.mean(latencies) * 1000,
+                    "p50": percentile(latencies, 50) * 1000,
+                    "p90": percentile(latencies, 90) * 1000,
+                    "p99": percentile(latencies, 99) * 1000,
+                    "max": max(latencies) * 1000,
+                },
+                "firestore_per_request": {
+                    operation: round(count / len(latencies), 2) for operation, count in operations.get(route, {}).items()
+                },
+            }
+        num_requests = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            "studies": self.num_studies,
+            "participants_per_study": self.num_participants,
+            "concurrency": self.concurrency,
+            "firestore_latency_ms": db.latency * 1000,
+            "requests": num_requests,
+            "errors": sum(self.errors.values()),
+            "requests_per_sec": num_requests / (end - start),
+            "total_sec": end - start,
+            "firestore_total": {
+                operation: sum(counts.get(operation, 0) for counts in operations.values())
+                for operation in sorted({operation for counts in operations.values() for operation in counts})
+            },
+            "routes": routes,
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", type=int, default=20, help="number of study scenarios")
+    parser.add_argument("--participants", type=int, default=2, help="participants per study, besides its owner")
+    parser.add_argument("--concurrency", type=int, default=10, help="number of study scenarios run concurrently")
+    parser.add_argument("--updates", type=int, default=12, help="CLI updates sent by each party")
+    parser.add_argument(
+        "--firestore-latency-ms", type=float, default=0.0, help="simulated latency of each Firestore RPC, in ms"
+    )
+    args = parser.parse_args()
+
+    benchmark = Benchmark(
+        args.studies, args.participants, args.concurrency, args.updates, args.firestore_latency_ms / 1000
+    )
+    results = asyncio.run(benchmark.run())
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Load test for the /api/ice signaling websocket.
+
+Drives ice_ws through Quart's test websocket client with N studies x M parties,
+with in-memory stand-ins for Firestore study reads and auth key lookups, and reports
+connect-to-barrier latency, per-message relay latency percentiles, throughput
+and memory per connection.
+
+Usage:
+    python -m benchmarks.signaling_bench --studies 100 --parties 3 --messages 50
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import tracemalloc
+import uuid
+from typing import Dict, List
+
+from quart import Quart
+
+from src import signaling
+from src.auth import AUTH_HEADER
+from src.utils import constants
+from src.utils.signaling.relay import create_relay
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Benchmark:
+    def __init__(
+        self, num_studies: int, num_parties: int, num_messages: int, payload_size: int, timeout: float
+    ) -> None:
+        self.num_studies = num_studies
+        self.num_parties = num_parties
+        self.num_messages = num_messages
+        self.payload = "x" * payload_size
+        # a broken stand-in fails the benchmark instead of leaving the parties waiting forever
+        self.timeout = timeout
+
+        self.studies: Dict[str, dict] = {}
+        self.auth_keys: Dict[str, dict] = {}
+        for _ in range(num_studies):
+            study_id = str(uuid.uuid4())
+            participants = [f"user-{study_id}-{pid}" for pid in range(num_parties)]
+            self.studies[study_id] = {"study_id": study_id, "participants": participants}
+            for user_id in participants:
+                self.auth_keys[uuid.uuid4().hex] = {"study_id": study_id, "username": user_id}
+
+        self.barrier_latencies: List[float] = []
+        self.relay_latencies: List[float] = []
+        self.all_connected = asyncio.Event()
+        self.connected_memory = 0
+
+    def install_stand_ins(self) -> None:
+        constants.TERRA = ""
+
+        async def fetch_study(study_id: str, user_id: str = "", cached: bool = False):
+            return None, None, self.studies[study_id]
+
+        async def get_cli_user(ws) -> dict:
+            return self.auth_keys[ws.headers[AUTH_HEADER]]
+
+        signaling.fetch_study = fetch_study
+        signaling.get_cli_user = get_cli_user
+
+        # measure the rendezvous from the server side
+        wait_for_parties = signaling.relay.wait_for_parties
+        num_connections = self.num_studies * self.num_parties
+
+        async def timed_wait_for_parties(study_id: str, num_parties: int, timeout=None) -> None:
+            start = time.perf_counter()
+            await wait_for_parties(study_id, num_parties, timeout)
+            self.barrier_latencies.append(time.perf_counter() - start)
+            if len(self.barrier_latencies) == num_connections:
+                self.connected_memory = tracemalloc.get_traced_memory()[0]
+                self.all_connected.set()
+
+        signaling.relay.wait_for_parties = timed_wait_for_parties  # type: ignore
+
+    async def run_party(self, app: Quart, auth_key: str) -> None:
+        user = self.auth_keys[auth_key]
+        study_id = user["study_id"]
+        pid = self.studies[study_id]["participants"].index(user["username"])
+        others = [p for p in range(self.num_parties) if p != pid]
+        expected = self.num_messages * len(others)
+
+        headers = {AUTH_HEADER: auth_key, signaling.STUDY_ID_HEADER: study_id}
+        async with app.test_client().websocket("/api/ice", headers=headers) as ws:
+            await asyncio.wait_for(self.all_connected.wait(), self.timeout)
+
+            async def send() -> None:
+                for i in range(self.num_messages):
+                    for target in others:
+                        data = json.dumps({"sent": time.perf_counter(), "payload": self.payload})
+                        await ws.send_json({"type": "candidate", "data": data, "targetPID": target})
+                    if i % 10 == 0:
+                        await asyncio.sleep(0)
+
+            sender = asyncio.create_task(send())
+            for _ in range(expected):
+                msg = await asyncio.wait_for(ws.receive_json(), self.timeout)
+                self.relay_latencies.append(time.perf_counter() - json.loads(msg["data"])["sent"])
+            await sender
+
+    async def run(self) -> dict:
+        app = Quart(__name__)
+        app.register_blueprint(signaling.bp)
+        self.install_stand_ins()
+
+        tracemalloc.start()
+        baseline_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        parties = [asyncio.create_task(self.run_party(app, auth_key)) for auth_key in self.auth_keys]
+        await asyncio.wait_for(self.all_connected.wait(), self.timeout)
+        connected = time.perf_counter()
+        await asyncio.wait_for(asyncio.gather(*parties), self.timeout)
+        end = time.perf_counter()
+        tracemalloc.stop()
+
+        num_connections = len(self.auth_keys)
+        return {
+            "studies": self.num_studies,
+            "parties_per_study": self.num_parties,
+            "connections": num_connections,
+            "connect_to_barrier_ms": {
+                "mean": statistics.mean(self.barrier_latencies) * 1000,
+                "p50": percentile(self.barrier_latencies, 50) * 1000,
+                "p99": percentile(self.barrier_latencies, 99) * 1000,
+                "max": max(self.barrier_latencies) * 1000,
+            },
+            "relay_latency_ms": {
+                "p50": percentile(self.relay_latencies, 50) * 1000,
+                "p90": percentile(self.relay_latencies, 90) * 1000,
+                "p99": percentile(self.relay_latencies, 99) * 1000,
+                "max": max(self.relay_latencies, default=float("nan")) * 1000,
+            },
+            "messages": len(self.relay_latencies),
+            "messages_per_sec": len(self.relay_latencies) / (end - connected),
+            "memory_per_connection_kib": (self.connected_memory - baseline_memory) / num_connections / 1024,
+            "total_sec": end - start,
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", type=int, default=100, help="number of concurrent studies")
+    parser.add_argument("--parties", type=int, default=3, help="number of parties per study")
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by each party to each other party")
+    parser.add_argument("--payload-size", type=int, default=200, help="size of each message payload, in bytes")
+    parser.add_argument("--relay", choices=["local", "loopback", "redis"], default=constants.SIGNALING_RELAY)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the parties at each stage")
+    args = parser.parse_args()
+
+    constants.SIGNALING_RELAY = args.relay
+    signaling.relay = create_relay()
+
+    results = asyncio.run(Benchmark(args.studies, args.parties, args.messages, args.payload_size, args.timeout).run())
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
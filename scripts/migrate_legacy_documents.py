@@ -0,0 +1,33 @@
+"""
+Moves the data of the legacy user documents to where the current version reads it:
+the display names of `users/display_names` to the user documents,
+and the auth keys of `users/auth_keys` to the auth_keys collection.
+
+Instances of the previous version keep writing the legacy documents, so run this once a rollout
+of the current version has finished, and no instance of the previous version is left.
+Until then, the current version falls back to reading the legacy documents.
+
+Usage:
+    python -m scripts.migrate_legacy_documents
+"""
+
+import asyncio
+
+from src import create_app
+from src.api_utils import migrate_display_names
+from src.auth import migrate_auth_keys
+
+
+async def migrate() -> None:
+    app = create_app()
+    async with app.app_context():
+        await migrate_display_names()
+        await migrate_auth_keys()
+
+
+def main() -> None:
+    asyncio.run(migrate())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import os
 import secrets
+from typing import Union
 
 import firebase_admin
 import sentry_sdk
@@ -7,12 +8,13 @@ from google.cloud import firestore
 from quart import Quart, Response, json
 from quart_cors import cors
 from sentry_sdk.integrations.quart import QuartIntegration
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, InternalServerError
 
 from src import cli, signaling, status
-from src.api_utils import get_allowed_origins
+from src.api_utils import begin_unit_of_work, flush_unit_of_work, get_allowed_origins
 from src.auth import register_terra_service_account
 from src.utils import constants, custom_logging
+from src.utils.memory_firestore import MemoryClient
 from src.web import participants, study, web
 
 logger = custom_logging.setup_logging(__name__)
@@ -24,7 +26,7 @@ def create_app() -> Quart:
     else:
         logger.info("Creating app - NOT on Terra")
 
-    initialize_firebase_app()
+    database = create_database()
 
     if constants.SENTRY_DSN:
         sentry_sdk.init(
@@ -40,10 +42,7 @@ def create_app() -> Quart:
 
     app.config.from_mapping(
         SECRET_KEY=secrets.token_hex(16),
-        DATABASE=firestore.AsyncClient(
-            project=constants.FIREBASE_PROJECT_ID,
-            database=constants.FIRESTORE_DATABASE,
-        ),
+        DATABASE=database,
     )
 
     app.register_blueprint(status.bp)
@@ -58,8 +57,26 @@ def create_app() -> Quart:
         if constants.TERRA:
             await register_terra_service_account()
 
+    @app.before_request
+    async def _begin_unit_of_work():
+        begin_unit_of_work()
+
+    @app.after_request
+    async def _flush_unit_of_work(response: Response) -> Response:
+        # the study changes staged by the request
+        try:
+            await flush_unit_of_work()
+        except Exception:
+            logger.exception("Failed to write study changes:")
+            # handled like any other error, so that the response gets the security headers too
+            raise InternalServerError("Failed to save changes")
+        return response
+
     @app.errorhandler(HTTPException)
     async def handle_exception(e: HTTPException):
+        # errors raised while finishing the response (e.g. by _flush_unit_of_work) come wrapped in a generic 500
+        if isinstance(original := getattr(e, "original_exception", None), HTTPException):
+            e = original
         res = e.get_response()
         if e.description:
             res.data = json.dumps({"error": e.description})  # type: ignore
@@ -68,8 +85,8 @@ def create_app() -> Quart:
 
     @app.after_request
     async def apply_security_headers(response: Response) -> Response:
-        # no caching
-        response.headers["Cache-Control"] = "no-store"
+        # no caching, unless the route allows it (e.g. revalidation with ETags)
+        response.headers.setdefault("Cache-Control", "no-store")
         response.headers["Pragma"] = "no-cache"
 
         # security
@@ -94,6 +111,18 @@ def create_app() -> Quart:
     return app
 
 
+def create_database() -> Union[firestore.AsyncClient, MemoryClient]:
+    if constants.DATA_BACKEND == "memory":
+        logger.info("Using the in-memory data backend")
+        return MemoryClient()
+
+    initialize_firebase_app()
+    return firestore.AsyncClient(
+        project=constants.FIREBASE_PROJECT_ID,
+        database=constants.FIRESTORE_DATABASE,
+    )
+
+
 def initialize_firebase_app() -> None:
     key: str = ".serviceAccountKey.json"
     options = {
@@ -1,12 +1,23 @@
+import asyncio
+import base64
+import itertools
+import json
 import traceback
 import uuid
-from typing import Union
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from copy import deepcopy
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from urllib.parse import urlparse, urlunsplit
 
 import httpx
 from google.cloud import firestore
 from google.cloud.firestore import AsyncDocumentReference
 from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.cloud.firestore_v1.transforms import Increment, Sentinel
 from jsonschema import ValidationError, validate
 from quart import current_app
 from sentry_sdk import capture_event
@@ -14,12 +25,35 @@ from werkzeug.exceptions import BadRequest, Forbidden, HTTPException
 from werkzeug.wrappers import Response
 
 from src.utils import constants, custom_logging
+from src.utils.cache import MISSING, SingleFlight, TTLCache
+from src.utils.generic_functions import BatchWriter
 from src.utils.schemas.generic import generic_schema
 
 logger = custom_logging.setup_logging(__name__)
 
 ID_KEY = "sub"
 TERRA_ID_KEY = "id"
+# the user document that held the display names of all users before they moved to the user documents
+LEGACY_DISPLAY_NAMES_DOCUMENT = "display_names"
+
+# process-wide read-through cache of study documents, for the routes that only read them.
+# Writes made by this process invalidate their entries; the TTL bounds how stale
+# an entry can be after a write made by another instance.
+# Entries are study dicts with their versions (see get_study).
+study_cache: TTLCache[str, Tuple[dict, Optional[str]]] = TTLCache(constants.STUDY_CACHE_TTL, constants.STUDY_CACHE_SIZE)
+# concurrent reads of a study document (e.g. from the CLI of every party of a study at once) share one Firestore read,
+# and, for STUDY_READ_TTL seconds, its result
+study_reads: SingleFlight[str, Tuple[dict, Optional[str]]] = SingleFlight()
+recent_study_reads: TTLCache[str, Tuple[dict, Optional[str]]] = TTLCache(
+    constants.STUDY_READ_TTL, constants.STUDY_CACHE_SIZE
+)
+# the writes by this process of the studies being read (see _track_study_writes),
+# so that the reads that started before a write do not fill the caches
+_study_writes: Dict[str, "_StudyWrites"] = {}
+# called with the ID of each study that this process writes, e.g. to stream its changes (see study_events)
+study_write_listeners: List[Callable[[str], None]] = []
+# display names by user ID, read from the user documents
+display_names_cache: TTLCache[str, str] = TTLCache(constants.DISPLAY_NAME_CACHE_TTL, constants.DISPLAY_NAME_CACHE_SIZE)
 
 
 class APIException(HTTPException):
@@ -54,25 +88,31 @@ def get_allowed_origins():
     return origins
 
 
-async def get_studies(private_filter=None) -> list:
+STUDY_SUMMARY_KEYS = [
+    "study_id",
+    "created",
+    "title",
+    "study_information",
+    "description",
+    "requested_participants",
+    "participants",
+    "owner",
+    "private",
+    "invited_participants",
+    "study_type",
+    "setup_configuration", # deprecated
+    "demo",
+]
+# lightweight projection for list views, without the free-text fields
+STUDY_LIST_KEYS = [key for key in STUDY_SUMMARY_KEYS if key not in ("description", "study_information")]
+
+MAX_PAGE_SIZE = 100
+
+
+async def get_studies(private_filter=None, keys: List[str] = STUDY_SUMMARY_KEYS) -> list:
     db = current_app.config["DATABASE"]
-    desired_keys = [
-        "study_id",
-        "created",
-        "title",
-        "study_information",
-        "description",
-        "requested_participants",
-        "participants",
-        "owner",
-        "private",
-        "invited_participants",
-        "study_type",
-        "setup_configuration", # deprecated
-        "demo",
-    ]
     try:
-        studies_query = db.collection("studies").select(desired_keys)
+        studies_query = db.collection("studies").select(keys)
         if private_filter is not None:
             studies_query = studies_query.where(filter=FieldFilter("private", "==", private_filter))
         studies = [doc.to_dict() async for doc in studies_query.stream()]
@@ -82,17 +122,150 @@ async def get_studies(private_filter=None) -> list:
     return studies
 
 
-async def get_display_names() -> dict:
+async def get_public_studies_page(
+    page_size: int, page_token: str = "", keys: List[str] = STUDY_SUMMARY_KEYS
+) -> Tuple[list, str]:
+    """
+    Fetches a page of public studies, ordered by creation time.
+
+    :param page_token: the continuation token of the previous page, if any.
+    :return: the studies, and the continuation token of the next page ("" for the last page).
+    """
     db = current_app.config["DATABASE"]
+    query = (
+        db.collection("studies")
+        .select(keys)
+        .where(filter=FieldFilter("private", "==", False))
+        .order_by("created")
+        .order_by(FieldPath.document_id())
+    )
+    if page_token:
+        created, study_id = decode_page_token(page_token)
+        query = query.start_after({"created": created, FieldPath.document_id(): study_id})
     try:
-        doc_ref = await db.collection("users").document("display_names").get()
-        display_names = doc_ref.to_dict() or {}
+        studies = await _stream(query.limit(page_size + 1))
     except Exception as e:
-        raise RuntimeError({"error": "Failed to fetch display names", "details": str(e)}) from e
+        raise RuntimeError({"error": "Failed to fetch studies", "details": str(e)}) from e
+
+    if len(studies) <= page_size:
+        return studies, ""
+    studies = studies[:page_size]
+    return studies, encode_page_token(studies[-1]["created"], studies[-1]["study_id"])
+
+
+def encode_page_token(created: datetime, doc_id: str) -> str:
+    """Encodes a cursor over (creation time, document ID) as an opaque continuation token."""
+    cursor = {"created": created.isoformat(), "id": doc_id}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_page_token(page_token: str) -> Tuple[datetime, str]:
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(page_token.encode()))
+        return datetime.fromisoformat(cursor["created"]), str(cursor["id"])
+    except Exception as e:
+        raise BadRequest("Invalid page token") from e
+
+
+async def get_user_studies(user_id: str, email: str = "") -> list:
+    """
+    Fetches the studies that the user participates in, or is invited to by email,
+    with indexed array-contains queries rather than by scanning all studies.
+    """
+    db = current_app.config["DATABASE"]
+    studies_query = db.collection("studies").select(STUDY_SUMMARY_KEYS)
+    queries = [studies_query.where(filter=FieldFilter("participants", "array_contains", user_id))]
+    if email:
+        queries.append(studies_query.where(filter=FieldFilter("invited_participants", "array_contains", email)))
+    try:
+        results = await asyncio.gather(*(_stream(query) for query in queries))
+    except Exception as e:
+        raise RuntimeError({"error": "Failed to fetch studies", "details": str(e)}) from e
+
+    studies = {study["study_id"]: study for study in itertools.chain(*results)}
+    # in document ID order, like an unfiltered query
+    return [studies[study_id] for study_id in sorted(studies)]
+
+
+async def _stream(query) -> list:
+    return [doc.to_dict() async for doc in query.stream()]
+
 
+async def get_display_names(user_ids: Iterable[str]) -> Dict[str, str]:
+    """
+    Resolves the display names of the given users from their user documents,
+    reading those not in the display name cache with a single batched lookup.
+    Users without a display name are mapped to their ID.
+    """
+    display_names = {}
+    missing = set()
+    for user_id in user_ids:
+        display_name = display_names_cache.get(user_id)
+        if display_name is MISSING:
+            missing.add(user_id)
+        else:
+            display_names[user_id] = display_name
+
+    # emails of invited participants, for instance, are not user IDs
+    lookups = [user_id for user_id in missing if user_id and "/" not in user_id]
+    if lookups:
+        db: firestore.AsyncClient = current_app.config["DATABASE"]
+        try:
+            refs = [db.collection("users").document(user_id) for user_id in lookups]
+            async for doc in db.get_all(refs, field_paths=["display_name"]):
+                if display_name := (doc.to_dict() or {}).get("display_name"):
+                    display_names[doc.id] = display_name
+            display_names |= await get_legacy_display_names(
+                [user_id for user_id in lookups if user_id not in display_names]
+            )
+        except Exception as e:
+            raise RuntimeError({"error": "Failed to fetch display names", "details": str(e)}) from e
+
+    for user_id in missing:
+        display_names.setdefault(user_id, user_id)
+        display_names_cache.set(user_id, display_names[user_id])
     return display_names
 
 
+def invalidate_display_name(user_id: str) -> None:
+    display_names_cache.pop(user_id)
+
+
+async def get_legacy_display_names(user_ids: List[str]) -> Dict[str, str]:
+    """
+    Reads display names from the legacy `users/display_names` document, which instances of the previous version
+    keep writing during a rolling deploy, until it is migrated (see scripts/migrate_legacy_documents.py).
+    """
+    if not user_ids:
+        return {}
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    legacy_ref = db.collection("users").document(LEGACY_DISPLAY_NAMES_DOCUMENT)
+    doc = await legacy_ref.get([FieldPath(user_id).to_api_repr() for user_id in user_ids])
+    legacy_names = doc.to_dict() or {}
+    return {user_id: legacy_names[user_id] for user_id in user_ids if legacy_names.get(user_id)}
+
+
+async def migrate_display_names() -> None:
+    """
+    Copies the display names of the legacy `users/display_names` document
+    into the user documents, and then deletes it.
+    Only run once no instance writes the legacy document anymore.
+    """
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    legacy_ref = db.collection("users").document(LEGACY_DISPLAY_NAMES_DOCUMENT)
+    display_names = (await legacy_ref.get()).to_dict() or {}
+    if not display_names:
+        return
+
+    logger.info(f"Migrating {len(display_names)} display names to user documents")
+    writer = BatchWriter(db)
+    for user_id, display_name in display_names.items():
+        await writer.set(db.collection("users").document(user_id), {"display_name": display_name}, merge=True)
+    await writer.commit()
+    await legacy_ref.delete()
+    display_names_cache.clear()
+
+
 async def add_user_to_db(decoded_token: dict) -> None:
     user_id = decoded_token[TERRA_ID_KEY] if constants.TERRA else decoded_token[ID_KEY]
     logger.info(f"Creating user {user_id}")
@@ -109,7 +282,6 @@ async def add_user_to_db(decoded_token: dict) -> None:
                 display_name += " " + decoded_token["family_name"]
         if "emails" in decoded_token:
             email = decoded_token["emails"][0]
-        await db.collection("users").document("display_names").set({user_id: display_name}, merge=True)
         await db.collection("users").document(user_id).set(
             {
                 "about": "",
@@ -119,6 +291,7 @@ async def add_user_to_db(decoded_token: dict) -> None:
             },
             merge=True,
         )
+        invalidate_display_name(user_id)
         if constants.SENTRY_DSN:
             capture_event(
                 {
@@ -148,10 +321,289 @@ def validate_uuid(val) -> str:
     return str(val)
 
 
-async def fetch_study(study_id: str, user_id: str = "") -> tuple[firestore.AsyncClient, AsyncDocumentReference, dict]:
+def invalidate_study(study_id: str) -> None:
+    _forget_study(study_id)
+    if unit_of_work := current_unit_of_work():
+        unit_of_work.studies.pop(study_id, None)
+
+
+async def get_study_dict(doc_ref: AsyncDocumentReference, cached: bool = False) -> dict:
+    return (await get_study(doc_ref, cached))[0]
+
+
+async def get_study(doc_ref: AsyncDocumentReference, cached: bool = False) -> Tuple[dict, Optional[str]]:
+    """
+    Reads a study document, from the study cache if `cached`,
+    and at most once per unit of work (see UnitOfWork).
+    Callers get their own copy, which they can modify.
+
+    :return: the study dict, and the version of the document it was read from (its update time), or None
+        if the study does not exist or the dict has changes that are not written yet.
+    """
+    unit_of_work = current_unit_of_work()
+    if unit_of_work and (entry := unit_of_work.studies.get(doc_ref.id)) and (cached or entry[1]):
+        return deepcopy(entry[0]), entry[2]
+
+    if cached and (read := study_cache.get(doc_ref.id)) is not MISSING:
+        doc_ref_dict, version = deepcopy(read[0]), read[1]
+        fresh = False
+    else:
+        with _track_study_writes(doc_ref.id) as written:
+            doc_ref_dict, version = await _read_study(doc_ref)
+            if doc_ref_dict and not written():
+                study_cache.set(doc_ref.id, (deepcopy(doc_ref_dict), version))
+        fresh = True
+
+    if unit_of_work and doc_ref_dict:
+        unit_of_work.studies[doc_ref.id] = (deepcopy(doc_ref_dict), fresh, version)
+        for updates in unit_of_work.pending_updates(doc_ref.id):
+            _apply_updates(unit_of_work.studies, doc_ref.id, updates)
+        if entry := unit_of_work.studies.get(doc_ref.id):
+            return deepcopy(entry[0]), entry[2]
+    return doc_ref_dict, version
+
+
+@dataclass
+class _StudyWrites:
+    readers: int = 0
+    writes: int = 0
+
+
+@contextmanager
+def _track_study_writes(study_id: str) -> Iterator[Callable[[], bool]]:
+    """
+    Yields a function telling whether this process wrote the study since the block started.
+    Writes are only counted while a study is being read, so that the studies written once are not kept forever.
+    """
+    tracked = _study_writes.setdefault(study_id, _StudyWrites())
+    tracked.readers += 1
+    writes = tracked.writes
+    try:
+        yield lambda: tracked.writes != writes
+    finally:
+        tracked.readers -= 1
+        if not tracked.readers:
+            del _study_writes[study_id]
+
+
+def _forget_study(study_id: str) -> None:
+    if tracked := _study_writes.get(study_id):
+        tracked.writes += 1
+    study_cache.pop(study_id)
+    recent_study_reads.pop(study_id)
+    # later reads must not get the result of a read that may have started before the write
+    study_reads.forget(study_id)
+    for listener in study_write_listeners:
+        listener(study_id)
+
+
+async def _read_study(doc_ref: AsyncDocumentReference) -> Tuple[dict, Optional[str]]:
+    if (read := recent_study_reads.get(doc_ref.id)) is MISSING:
+        read = await study_reads.do(doc_ref.id, lambda: _get_study_document(doc_ref))
+    return deepcopy(read[0]), read[1]
+
+
+async def _get_study_document(doc_ref: AsyncDocumentReference) -> Tuple[dict, Optional[str]]:
+    with _track_study_writes(doc_ref.id) as written:
+        doc = await doc_ref.get()
+        if not doc.exists:
+            return {}, None
+        read = (doc.to_dict() or {}, doc.update_time.isoformat())
+        if not written():
+            recent_study_reads.set(doc_ref.id, read)
+    return read
+
+
+# the unit of work of the current request, if any
+_unit_of_work: ContextVar[Optional["UnitOfWork"]] = ContextVar("unit_of_work", default=None)
+
+
+class UnitOfWork:
+    """
+    Request-scoped identity map of study documents, and of the changes pending on them.
+
+    Within a unit of work, each study is read at most once: later reads get a copy of the first one,
+    with the changes staged since applied to it. StudyMutation.commit() stages its changes instead of
+    writing them; the changes to each study are merged, and flush() writes them all in one batch
+    at the end of the unit of work. Writes made otherwise (e.g. in transactions) invalidate the study.
+
+    A unit of work only applies to the task that began it, not to the background tasks that it starts,
+    which must not see changes that may not be written yet.
+    """
+
+    def __init__(self) -> None:
+        self.task = asyncio.current_task()
+        # study dicts by study ID, whether they were read from Firestore rather than from the study cache,
+        # and their versions (see get_study)
+        self.studies: Dict[str, Tuple[dict, bool, Optional[str]]] = {}
+        self.pending: Dict[str, Tuple[AsyncDocumentReference, Dict[str, Any]]] = {}
+
+    def pending_updates(self, study_id: str) -> List[Dict[str, Any]]:
+        return [self.pending[study_id][1]] if study_id in self.pending else []
+
+    async def stage(self, doc_ref: AsyncDocumentReference, updates: Dict[str, Any]) -> None:
+        if doc_ref.id in self.pending:
+            merged = _merge_updates(self.pending[doc_ref.id][1], updates)
+            if merged is None:
+                # the changes cannot be written together without changing their outcome
+                await self.flush()
+            else:
+                self.pending[doc_ref.id] = (doc_ref, merged)
+        if doc_ref.id not in self.pending:
+            self.pending[doc_ref.id] = (doc_ref, dict(updates))
+        _apply_updates(self.studies, doc_ref.id, updates)
+
+    async def flush(self) -> None:
+        pending, self.pending = list(self.pending.values()), {}
+        if len(pending) == 1:
+            doc_ref, updates = pending[0]
+            await doc_ref.update(updates)
+        elif pending:
+            db: firestore.AsyncClient = current_app.config["DATABASE"]
+            batch = db.batch()
+            for doc_ref, updates in pending:
+                batch.update(doc_ref, updates)
+            await batch.commit()
+        for doc_ref, _ in pending:
+            _forget_study(doc_ref.id)
+
+
+def current_unit_of_work() -> Optional[UnitOfWork]:
+    unit_of_work = _unit_of_work.get()
+    if unit_of_work is None or unit_of_work.task is not asyncio.current_task():
+        return None
+    return unit_of_work
+
+
+def begin_unit_of_work() -> UnitOfWork:
+    """Begins a unit of work for the rest of the current task, which must flush it."""
+    unit_of_work = UnitOfWork()
+    _unit_of_work.set(unit_of_work)
+    return unit_of_work
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[UnitOfWork]:
+    unit_of_work = UnitOfWork()
+    token = _unit_of_work.set(unit_of_work)
+    try:
+        yield unit_of_work
+    finally:
+        _unit_of_work.reset(token)
+        await unit_of_work.flush()
+
+
+async def flush_unit_of_work() -> None:
+    """Writes the pending changes now, e.g. before starting background tasks that read them."""
+    if unit_of_work := current_unit_of_work():
+        await unit_of_work.flush()
+
+
+def _field_path(path: str) -> Tuple[str, ...]:
+    return tuple(FieldPath.from_api_repr(path).parts)
+
+
+def _apply_update(data: dict, parts: Tuple[str, ...], value: Any) -> bool:
+    """Applies a change to a field of a dict, like Firestore would. Returns False if it cannot."""
+    for part in parts[:-1]:
+        if not isinstance(data.get(part), dict):
+            if value is firestore.DELETE_FIELD:
+                return True
+            data[part] = {}
+        data = data[part]
+    field = parts[-1]
+    if value is firestore.DELETE_FIELD:
+        data.pop(field, None)
+    elif isinstance(value, firestore.ArrayUnion):
+        current = data.get(field) if isinstance(data.get(field), list) else []
+        data[field] = current + [v for v in value.values if v not in current]
+    elif isinstance(value, firestore.ArrayRemove):
+        current = data.get(field) if isinstance(data.get(field), list) else []
+        data[field] = [v for v in current if v not in value.values]
+    elif isinstance(value, (Sentinel, Increment)):
+        return False
+    else:
+        data[field] = deepcopy(value)
+    return True
+
+
+def _apply_updates(
+    studies: Dict[str, Tuple[dict, bool, Optional[str]]], study_id: str, updates: Dict[str, Any]
+) -> None:
+    if study_id not in studies:
+        return
+    doc_ref_dict, fresh, _ = studies[study_id]
+    if all(_apply_update(doc_ref_dict, _field_path(path), value) for path, value in updates.items()):
+        # the changes are not part of any version of the document yet
+        studies[study_id] = (doc_ref_dict, fresh, None)
+    else:
+        del studies[study_id]
+
+
+def _is_array_transform(value: Any) -> bool:
+    return isinstance(value, (firestore.ArrayUnion, firestore.ArrayRemove))
+
+
+def _merge_updates(pending: Dict[str, Any], updates: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Merges changes into the pending changes to a document, so that writing the result has the same outcome
+    as writing them in turn. Returns None if they cannot be merged (e.g. an ArrayRemove after an ArrayUnion).
+    """
+    merged = dict(pending)
+    for path, value in updates.items():
+        parts = _field_path(path)
+        for other in list(merged):
+            other_parts = _field_path(other)
+            other_value = merged[other]
+            if other_parts == parts:
+                if type(value) is type(other_value) and _is_array_transform(value):
+                    values = other_value.values + [v for v in value.values if v not in other_value.values]
+                    value = type(value)(values)
+                elif _is_array_transform(value):
+                    if isinstance(other_value, list):
+                        container = {"": deepcopy(other_value)}
+                        _apply_update(container, ("",), value)
+                        value = container[""]
+                    else:
+                        return None
+                del merged[other]
+            elif parts[: len(other_parts)] == other_parts:
+                # a change to a field of a map that is pending as a whole
+                if not isinstance(other_value, dict):
+                    return None
+                container = deepcopy(other_value)
+                if not _apply_update(container, parts[len(other_parts) :], value):
+                    return None
+                merged[other] = container
+                break
+            elif other_parts[: len(parts)] == parts:
+                # a change that replaces pending changes to the fields of a map
+                if _is_array_transform(value):
+                    return None
+                del merged[other]
+        else:
+            merged[path] = value
+    return merged
+
+
+async def fetch_study(
+    study_id: str, user_id: str = "", cached: bool = False
+) -> tuple[firestore.AsyncClient, AsyncDocumentReference, dict]:
+    """
+    Use `cached` only when the study is not written back from what is read,
+    as the cached document can be a few seconds out of date.
+    """
+    db, doc_ref, doc_ref_dict, _ = await fetch_study_with_version(study_id, user_id, cached)
+    return db, doc_ref, doc_ref_dict
+
+
+async def fetch_study_with_version(
+    study_id: str, user_id: str = "", cached: bool = False
+) -> tuple[firestore.AsyncClient, AsyncDocumentReference, dict, Optional[str]]:
+    """Like fetch_study, and also returns the version of the study (see get_study)."""
     db: firestore.AsyncClient = current_app.config["DATABASE"]
     doc_ref = db.collection("studies").document(study_id)
-    doc_ref_dict = (await doc_ref.get()).to_dict() or {}
+    doc_ref_dict, version = await get_study(doc_ref, cached)
     if not doc_ref_dict:
         logger.error(f"Study not found: {study_id}")
         raise BadRequest("Study not found")
@@ -159,7 +611,7 @@ async def fetch_study(study_id: str, user_id: str = "") -> tuple[firestore.Async
     if user_id and user_id not in doc_ref_dict["participants"]:
         raise Forbidden()
 
-    return db, doc_ref, doc_ref_dict
+    return db, doc_ref, doc_ref_dict, version
 
 
 def validate_json(data: dict, schema: dict = generic_schema) -> dict:
@@ -1,6 +1,7 @@
+import re
 from functools import wraps
 from http import HTTPMethod, HTTPStatus
-from typing import Dict, Set, Union
+from typing import Dict, List, Optional, Set, Union
 
 import google.auth
 import httpx
@@ -9,12 +10,17 @@ import requests
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 from google.auth.transport.requests import Request as GAuthRequest
 from google.cloud import firestore
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
 from jwt import algorithms
 from quart import Request, Websocket, current_app, request
 from werkzeug.exceptions import Conflict, Unauthorized
 
 from src.api_utils import ID_KEY, TERRA_ID_KEY, APIException, add_user_to_db
 from src.utils import constants, custom_logging
+from src.utils.cache import MISSING, TTLCache
+from src.utils.generic_functions import BatchWriter
 
 logger = custom_logging.setup_logging(__name__)
 
@@ -24,6 +30,16 @@ BEARER_PREFIX = "Bearer "
 PUBLIC_KEYS = {}
 USER_IDS: Set = set()
 
+# auth keys are stored one per document, keyed by the auth key, with the study ID, title and username
+AUTH_KEYS_COLLECTION = "auth_keys"
+AUTH_KEY_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,128}")
+# the user document that held all auth keys before they moved to their own collection,
+# which instances of the previous version keep writing during a rolling deploy, until it is migrated
+# (see scripts/migrate_legacy_documents.py)
+LEGACY_AUTH_KEYS_DOCUMENT = "auth_keys"
+# auth key records by auth key, and None for unknown keys
+auth_keys_cache: TTLCache[str, Optional[dict]] = TTLCache(constants.AUTH_KEY_CACHE_TTL, constants.AUTH_KEY_CACHE_SIZE)
+
 
 # Prepare public keys from Microsoft's JWKS endpoint for token verification
 jwks = requests.get(constants.AZURE_B2C_JWKS_URL).json()
@@ -58,9 +74,8 @@ async def get_user_id(req: Union[Request, Websocket] = request) -> str:
     if user_id in USER_IDS:
         return user_id
 
-    # guard against possible confusion of user_id with auth_keys
-    # TODO: move auth_keys into a separate collection
-    if user_id == "auth_keys":
+    # guard against possible confusion of user_id with the legacy auth_keys document
+    if user_id == LEGACY_AUTH_KEYS_DOCUMENT:
         logger.error("Attempted to use 'auth_keys' as user ID")
         raise Unauthorized("Invalid user ID")
 
@@ -180,17 +195,84 @@ async def get_cli_user(req: Union[Request, Websocket]) -> dict:
         if not auth_header:
             raise Unauthorized("Missing authorization key")
 
-        db: firestore.AsyncClient = current_app.config["DATABASE"]
-        doc_ref_dict = (
-            await db.collection("users").document("auth_keys").get()
-        ).to_dict() or {}
-        user = doc_ref_dict.get(auth_header) or None
+        user = await get_auth_key_user(auth_header)
 
         if not user:
             raise Unauthorized("invalid authorization key")
     return user
 
 
+async def get_auth_key_user(auth_key: str) -> Optional[dict]:
+    """
+    Looks up the study ID, title and username of an auth key, with a single document read
+    for keys that are not in the auth key cache. Unknown keys are cached too.
+    """
+    if not AUTH_KEY_PATTERN.fullmatch(auth_key):
+        return None
+    user = auth_keys_cache.get(auth_key)
+    if user is MISSING:
+        db: firestore.AsyncClient = current_app.config["DATABASE"]
+        user = (await db.collection(AUTH_KEYS_COLLECTION).document(auth_key).get()).to_dict() or None
+        if user is None:
+            legacy_ref = db.collection("users").document(LEGACY_AUTH_KEYS_DOCUMENT)
+            legacy_keys = (await legacy_ref.get([FieldPath(auth_key).to_api_repr()])).to_dict() or {}
+            user = legacy_keys.get(auth_key) or None
+        auth_keys_cache.set(auth_key, user)
+    return user
+
+
+async def get_auth_keys(username: str) -> List[dict]:
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    query = db.collection(AUTH_KEYS_COLLECTION).where(filter=FieldFilter("username", "==", username))
+    auth_keys = {doc.id: doc.to_dict() or {} async for doc in query.stream()}
+    legacy_keys = (await db.collection("users").document(LEGACY_AUTH_KEYS_DOCUMENT).get()).to_dict() or {}
+    for auth_key, user in legacy_keys.items():
+        if isinstance(user, dict) and user.get("username") == username:
+            auth_keys.setdefault(auth_key, user)
+    return [user | {"auth_key": auth_key} for auth_key, user in auth_keys.items()]
+
+
+async def set_auth_key(auth_key: str, study_id: str, title: str, username: str) -> None:
+    user = {"study_id": study_id, "title": title, "username": username}
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    await db.collection(AUTH_KEYS_COLLECTION).document(auth_key).set(user)
+    auth_keys_cache.set(auth_key, user)
+
+
+async def delete_auth_key(auth_key: str) -> None:
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    await db.collection(AUTH_KEYS_COLLECTION).document(auth_key).delete()
+    try:
+        # or the legacy document would keep it valid
+        await db.collection("users").document(LEGACY_AUTH_KEYS_DOCUMENT).update(
+            {FieldPath(auth_key).to_api_repr(): firestore.DELETE_FIELD}
+        )
+    except NotFound:
+        pass
+    auth_keys_cache.pop(auth_key)
+
+
+async def migrate_auth_keys() -> None:
+    """
+    Copies the auth keys of the legacy `users/auth_keys` document
+    into the auth_keys collection, and then deletes it.
+    Only run once no instance writes the legacy document anymore.
+    """
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    legacy_ref = db.collection("users").document(LEGACY_AUTH_KEYS_DOCUMENT)
+    auth_keys = (await legacy_ref.get()).to_dict() or {}
+    if not auth_keys:
+        return
+
+    logger.info(f"Migrating {len(auth_keys)} auth keys to the {AUTH_KEYS_COLLECTION} collection")
+    writer = BatchWriter(db)
+    for auth_key, user in auth_keys.items():
+        await writer.set(db.collection(AUTH_KEYS_COLLECTION).document(auth_key), user)
+    await writer.commit()
+    await legacy_ref.delete()
+    auth_keys_cache.clear()
+
+
 async def get_cli_user_id():
     user = await get_cli_user(request)
     user_id = user[TERRA_ID_KEY] if constants.TERRA else user["username"]
@@ -1,14 +1,16 @@
 import asyncio
 from dataclasses import dataclass
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Optional, Tuple
 
 from google.cloud.firestore import AsyncClient, AsyncDocumentReference
-from quart import Blueprint, current_app, request
+from quart import Blueprint, Response, current_app, jsonify, request
 from werkzeug.exceptions import BadRequest, Conflict, Forbidden
 
-from src.auth import get_cli_user_id
+from src.api_utils import get_study
+from src.auth import get_auth_keys, get_cli_user_id
 from src.utils import constants, custom_logging
 from src.utils.api_functions import process_parameter, process_status, process_task
+from src.utils.etags import conditional_response, make_etag
 from src.utils.google_cloud.google_cloud_storage import upload_blob_from_file
 from src.utils.studies_functions import setup_gcp, submit_terra_workflow
 
@@ -23,6 +25,8 @@ class Study:
     ref: AsyncDocumentReference
     user_id: str
     role: str
+    # see get_study
+    version: Optional[str] = None
 
 
 async def _get_user_study_ids():
@@ -49,8 +53,8 @@ async def _get_study():
     user_id, study_id = await _get_user_study_ids()
 
     study_ref = _get_db().collection("studies").document(study_id)
-    doc = await study_ref.get()
-    study = doc.to_dict()
+    # the CLI polls this, and writes go through transactions that re-read the study
+    study, version = await get_study(study_ref, cached=True)
     PARTICIPANTS_KEY = "participants"
     if (
         not study
@@ -62,7 +66,7 @@ async def _get_study():
         raise Conflict("study has no participants")
     role = str(study[PARTICIPANTS_KEY].index(user_id))
 
-    return Study(study_id, study, study_ref, user_id, role)
+    return Study(study_id, study, study_ref, user_id, role, version)
 
 
 @bp.route("/upload_file", methods=["POST"])
@@ -94,25 +98,18 @@ async def upload_file() -> Tuple[dict, int]:
 
 
 @bp.route("/get_doc_ref_dict", methods=["GET"])
-async def get_doc_ref_dict() -> Tuple[dict, int]:
+async def get_doc_ref_dict() -> Response:
     study = await _get_study()
-    return study.dict, 200
+    # the CLI polls this, so unchanged studies are not sent again
+    etag = make_etag(study.id, study.version) if study.version else None
+    return conditional_response(etag, lambda: jsonify(study.dict))
 
 
 @bp.route("/get_study_options", methods=["GET"])
 async def get_study_options() -> Tuple[dict, int]:
     _, username = await get_cli_user_id()
 
-    auth_keys_doc = await _get_db().collection("users").document("auth_keys").get()
-    auth_keys = auth_keys_doc.to_dict() or {}
-
-    options = [
-        value | {"auth_key": key}
-        for key, value in auth_keys.items()
-        if username == value["username"]
-    ]
-
-    return {"options": options}, 200
+    return {"options": await get_auth_keys(username)}, 200
 
 
 @bp.route("/get_username", methods=["GET"])
@@ -139,10 +136,8 @@ async def update_firestore() -> Tuple[dict, int]:
     except KeyError:
         raise Conflict("GCP_PROJECT not found")
 
-    db = _get_db()
     if parameter.startswith("status="):
         return await process_status(
-            db,
             study.user_id,
             study.id,
             parameter,
@@ -152,9 +147,9 @@ async def update_firestore() -> Tuple[dict, int]:
             study.role,
         )
     elif parameter.startswith("task="):
-        return await process_task(db, study.user_id, parameter, study.ref)
+        return await process_task(study.user_id, parameter, study.ref)
     else:
-        return await process_parameter(db, study.user_id, parameter, study.ref)
+        return await process_parameter(study.user_id, parameter, study.ref)
 
 
 @bp.route("/create_cp0", methods=["POST", "GET"])  # TODO: Use only POST
@@ -1,19 +1,23 @@
 import asyncio
-from dataclasses import asdict, dataclass
+import time
+from dataclasses import dataclass
 from enum import Enum
-from typing import Dict, List
+from typing import Awaitable, Callable, Dict, List, Tuple, Union
 
 from quart import Blueprint, Websocket, abort, websocket
+from werkzeug.exceptions import HTTPException
 
-from src.api_utils import fetch_study
+from src.api_utils import fetch_study, study_write_listeners
 from src.auth import get_cli_user, get_user_id
-from src.utils import constants, custom_logging
+from src.utils import constants, custom_logging, metrics
+from src.utils.cache import MISSING, TTLCache
+from src.utils.signaling import codec
+from src.utils.signaling.outbox import Outbox, OverflowPolicy
+from src.utils.signaling.relay import PID, Registration, create_relay
 
 bp = Blueprint("signaling", __name__, url_prefix="/api")
 logger = custom_logging.setup_logging(__name__)
 
-PID = int
-
 
 class MessageType(Enum):
     CANDIDATE = "candidate"
@@ -22,7 +26,29 @@ class MessageType(Enum):
     ERROR = "error"
 
 
-@dataclass
+MESSAGE_TYPES = frozenset(t.value for t in MessageType)
+
+messages_received = metrics.Counter(
+    "sfkit_signaling_messages_received_total", "Signaling messages received from parties", ["type"]
+)
+messages_sent = metrics.Counter(
+    "sfkit_signaling_messages_sent_total", "Signaling messages sent by the server itself", ["type"]
+)
+messages_relayed = metrics.Counter(
+    "sfkit_signaling_messages_relayed_total", "Signaling messages routed to their target party", ["type"]
+)
+bytes_relayed = metrics.Counter("sfkit_signaling_relayed_bytes_total", "Size of the signaling messages routed")
+relay_latency = metrics.Histogram(
+    "sfkit_signaling_relay_seconds", "Time to route a signaling message to the queue or channel of its target"
+)
+rendezvous_wait = metrics.Histogram(
+    "sfkit_signaling_rendezvous_wait_seconds",
+    "Time a party waits for the other parties of its study to connect",
+    buckets=(0.1, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+
+
+@dataclass(slots=True)
 class Message:
     type: MessageType
     data: str = ""
@@ -30,106 +56,218 @@ class Message:
     sourcePID: PID = -1
     targetPID: PID = -1
 
-    async def send(self, ws: Websocket):
-        msg = asdict(self)
-        for key, value in msg.items():
-            if isinstance(value, Enum):
-                msg[key] = value.value
+    def to_dict(self) -> dict:
+        return {
+            "type": self.type.value,
+            "data": self.data,
+            "studyID": self.studyID,
+            "sourcePID": self.sourcePID,
+            "targetPID": self.targetPID,
+        }
+
+    async def send(self, ws: Websocket, binary: bool = False):
+        msg = self.to_dict()
         if self.type == MessageType.ERROR:
             logger.error("Sending error message: %s", msg)
-        await ws.send_json(msg)
+        messages_sent.inc(msg["type"])
+        await _frame_sender(ws, binary)(codec.dumps(msg))
+
+
+def _frame_sender(ws: Websocket, binary: bool) -> Callable[[str], Awaitable[None]]:
+    if not binary:
+        return ws.send
 
-    @staticmethod
-    async def receive(ws: Websocket):
-        msg = await ws.receive_json()
-        logger.debug("Received: %s", msg)
-        msg["type"] = MessageType(msg["type"])
-        return Message(**msg)
+    async def send_binary(frame: str) -> None:
+        await ws.send(codec.to_binary(frame, constants.SIGNALING_COMPRESSION_THRESHOLD))
 
+    return send_binary
 
-# in-memory stores for Websockets
-study_barriers: Dict[str, asyncio.Barrier] = {}
-study_parties: Dict[str, Dict[PID, Websocket]] = {}
+
+def stamp_frame(frame: Union[str, bytes], study_id: str, pid: PID) -> Tuple[PID, dict]:
+    """
+    Parses a received frame just enough to route it, without materializing a Message,
+    and rebuilds it from the fields of a Message only, with its source PID and study ID
+    overridden (this prevents PID spoofing).
+
+    :return: the target PID and the stamped message.
+    """
+    msg = codec.loads(frame)
+    if msg.get("type") not in MESSAGE_TYPES:
+        raise ValueError(f"Invalid message type: {msg.get('type')}")
+    target_pid = msg.get("targetPID", -1)
+    if type(target_pid) != int:
+        raise ValueError(f"Invalid target PID: {target_pid}")
+    return target_pid, {
+        "type": msg["type"],
+        "data": msg.get("data", ""),
+        "studyID": study_id,
+        "sourcePID": pid,
+        "targetPID": target_pid,
+    }
+
+
+# routes messages between the Websockets of study parties
+relay = create_relay()
+# outbound queues of the parties connected to this process
+study_outboxes: Dict[str, Dict[PID, Outbox]] = {}
+
+# short-lived cache for Websocket admission, so that reconnection storms are served
+# without Firestore reads (auth keys are cached by get_cli_user)
+study_participants_cache: TTLCache[str, List[str]] = TTLCache(
+    constants.SIGNALING_AUTH_CACHE_TTL, constants.SIGNALING_AUTH_CACHE_SIZE
+)
 
 STUDY_ID_HEADER = "X-MPC-Study-ID"
 
-def reset_study_websockets(study_id: str):
-    if study_id in study_barriers:
-        del study_barriers[study_id]
-    if study_id in study_parties:
-        del study_parties[study_id]
+
+async def reset_study_websockets(study_id: str):
+    await relay.reset(study_id)
+    invalidate_study_auth(study_id)
+
+
+def invalidate_study_auth(study_id: str):
+    study_participants_cache.pop(study_id)
+
+
+# once the changes to a study are written (e.g. to its participants), as unit of work writes are deferred
+study_write_listeners.append(invalidate_study_auth)
+
+
+metrics.Gauge(
+    "sfkit_signaling_active_studies",
+    "Studies with parties connected to this process",
+    lambda: len(study_outboxes),
+)
+metrics.Gauge(
+    "sfkit_signaling_active_parties",
+    "Parties connected to this process",
+    lambda: sum(len(outboxes) for outboxes in study_outboxes.values()),
+)
+metrics.Gauge(
+    "sfkit_signaling_queued_messages",
+    "Messages waiting in the outbound queues of connected parties",
+    lambda: sum(o.depth for outboxes in study_outboxes.values() for o in outboxes.values()),
+)
+metrics.Gauge(
+    "sfkit_signaling_dropped_messages",
+    "Messages dropped by the outbound queues of connected parties",
+    lambda: sum(o.dropped for outboxes in study_outboxes.values() for o in outboxes.values()),
+)
 
 
 @bp.websocket("/ice")
 async def ice_ws():
-    user_id = await _get_user_id(websocket)
+    # clients that negotiate the binary subprotocol get binary frames,
+    # with large payloads compressed (see codec)
+    binary = codec.BINARY_SUBPROTOCOL in websocket.requested_subprotocols
+    if binary:
+        await websocket.accept(subprotocol=codec.BINARY_SUBPROTOCOL)
+
+    user_id = await _get_user_id(websocket, binary)
     if not user_id:
-        await Message(MessageType.ERROR, "Missing authentication").send(websocket)
+        await Message(MessageType.ERROR, "Missing authentication").send(websocket, binary)
         abort(401)
 
     study_id = websocket.headers.get(STUDY_ID_HEADER)
     if not study_id:
-        await Message(MessageType.ERROR, f"Missing {STUDY_ID_HEADER} header").send(websocket)
+        await Message(MessageType.ERROR, f"Missing {STUDY_ID_HEADER} header").send(websocket, binary)
         abort(400)
 
     study_participants = await _get_study_participants(study_id)
 
     pid = _get_pid(study_participants, user_id)
     if pid < 0:
-        await Message(MessageType.ERROR, f"User {user_id} is not in study {study_id}").send(websocket)
+        await Message(MessageType.ERROR, f"User {user_id} is not in study {study_id}").send(websocket, binary)
         abort(403)
 
-    parties = study_parties.setdefault(study_id, {})
-    if pid in parties:
-        await Message(
-            MessageType.ERROR,
-            f"Party {pid} is already connected to study {study_id}",
-        ).send(websocket)
-        abort(409)
-
+    ws = websocket._get_current_object()  # type: ignore
+    outbox = Outbox(
+        _frame_sender(ws, binary),
+        maxsize=constants.SIGNALING_QUEUE_SIZE,
+        policy=OverflowPolicy(constants.SIGNALING_QUEUE_POLICY),
+        block_timeout=constants.SIGNALING_QUEUE_TIMEOUT,
+    )
+    registration = Registration.CONFLICT
+    # whether the party has passed the rendezvous, and can thus resume its session after a disconnect
+    started = False
     try:
-        # store the current websocket for the party
-        parties[pid] = websocket._get_current_object()  # type: ignore
+        # start writing before registering, since buffered messages are replayed on resumption
+        outbox.start()
+        registration = await relay.register(study_id, pid, outbox.put)
+        if registration == Registration.CONFLICT:
+            await Message(
+                MessageType.ERROR,
+                f"Party {pid} is already connected to study {study_id}",
+            ).send(websocket, binary)
+            abort(409)
+
+        started = registration == Registration.RESUMED
+        study_outboxes.setdefault(study_id, {})[pid] = outbox
         logger.info("Registered websocket for party %d", pid)
 
-        # using a study-specific barrier,
-        # wait until all participants in a study are connected,
-        # and then initiate the ICE protocol for it
-        barrier = study_barriers.setdefault(study_id, asyncio.Barrier(len(study_participants)))
-        async with barrier:
+        if started:
+            logger.info("Party %d resumed its session in study %s", pid, study_id)
+        else:
+            # wait until all participants in a study are connected,
+            # and then initiate the ICE protocol for it
+            start = time.perf_counter()
+            try:
+                await relay.wait_for_parties(
+                    study_id, len(study_participants), timeout=constants.SIGNALING_RENDEZVOUS_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                await Message(MessageType.ERROR, "Timed out waiting for all parties to connect").send(websocket, binary)
+                raise
+            finally:
+                rendezvous_wait.observe(time.perf_counter() - start)
+            started = True
             if pid == 0:
-                logger.info("PID %d: All parties have connected: %s", pid, parties)
-
-            while True:
-                logger.debug("pid: %d, parties: %s", pid, parties)
-                # read the next message and override its PID
-                # (this prevents PID spoofing)
-                msg = await Message.receive(websocket)
-                msg.sourcePID = pid
-                msg.studyID = study_id
-
-                # and send it to the other party
-                if msg.targetPID < 0:
-                    await Message(MessageType.ERROR, f"Missing target PID: {msg}").send(websocket)
-                    continue
-                elif msg.targetPID not in parties or msg.targetPID == pid:
-                    logger.error("Unexpected message is %s. Parties are %s", msg, parties)
-                    await Message(
-                        MessageType.ERROR,
-                        f"Unexpected target id {msg.targetPID}",
-                    ).send(websocket)
-                    continue
-                else:
-                    target_ws = parties[msg.targetPID]
-                    await msg.send(target_ws)
+                logger.info("PID %d: All parties have connected: %s", pid, await relay.parties(study_id))
+
+        while True:
+            logger.debug("pid: %d, study: %s", pid, study_id)
+            # read the next message and stamp it with the PID of its sender;
+            # it is re-encoded with only the fields of a Message
+            target_pid, msg = stamp_frame(await websocket.receive(), study_id, pid)
+            messages_received.inc(msg["type"])
+
+            # and send it to the other party
+            if target_pid < 0:
+                await Message(MessageType.ERROR, f"Missing target PID: {msg}").send(websocket, binary)
+                continue
+
+            frame = codec.dumps(msg)
+            start = time.perf_counter()
+            if target_pid != pid and await relay.send(study_id, target_pid, frame):
+                relay_latency.observe(time.perf_counter() - start)
+                messages_relayed.inc(msg["type"])
+                bytes_relayed.inc(amount=len(frame))
+            else:
+                logger.error("Unexpected message is %s. Parties are %s", msg, await relay.parties(study_id))
+                await Message(
+                    MessageType.ERROR,
+                    f"Unexpected target id {target_pid}",
+                ).send(websocket, binary)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error("Terminal connection error for party %d in study %s: %s", pid, study_id, e)
     finally:
-        del parties[pid]
-        logger.warning("Party %d disconnected from study %s", pid, study_id)
+        try:
+            # a registration that did not complete has undone itself, and a conflicting one belongs to another connection
+            if registration != Registration.CONFLICT:
+                await relay.unregister(study_id, pid, resumable=started)
+                logger.warning("Party %d disconnected from study %s", pid, study_id)
+        finally:
+            await outbox.close()
+        outboxes = study_outboxes.get(study_id, {})
+        if outboxes.get(pid) is outbox:
+            del outboxes[pid]
+            if not outboxes:
+                del study_outboxes[study_id]
 
 
-async def _get_user_id(ws: Websocket):
+async def _get_user_id(ws: Websocket, binary: bool = False):
     # sourcery skip: assign-if-exp, reintroduce-else, remove-unnecessary-else, swap-if-else-branches
     if constants.TERRA:
         return await get_user_id(ws)
@@ -138,12 +276,16 @@ async def _get_user_id(ws: Websocket):
         if user:
             return user["username"]
         else:
-            await Message(MessageType.ERROR, "Unable_to_read_auth_key").send(ws)
+            await Message(MessageType.ERROR, "Unable_to_read_auth_key").send(ws, binary)
 
 
 async def _get_study_participants(study_id: str) -> List[str]:
-    _, _, doc_ref_dict = await fetch_study(study_id)
-    return doc_ref_dict.get("participants", [])
+    participants = study_participants_cache.get(study_id)
+    if participants is MISSING:
+        _, _, doc_ref_dict = await fetch_study(study_id, cached=True)
+        participants = doc_ref_dict.get("participants", [])
+        study_participants_cache.set(study_id, participants)
+    return participants
 
 
 def _get_pid(study: List[str], user_id: str) -> PID:
@@ -1,8 +1,8 @@
 from typing import Tuple
 
-from quart import Blueprint
+from quart import Blueprint, Response
 
-from src.utils import constants
+from src.utils import constants, metrics
 
 bp = Blueprint("status", __name__, url_prefix="")
 
@@ -15,3 +15,8 @@ async def status() -> Tuple[dict, int]:
 @bp.route("/version", methods=["GET"])
 async def version() -> Tuple[dict, int]:
     return {"appVersion": constants.APP_VERSION, "buildVersion": constants.BUILD_VERSION}, 200
+
+
+@bp.route("/metrics", methods=["GET"])
+async def metrics_endpoint() -> Response:
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
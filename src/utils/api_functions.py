@@ -1,19 +1,108 @@
 import asyncio
-import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, TypeVar
 
+from google.api_core.exceptions import Aborted
 from google.cloud import firestore
 from google.cloud.firestore import AsyncClient, AsyncDocumentReference
+from quart import current_app
+from tenacity import AsyncRetrying, RetryCallState
+from tenacity.stop import stop_after_attempt, stop_after_delay
+from tenacity.wait import wait_random_exponential
 
-from src.utils import custom_logging
+from src.api_utils import invalidate_study
+from src.utils import constants, custom_logging, metrics
 from src.utils.generic_functions import is_create_vm
 from src.utils.google_cloud.google_cloud_compute import (GoogleCloudCompute,
                                                          format_instance_name)
+from src.utils.study_mutation import StudyMutation
+from src.utils.update_coalescer import UpdateCoalescer
 
 logger = custom_logging.setup_logging(__name__)
 
+T = TypeVar("T")
+
+update_retries = metrics.Counter(
+    "sfkit_study_update_retries_total", "Retries of transactional study updates from the CLI", ["update"]
+)
+update_contention = metrics.Counter(
+    "sfkit_study_update_contention_total",
+    "Transactional study updates from the CLI aborted by concurrent transactions on the same study",
+    ["update"],
+)
+update_failures = metrics.Counter(
+    "sfkit_study_update_failures_total", "Transactional study updates from the CLI that failed after all retries", ["update"]
+)
+update_batch_size = metrics.Histogram(
+    "sfkit_study_update_batch_size",
+    "Updates from the CLI committed together in one transaction",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+
+
+def _is_contention(e: BaseException) -> bool:
+    # async_transactional retries aborted commits itself, and then wraps the last abort in a ValueError
+    return isinstance(e, Aborted) or isinstance(e.__cause__, Aborted)
+
+
+async def _retry_update(kinds: Counter[str], update: Callable[[], Awaitable[T]]) -> T:
+    """
+    Runs a transactional update, retrying failures with jittered exponential backoff,
+    for at most UPDATE_RETRY_ATTEMPTS attempts and UPDATE_RETRY_MAX_TIME seconds.
+    Unlike sleeping between attempts, the backoff does not block the event loop.
+    Metrics are counted for each of the `kinds` of updates committed together.
+    """
+
+    def count(counter: metrics.Counter) -> None:
+        for kind, amount in kinds.items():
+            counter.inc(kind, amount=amount)
+
+    def before_sleep(state: RetryCallState) -> None:
+        e = state.outcome.exception() if state.outcome else None
+        logger.warning(f"Failed to update study (attempt {state.attempt_number}), retrying: {e!r}")
+        count(update_retries)
+        if e is not None and _is_contention(e):
+            count(update_contention)
+
+    retrying = AsyncRetrying(
+        stop=stop_after_attempt(constants.UPDATE_RETRY_ATTEMPTS) | stop_after_delay(constants.UPDATE_RETRY_MAX_TIME),
+        wait=wait_random_exponential(multiplier=0.1, max=2),
+        before_sleep=before_sleep,
+        reraise=True,
+    )
+    try:
+        return await retrying(update)
+    except Exception as e:
+        logger.exception(f"Failed to update study with {dict(kinds)}:")
+        count(update_failures)
+        if _is_contention(e):
+            count(update_contention)
+        raise
+
+
+@dataclass(frozen=True)
+class StudyUpdate:
+    kind: str  # "status", "task" or "parameter"
+    username: str
+    value: str
+    name: str = ""
+
+
+async def _commit_updates(doc_ref: AsyncDocumentReference, updates: List[StudyUpdate]) -> List[bool]:
+    db: AsyncClient = current_app.config["DATABASE"]
+    update_batch_size.observe(len(updates))
+    return await _retry_update(
+        Counter(update.kind for update in updates), lambda: update_study(db.transaction(), doc_ref, updates)
+    )
+
+
+# the CLI of every party of a study sends its updates to the same study document,
+# so those arriving close together are committed in a single transaction
+study_updates: UpdateCoalescer[StudyUpdate, bool] = UpdateCoalescer(constants.UPDATE_COALESCE_WINDOW, _commit_updates)
+
 
 async def process_status(
-    db: AsyncClient,
     username: str,
     study_id: str,
     parameter: str,
@@ -23,7 +112,11 @@ async def process_status(
     role: str,
 ):
     status = parameter.split("=")[1]
-    await update_status(db.transaction(), {"username": username, "status": status, "doc_ref": doc_ref})
+    try:
+        # a study without statuses is not an error
+        await study_updates.submit(doc_ref, StudyUpdate("status", username, status))
+    except Exception:
+        return {"error": "Failed to update status"}, 400
 
     is_finished_protocol = "Finished protocol" in status
     create_vm = is_create_vm(doc_ref_dict, username)
@@ -39,91 +132,81 @@ async def process_status(
     return {}, 200
 
 
-async def process_task(db: AsyncClient, username: str, parameter: str, doc_ref: AsyncDocumentReference):
+async def process_task(username: str, parameter: str, doc_ref: AsyncDocumentReference):
     task = parameter.split("=")[1]
-    for _ in range(10):
-        try:
-            await update_tasks(db.transaction(), {"username": username, "task": task, "doc_ref": doc_ref})
-            return {}, 200
-        except:
-            logger.exception("Failed to update task:")
-            time.sleep(1)
-
-    return {"error": "Failed to update task"}, 400
-
-
-async def process_parameter(db: AsyncClient, username: str, parameter: str, doc_ref: AsyncDocumentReference):
-    for _ in range(10):
-        try:
-            if await update_parameter(
-                db.transaction(), {"username": username, "parameter": parameter, "doc_ref": doc_ref}
-            ):
-                return {}, 200
-        except:
-            logger.exception("Failed to update parameter:")
-            time.sleep(1)
-
-    return {"error": "Failed to update parameter"}, 400
+    try:
+        # an existing task is not an error
+        await study_updates.submit(doc_ref, StudyUpdate("task", username, task))
+    except Exception:
+        return {"error": "Failed to update task"}, 400
+    return {}, 200
 
 
-async def update_parameter(transaction: firestore.AsyncTransaction, data: dict):
-    @firestore.async_transactional
-    async def transactional_update_parameter(transaction: firestore.AsyncTransaction) -> bool:
-        username = data["username"]
-        parameter = data["parameter"]
-        doc_ref = data["doc_ref"]
+async def process_parameter(username: str, parameter: str, doc_ref: AsyncDocumentReference):
+    try:
         name, value = parameter.split("=")
-        doc_ref_dict: dict = (await doc_ref.get(transaction=transaction)).to_dict()
-        if name in doc_ref_dict["personal_parameters"][username]:
-            doc_ref_dict["personal_parameters"][username][name]["value"] = value
-        elif name in doc_ref_dict["parameters"]:
-            doc_ref_dict["parameters"][name]["value"] = value
-        else:
-            logger.info(f"Parameter {name} not found")
-            return False
-        transaction.update(doc_ref, doc_ref_dict)
-        return True
-
-    return await transactional_update_parameter(transaction)
-
-
-async def update_status(transaction: firestore.AsyncTransaction, data: dict):
-    @firestore.async_transactional
-    async def transactional_update_status(transaction: firestore.AsyncTransaction) -> bool:
-        username = data["username"]
-        status = data["status"]
-        doc_ref = data["doc_ref"]
-        doc_ref_dict: dict = (await doc_ref.get(transaction=transaction)).to_dict()
-        if "status" in doc_ref_dict:
-            doc_ref_dict["status"][username] = status
-        else:
-            logger.info(f"Status not found for user {username}")
-            return False
-        transaction.update(doc_ref, doc_ref_dict)
-        return True
+        if await study_updates.submit(doc_ref, StudyUpdate("parameter", username, value, name)):
+            return {}, 200
+    except Exception:
+        pass
+    return {"error": "Failed to update parameter"}, 400
 
-    return await transactional_update_status(transaction)
 
+async def update_study(
+    transaction: firestore.AsyncTransaction, doc_ref: AsyncDocumentReference, updates: List[StudyUpdate]
+) -> List[bool]:
+    """
+    Applies updates from the CLI to a study in one transaction: the latest status and parameter values win,
+    and new tasks are appended in order. Returns whether each update applied.
+    """
 
-async def update_tasks(transaction: firestore.AsyncTransaction, data: dict):
     @firestore.async_transactional
-    async def transactional_update_tasks(transaction: firestore.AsyncTransaction) -> bool:
-        username = data["username"]
-        task = data["task"]
-        doc_ref = data["doc_ref"]
+    async def transactional_update_study(transaction: firestore.AsyncTransaction) -> List[bool]:
         doc_ref_dict: dict = (await doc_ref.get(transaction=transaction)).to_dict()
-        doc_ref_dict.setdefault("tasks", {}).setdefault(username, [])
-
-        if task not in doc_ref_dict["tasks"][username]:
-            doc_ref_dict["tasks"][username].append(task)
-        else:
-            logger.info(f"Task {task} already exists for user {username}")
-            return False
-
-        transaction.update(doc_ref, doc_ref_dict)
-        return True
-
-    return await transactional_update_tasks(transaction)
+        mutation = StudyMutation()
+        new_tasks: Dict[str, List[str]] = {}
+        results = []
+        for update in updates:
+            username = update.username
+            try:
+                if update.kind == "status":
+                    if "status" not in doc_ref_dict:
+                        logger.info(f"Status not found for user {username}")
+                        results.append(False)
+                        continue
+                    mutation.set("status", username, value=update.value)
+                elif update.kind == "task":
+                    tasks = new_tasks.setdefault(username, [])
+                    if update.value in doc_ref_dict.get("tasks", {}).get(username, []) or update.value in tasks:
+                        logger.info(f"Task {update.value} already exists for user {username}")
+                        results.append(False)
+                        continue
+                    tasks.append(update.value)
+                elif update.name in doc_ref_dict["personal_parameters"][username]:
+                    mutation.set("personal_parameters", username, update.name, "value", value=update.value)
+                elif update.name in doc_ref_dict["parameters"]:
+                    mutation.set("parameters", update.name, "value", value=update.value)
+                else:
+                    logger.info(f"Parameter {update.name} not found")
+                    results.append(False)
+                    continue
+            except Exception:
+                # e.g. a user who is not a participant; the other updates still apply
+                logger.exception(f"Failed to apply {update}:")
+                results.append(False)
+                continue
+            results.append(True)
+
+        for username, tasks in new_tasks.items():
+            if tasks:
+                mutation.array_union("tasks", username, values=tasks)
+        mutation.commit_in(transaction, doc_ref)
+        return results
+
+    try:
+        return await transactional_update_study(transaction)
+    finally:
+        invalidate_study(doc_ref.id)
 
 
 async def delete_instance(study_id, gcp_project, role):
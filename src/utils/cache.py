@@ -0,0 +1,90 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Iterator, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+# returned by TTLCache.get() for absent or expired keys,
+# so that falsy values (e.g. None for negative caching) can be cached too
+MISSING = object()
+
+
+class TTLCache(Generic[K, V]):
+    """
+    In-process LRU cache whose entries expire `ttl` seconds after they are set.
+    """
+
+    def __init__(self, ttl: float, maxsize: int) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[K, Tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: K, value: V) -> None:
+        if self.ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        self._entries.pop(key, None)
+
+    def items(self) -> Iterator[Tuple[K, V]]:
+        now = time.monotonic()
+        return iter([(key, value) for key, (expiry, value) in self._entries.items() if expiry > now])
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    Shares an in-flight call with the concurrent calls for the same key, instead of making them again.
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.shared = 0
+        self._in_flight: Dict[K, asyncio.Future] = {}
+
+    async def do(self, key: K, call: Callable[[], Awaitable[V]]) -> V:
+        future = self._in_flight.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(call())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.shared += 1
+        # a caller that goes away does not cancel the call for the others
+        return await asyncio.shield(future)
+
+    def forget(self, key: K) -> None:
+        """Makes later calls for `key` not share the one in flight, e.g. because its result is out of date."""
+        self._in_flight.pop(key, None)
+
+    def _done(self, key: K, future: asyncio.Future) -> None:
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        if not future.cancelled():
+            # retrieved here, in case all of its callers went away
+            future.exception()
@@ -41,6 +41,8 @@ AZURE_B2C_JWKS_URL = os.getenv(
 FIREBASE_API_KEY = os.getenv("FIREBASE_API_KEY")
 FIREBASE_PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID", SERVER_GCP_PROJECT)
 FIRESTORE_DATABASE = os.getenv("FIRESTORE_DATABASE", "(default)")
+# "firestore", or "memory" for an in-process stand-in, for local development and benchmarks
+DATA_BACKEND = os.getenv("DATA_BACKEND", "firestore")
 
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY", "")
 SENDGRID_FROM_EMAIL = os.getenv("SENDGRID_FROM_EMAIL", "")
@@ -48,6 +50,54 @@ SENDGRID_FROM_EMAIL = os.getenv("SENDGRID_FROM_EMAIL", "")
 SENTRY_DSN = os.getenv("SENTRY_DSN", "")
 SENTRY_ENVIRONMENT = os.getenv("SENTRY_ENVIRONMENT", "development")
 
+# "local" keeps signaling in process memory, "redis" relays it across workers,
+# and "loopback" uses an in-memory stand-in for the broker
+SIGNALING_RELAY = os.getenv("SIGNALING_RELAY", "local")
+SIGNALING_REDIS_URL = os.getenv("SIGNALING_REDIS_URL", "redis://localhost:6379/0")
+# outbound queue of each signaling party: its size, and the overflow policy
+# ("drop-oldest", "block" or "disconnect") with the timeout for "block"
+SIGNALING_QUEUE_SIZE = int(os.getenv("SIGNALING_QUEUE_SIZE", "256"))
+SIGNALING_QUEUE_POLICY = os.getenv("SIGNALING_QUEUE_POLICY", "block")
+SIGNALING_QUEUE_TIMEOUT = float(os.getenv("SIGNALING_QUEUE_TIMEOUT", "5"))
+# how long study participants are cached for signaling websocket admission
+SIGNALING_AUTH_CACHE_TTL = float(os.getenv("SIGNALING_AUTH_CACHE_TTL", "30"))
+SIGNALING_AUTH_CACHE_SIZE = int(os.getenv("SIGNALING_AUTH_CACHE_SIZE", "10000"))
+# how long, and how many (at most SIGNALING_QUEUE_SIZE), messages addressed to a disconnected party
+# are kept for when it reconnects
+SIGNALING_RESUME_TTL = float(os.getenv("SIGNALING_RESUME_TTL", "120"))
+SIGNALING_RESUME_BUFFER_SIZE = int(os.getenv("SIGNALING_RESUME_BUFFER_SIZE", "256"))
+# how long a signaling party waits for the other parties of its study to connect
+SIGNALING_RENDEZVOUS_TIMEOUT = float(os.getenv("SIGNALING_RENDEZVOUS_TIMEOUT", "1800"))
+# minimum size of the signaling frames compressed for clients using the binary subprotocol
+SIGNALING_COMPRESSION_THRESHOLD = int(os.getenv("SIGNALING_COMPRESSION_THRESHOLD", "1024"))
+# maximum size of a compressed signaling frame once inflated, as hypercorn only limits frames as received
+SIGNALING_MAX_FRAME_SIZE = int(os.getenv("SIGNALING_MAX_FRAME_SIZE", str(16 * 1024 * 1024)))
+# how long, and how many, study documents are cached for read-only routes
+STUDY_CACHE_TTL = float(os.getenv("STUDY_CACHE_TTL", "5"))
+STUDY_CACHE_SIZE = int(os.getenv("STUDY_CACHE_SIZE", "1000"))
+# how long a study document read from Firestore also serves uncached reads of it (0 to only share reads in flight)
+STUDY_READ_TTL = float(os.getenv("STUDY_READ_TTL", "0"))
+# how long, and how many, user display names are cached for
+DISPLAY_NAME_CACHE_TTL = float(os.getenv("DISPLAY_NAME_CACHE_TTL", "60"))
+DISPLAY_NAME_CACHE_SIZE = int(os.getenv("DISPLAY_NAME_CACHE_SIZE", "10000"))
+# how long, and how many, auth keys (including unknown ones) are cached for
+AUTH_KEY_CACHE_TTL = float(os.getenv("AUTH_KEY_CACHE_TTL", "60"))
+AUTH_KEY_CACHE_SIZE = int(os.getenv("AUTH_KEY_CACHE_SIZE", "10000"))
+# how old the in-memory view of public studies can get before it is reloaded (0 to query on every request)
+PUBLIC_STUDIES_MAX_AGE = float(os.getenv("PUBLIC_STUDIES_MAX_AGE", "10"))
+# how many times, and for how long, transactional study updates from the CLI are retried
+UPDATE_RETRY_ATTEMPTS = int(os.getenv("UPDATE_RETRY_ATTEMPTS", "10"))
+UPDATE_RETRY_MAX_TIME = float(os.getenv("UPDATE_RETRY_MAX_TIME", "10"))
+# how long updates from the CLI to the same study are collected before they are committed together
+UPDATE_COALESCE_WINDOW = float(os.getenv("UPDATE_COALESCE_WINDOW", "0.05"))
+# how often studies whose changes are streamed to clients are re-read, and how often the streams send heartbeats
+STUDY_EVENTS_POLL_INTERVAL = float(os.getenv("STUDY_EVENTS_POLL_INTERVAL", "2"))
+STUDY_EVENTS_HEARTBEAT_INTERVAL = float(os.getenv("STUDY_EVENTS_HEARTBEAT_INTERVAL", "15"))
+# how many changes to a study are kept for the clients that resume their streams,
+# and for how long after its last client disconnected
+STUDY_EVENTS_HISTORY_SIZE = int(os.getenv("STUDY_EVENTS_HISTORY_SIZE", "100"))
+STUDY_EVENTS_RESUME_TTL = float(os.getenv("STUDY_EVENTS_RESUME_TTL", "60"))
+
 PARAMETERS_TYPE = Dict[str, Union[Dict[str, Any], List[str]]]
 
 MPCGWAS_SHARED_PARAMETERS = {
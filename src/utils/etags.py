@@ -0,0 +1,31 @@
+"""
+Conditional GET: responses with ETags, which clients revalidate with If-None-Match.
+"""
+
+import hashlib
+import json
+from typing import Any, Callable, Optional
+
+from quart import Response, request
+
+
+def make_etag(*parts: Any) -> str:
+    """An ETag for a response made from `parts` (e.g. the version of the document it shows)."""
+    data = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def conditional_response(
+    etag: Optional[str], make_response: Callable[[], Response], cache_control: str = "private, no-cache"
+) -> Response:
+    """
+    Responds 304 Not Modified, without making the response, if the client already has it (by its ETag).
+    Without an ETag (e.g. for data with changes that are not written yet), the response is not cacheable.
+    """
+    if etag is None:
+        return make_response()
+    response = Response(status=304) if request.if_none_match.contains(etag) else make_response()
+    response.set_etag(etag)
+    # clients must revalidate the response before reusing it
+    response.headers["Cache-Control"] = cache_control
+    return response
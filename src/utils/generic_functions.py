@@ -1,26 +1,79 @@
+from typing import Iterable
+
+from google.cloud import firestore
+from google.cloud.firestore import AsyncDocumentReference
 from quart import current_app
 
 from src.utils import custom_logging
 
 logger = custom_logging.setup_logging(__name__)
 
+# the most writes that a batch can hold
+MAX_BATCH_WRITES = 500
+
+
+class BatchWriter:
+    """
+    Writes documents like a batch, but for any number of writes, by committing them a batch at a time, in order.
+    Each batch is atomic, but the writes as a whole are not. Call commit() after the last write.
+    """
+
+    def __init__(self, db: firestore.AsyncClient) -> None:
+        self.db = db
+        self._batch = db.batch()
+        self._size = 0
+
+    async def set(self, reference: AsyncDocumentReference, document_data: dict, merge: bool = False) -> None:
+        self._batch.set(reference, document_data, merge=merge)
+        await self._added()
+
+    async def update(self, reference: AsyncDocumentReference, field_updates: dict) -> None:
+        self._batch.update(reference, field_updates)
+        await self._added()
+
+    async def delete(self, reference: AsyncDocumentReference) -> None:
+        self._batch.delete(reference)
+        await self._added()
 
-async def remove_notification(notification: str, user_id: str) -> None:
+    async def commit(self) -> None:
+        if self._size:
+            batch, self._batch, self._size = self._batch, self.db.batch(), 0
+            await batch.commit()
+
+    async def _added(self) -> None:
+        self._size += 1
+        if self._size == MAX_BATCH_WRITES:
+            await self.commit()
+
+
+async def archive_notification(notification: str, user_id: str) -> None:
+    """Moves a notification to the user's old notifications, with a single atomic write."""
     db = current_app.config["DATABASE"]
     doc_ref = db.collection("users").document(user_id)
-    doc_ref_dict = (await doc_ref.get()).to_dict()
-    notifications = doc_ref_dict.get("notifications", [])
-    notifications.remove(notification)
-    await doc_ref.set({"notifications": notifications}, merge=True)
+    await doc_ref.set(
+        {
+            "notifications": firestore.ArrayRemove([notification]),
+            "old_notifications": firestore.ArrayUnion([notification]),
+        },
+        merge=True,
+    )
 
 
 async def add_notification(notification: str, user_id: str, location: str = "notifications") -> None:
+    await add_notifications(notification, [user_id], location)
+
+
+async def add_notifications(notification: str, user_ids: Iterable[str], location: str = "notifications") -> None:
+    """
+    Adds a notification to several users (e.g. the participants of a study) with batched writes,
+    instead of a read-modify-write of each user document.
+    """
     db = current_app.config["DATABASE"]
-    doc_ref = db.collection("users").document(user_id)
-    doc_ref_dict: dict = (await doc_ref.get()).to_dict() or {}
-    notifications: list[str] = doc_ref_dict.get(location, [])
-    notifications.append(notification)
-    await doc_ref.set({location: notifications}, merge=True)
+    writer = BatchWriter(db)
+    for user_id in user_ids:
+        doc_ref = db.collection("users").document(user_id)
+        await writer.set(doc_ref, {location: firestore.ArrayUnion([notification])}, merge=True)
+    await writer.commit()
 
 
 def is_create_vm(study: dict, participant: str) -> bool:
@@ -0,0 +1,592 @@
+"""
+In-memory stand-in for the Firestore AsyncClient (DATA_BACKEND=memory), for local development and benchmarks.
+
+It covers the part of the API that the app uses: documents and subcollections, merges, field paths and
+transforms (ArrayUnion, ArrayRemove, Increment, DELETE_FIELD, SERVER_TIMESTAMP), batches, transactions
+(run with firestore.async_transactional), get_all, and queries with FieldFilter, select, order_by,
+start_after and limit. Transactions are validated optimistically at commit, and aborted when
+a document they read has changed since, which the transactional decorator then retries.
+
+Each RPC yields to the event loop (after `latency` seconds). RPCs, as well as document reads, writes,
+deletes and transaction aborts, are counted in `operations` under the current `operation_label`,
+so that benchmarks can attribute Firestore usage to routes.
+"""
+
+import asyncio
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
+
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.api_core.exceptions import Aborted, AlreadyExists, NotFound
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+
+Path = Tuple[str, ...]
+
+DOCUMENT_ID = FieldPath.document_id()
+ASCENDING = "ASCENDING"
+DESCENDING = "DESCENDING"
+
+# what the counted operations are attributed to, e.g. the route being benchmarked
+operation_label: ContextVar[str] = ContextVar("operation_label", default="")
+
+
+class _Document:
+    __slots__ = ("data", "create_time", "update_time")
+
+    def __init__(self, data: dict, create_time: datetime, update_time: datetime) -> None:
+        self.data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+
+class MemoryClient:
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.operations: Counter[Tuple[str, str]] = Counter()
+        self._documents: Dict[Path, _Document] = {}
+        self._last_update_time = datetime.fromtimestamp(0, timezone.utc)
+
+    def collection(self, *path: str) -> "MemoryCollectionReference":
+        return MemoryCollectionReference(self, _split(path))
+
+    def document(self, *path: str) -> "MemoryDocumentReference":
+        return MemoryDocumentReference(self, _split(path))
+
+    def batch(self) -> "MemoryWriteBatch":
+        return MemoryWriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5, read_only: bool = False) -> "MemoryTransaction":
+        return MemoryTransaction(self, max_attempts, read_only)
+
+    async def get_all(
+        self,
+        references: Iterable["MemoryDocumentReference"],
+        field_paths: Optional[Iterable[str]] = None,
+        transaction: Optional["MemoryTransaction"] = None,
+    ) -> AsyncIterator["MemoryDocumentSnapshot"]:
+        references = list(references)
+        await self._rpc("BatchGetDocuments")
+        for reference in references:
+            yield self._read(reference, field_paths, transaction)
+
+    def operation_counts(self) -> Dict[str, Dict[str, int]]:
+        """The counted operations, by label."""
+        counts: Dict[str, Dict[str, int]] = {}
+        for (label, operation), count in sorted(self.operations.items()):
+            counts.setdefault(label, {})[operation] = count
+        return counts
+
+    async def _rpc(self, operation: str, count: int = 1) -> None:
+        self._count(operation, count)
+        await asyncio.sleep(self.latency)
+
+    def _count(self, operation: str, count: int = 1) -> None:
+        if count:
+            self.operations[(operation_label.get(), operation)] += count
+
+    def _read(
+        self,
+        reference: "MemoryDocumentReference",
+        field_paths: Optional[Iterable[str]] = None,
+        transaction: Optional["MemoryTransaction"] = None,
+    ) -> "MemoryDocumentSnapshot":
+        self._count("document_reads")
+        document = self._documents.get(reference._path)
+        if transaction is not None:
+            transaction._reads.setdefault(reference._path, document.update_time if document else None)
+        return MemoryDocumentSnapshot(reference, document, field_paths)
+
+    def _commit(self, writes: List["_Write"], reads: Optional[Dict[Path, Optional[datetime]]] = None) -> datetime:
+        """Applies writes atomically, unless a document read by the transaction has changed since."""
+        for path, update_time in (reads or {}).items():
+            document = self._documents.get(path)
+            if (document.update_time if document else None) != update_time:
+                self._count("aborts")
+                raise Aborted(f"Transaction aborted: {'/'.join(path)} was changed by another transaction")
+
+        now = self._now()
+        staged: Dict[Path, Optional[_Document]] = {}
+        for write in writes:
+            current = staged[write.path] if write.path in staged else self._documents.get(write.path)
+            staged[write.path] = write.apply(current, now)
+        for write in writes:
+            self._count("deletes" if write.kind == "delete" else "writes")
+        for path, document in staged.items():
+            if document is None:
+                self._documents.pop(path, None)
+            else:
+                self._documents[path] = document
+        return now
+
+    def _now(self) -> datetime:
+        # update times are unique, since they version the documents
+        now = max(datetime.now(timezone.utc), self._last_update_time + timedelta(microseconds=1))
+        self._last_update_time = now
+        return DatetimeWithNanoseconds(*now.timetuple()[:6], now.microsecond, tzinfo=timezone.utc)
+
+    def _children(self, collection_path: Path) -> Iterable[Tuple[Path, _Document]]:
+        depth = len(collection_path) + 1
+        for path, document in list(self._documents.items()):
+            if len(path) == depth and path[:-1] == collection_path:
+                yield path, document
+
+
+class MemoryDocumentSnapshot:
+    def __init__(
+        self,
+        reference: "MemoryDocumentReference",
+        document: Optional[_Document],
+        field_paths: Optional[Iterable[str]] = None,
+    ) -> None:
+        self.reference = reference
+        self.exists = document is not None
+        self.create_time = document.create_time if document else None
+        self.update_time = document.update_time if document else None
+        data = deepcopy(document.data) if document else None
+        if data is not None and field_paths is not None:
+            data = _project(data, field_paths)
+        self._data = data
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    def to_dict(self) -> Optional[dict]:
+        return deepcopy(self._data)
+
+    def get(self, field_path: str) -> Any:
+        if self._data is None:
+            return None
+        return deepcopy(_get_field(self._data, FieldPath.from_api_repr(field_path).parts))
+
+
+class MemoryDocumentReference:
+    def __init__(self, client: MemoryClient, path: Path) -> None:
+        if len(path) % 2:
+            raise ValueError(f"Not a document path: {'/'.join(path)}")
+        self._client = client
+        self._path = path
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, MemoryDocumentReference) and other._path == self._path
+
+    def __hash__(self) -> int:
+        return hash(self._path)
+
+    @property
+    def id(self) -> str:
+        return self._path[-1]
+
+    @property
+    def path(self) -> str:
+        return "/".join(self._path)
+
+    @property
+    def parent(self) -> "MemoryCollectionReference":
+        return MemoryCollectionReference(self._client, self._path[:-1])
+
+    def collection(self, collection_id: str) -> "MemoryCollectionReference":
+        return MemoryCollectionReference(self._client, self._path + (collection_id,))
+
+    async def get(
+        self, field_paths: Optional[Iterable[str]] = None, transaction: Optional["MemoryTransaction"] = None
+    ) -> MemoryDocumentSnapshot:
+        await self._client._rpc("BatchGetDocuments")
+        return self._client._read(self, field_paths, transaction)
+
+    async def create(self, document_data: dict) -> datetime:
+        await self._client._rpc("Commit")
+        return self._client._commit([_Write(self._path, "create", document_data)])
+
+    async def set(self, document_data: dict, merge: bool = False) -> datetime:
+        await self._client._rpc("Commit")
+        return self._client._commit([_Write(self._path, "set", document_data, merge)])
+
+    async def update(self, field_updates: dict) -> datetime:
+        await self._client._rpc("Commit")
+        return self._client._commit([_Write(self._path, "update", field_updates)])
+
+    async def delete(self) -> datetime:
+        await self._client._rpc("Commit")
+        return self._client._commit([_Write(self._path, "delete")])
+
+
+class MemoryQuery:
+    def __init__(
+        self,
+        client: MemoryClient,
+        collection_path: Path,
+        projection: Optional[List[str]] = None,
+        filters: Tuple[FieldFilter, ...] = (),
+        orders: Tuple[Tuple[str, str], ...] = (),
+        limit: Optional[int] = None,
+        start_after: Optional[Union[dict, MemoryDocumentSnapshot]] = None,
+    ) -> None:
+        self._client = client
+        self._path = collection_path
+        self._projection = projection
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes) -> "MemoryQuery":
+        query = MemoryQuery.__new__(MemoryQuery)
+        query.__dict__.update(self.__dict__)
+        query.__dict__.update({f"_{key}": value for key, value in changes.items()})
+        return query
+
+    def select(self, field_paths: Iterable[str]) -> "MemoryQuery":
+        return self._copy(projection=list(field_paths))
+
+    def where(
+        self, field_path: Optional[str] = None, op_string: Optional[str] = None, value: Any = None, *, filter=None
+    ) -> "MemoryQuery":
+        if filter is None:
+            filter = FieldFilter(field_path, op_string, value)
+        if not isinstance(filter, FieldFilter):
+            raise NotImplementedError("Only FieldFilter filters are supported")
+        return self._copy(filters=self._filters + (filter,))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> "MemoryQuery":
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> "MemoryQuery":
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot: Union[dict, MemoryDocumentSnapshot]) -> "MemoryQuery":
+        return self._copy(start_after=document_fields_or_snapshot)
+
+    async def get(self, transaction: Optional["MemoryTransaction"] = None) -> List[MemoryDocumentSnapshot]:
+        return [snapshot async for snapshot in self.stream(transaction)]
+
+    async def stream(self, transaction: Optional["MemoryTransaction"] = None) -> AsyncIterator[MemoryDocumentSnapshot]:
+        await self._client._rpc("RunQuery")
+        for reference in self._run():
+            yield self._client._read(reference, self._projection, transaction)
+
+    def _run(self) -> List[MemoryDocumentReference]:
+        # like Firestore, documents without a field that the query orders by are left out,
+        # and ties are broken by document ID, in the direction of the last ordering
+        orders = self._orders + ((DOCUMENT_ID, self._orders[-1][1] if self._orders else ASCENDING),)
+        matches = []
+        for path, document in self._client._children(self._path):
+            if not all(_matches(document.data, path, f) for f in self._filters):
+                continue
+            try:
+                key = _sort_key([_get_order_value(document.data, path, field) for field, _ in orders], orders)
+            except KeyError:
+                continue
+            matches.append((key, path))
+        matches.sort()
+
+        if self._start_after is not None:
+            cursor = _sort_key(self._cursor_values(orders), orders)
+            matches = [(key, path) for key, path in matches if key > cursor]
+        if self._limit is not None:
+            matches = matches[: self._limit]
+        return [MemoryDocumentReference(self._client, path) for _, path in matches]
+
+    def _cursor_values(self, orders: Tuple[Tuple[str, str], ...]) -> List[Any]:
+        cursor = self._start_after
+        if isinstance(cursor, MemoryDocumentSnapshot):
+            data = cursor._data or {}
+            return [_get_order_value(data, cursor.reference._path, field) for field, _ in orders]
+        values = []
+        for field, _ in orders:
+            value = cursor[field]
+            if field == DOCUMENT_ID:
+                value = value._path if isinstance(value, MemoryDocumentReference) else self._path + (str(value),)
+            values.append(value)
+        return values
+
+
+class MemoryCollectionReference(MemoryQuery):
+    def __init__(self, client: MemoryClient, path: Path) -> None:
+        if not len(path) % 2:
+            raise ValueError(f"Not a collection path: {'/'.join(path)}")
+        super().__init__(client, path)
+
+    @property
+    def id(self) -> str:
+        return self._path[-1]
+
+    def document(self, document_id: Optional[str] = None) -> MemoryDocumentReference:
+        return MemoryDocumentReference(self._client, self._path + (document_id or uuid.uuid4().hex[:20],))
+
+    async def add(
+        self, document_data: dict, document_id: Optional[str] = None
+    ) -> Tuple[datetime, MemoryDocumentReference]:
+        reference = self.document(document_id)
+        return await reference.create(document_data), reference
+
+
+class _Write:
+    __slots__ = ("path", "kind", "data", "merge")
+
+    def __init__(self, path: Path, kind: str, data: Optional[dict] = None, merge: bool = False) -> None:
+        self.path = path
+        self.kind = kind
+        self.data = data or {}
+        self.merge = merge
+
+    def apply(self, document: Optional[_Document], now: datetime) -> Optional[_Document]:
+        name = "/".join(self.path)
+        if self.kind == "delete":
+            return None
+        if self.kind == "create" and document is not None:
+            raise AlreadyExists(f"Document already exists: {name}")
+        if self.kind == "update" and document is None:
+            raise NotFound(f"No document to update: {name}")
+
+        data = deepcopy(document.data) if document is not None and (self.merge or self.kind == "update") else {}
+        if self.kind == "update":
+            for field_path, value in self.data.items():
+                _set_field(data, FieldPath.from_api_repr(field_path).parts, value, now)
+        else:
+            _merge(data, self.data, now, self.merge)
+        create_time = document.create_time if document is not None else now
+        return _Document(data, create_time, now)
+
+
+class MemoryWriteBatch:
+    def __init__(self, client: MemoryClient) -> None:
+        self._client = client
+        self._writes: List[_Write] = []
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    def create(self, reference: MemoryDocumentReference, document_data: dict) -> None:
+        self._writes.append(_Write(reference._path, "create", document_data))
+
+    def set(self, reference: MemoryDocumentReference, document_data: dict, merge: bool = False) -> None:
+        self._writes.append(_Write(reference._path, "set", document_data, merge))
+
+    def update(self, reference: MemoryDocumentReference, field_updates: dict) -> None:
+        self._writes.append(_Write(reference._path, "update", field_updates))
+
+    def delete(self, reference: MemoryDocumentReference) -> None:
+        self._writes.append(_Write(reference._path, "delete"))
+
+    async def commit(self) -> datetime:
+        await self._client._rpc("Commit")
+        writes, self._writes = self._writes, []
+        return self._client._commit(writes)
+
+
+class MemoryTransaction(MemoryWriteBatch):
+    """A transaction, with the private interface that firestore.async_transactional drives."""
+
+    def __init__(self, client: MemoryClient, max_attempts: int = 5, read_only: bool = False) -> None:
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id: Optional[bytes] = None
+        self._reads: Dict[Path, Optional[datetime]] = {}
+
+    @property
+    def in_progress(self) -> bool:
+        return self._id is not None
+
+    async def get(self, ref_or_query: Union[MemoryDocumentReference, MemoryQuery]):
+        if isinstance(ref_or_query, MemoryDocumentReference):
+            return self._client.get_all([ref_or_query], transaction=self)
+        return ref_or_query.stream(transaction=self)
+
+    def _clean_up(self) -> None:
+        self._writes = []
+        self._reads = {}
+        self._id = None
+
+    async def _begin(self, retry_id: Optional[bytes] = None) -> None:
+        await self._client._rpc("BeginTransaction")
+        self._id = uuid.uuid4().bytes
+
+    async def _rollback(self) -> None:
+        await self._client._rpc("Rollback")
+        self._clean_up()
+
+    async def _commit(self) -> List:
+        if self._read_only and self._writes:
+            raise ValueError("Cannot write in a read-only transaction")
+        await self._client._rpc("Commit")
+        try:
+            self._client._commit(self._writes, self._reads)
+        finally:
+            self._clean_up()
+        return []
+
+    async def commit(self) -> datetime:
+        raise NotImplementedError("Transactions are committed by firestore.async_transactional")
+
+
+def _split(path: Tuple[str, ...]) -> Path:
+    return tuple(part for segment in path for part in segment.split("/") if part)
+
+
+def _get_field(data: dict, parts: Tuple[str, ...]) -> Any:
+    value: Any = data
+    for part in parts:
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(".".join(parts))
+        value = value[part]
+    return value
+
+
+def _get_order_value(data: dict, path: Path, field_path: str) -> Any:
+    if field_path == DOCUMENT_ID:
+        return path
+    return _get_field(data, FieldPath.from_api_repr(field_path).parts)
+
+
+def _project(data: dict, field_paths: Iterable[str]) -> dict:
+    projected: dict = {}
+    for field_path in field_paths:
+        parts = FieldPath.from_api_repr(field_path).parts
+        try:
+            value = _get_field(data, parts)
+        except KeyError:
+            continue
+        target = projected
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return projected
+
+
+def _transform(current: Any, value: Any, now: datetime) -> Any:
+    if value is transforms.SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, transforms.ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        result.extend(v for v in deepcopy(value.values) if v not in result)
+        return result
+    if isinstance(value, transforms.ArrayRemove):
+        return [v for v in current if v not in value.values] if isinstance(current, list) else []
+    if isinstance(value, transforms.Increment):
+        return (current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0) + value.value
+    if isinstance(value, dict):
+        result: dict = {}
+        _merge(result, value, now, merge=False)
+        return result
+    if isinstance(value, (list, tuple)):
+        return [deepcopy(v) for v in value]
+    return deepcopy(value)
+
+
+def _set_field(data: dict, parts: Tuple[str, ...], value: Any, now: datetime) -> None:
+    target = data
+    for part in parts[:-1]:
+        if not isinstance(target.get(part), dict):
+            if value is transforms.DELETE_FIELD:
+                return
+            target[part] = {}
+        target = target[part]
+    if value is transforms.DELETE_FIELD:
+        target.pop(parts[-1], None)
+    else:
+        target[parts[-1]] = _transform(target.get(parts[-1]), value, now)
+
+
+def _merge(data: dict, values: dict, now: datetime, merge: bool) -> None:
+    for key, value in values.items():
+        if value is transforms.DELETE_FIELD:
+            if not merge:
+                raise ValueError("DELETE_FIELD can only be used with update() or set(merge=True)")
+            data.pop(key, None)
+        elif merge and isinstance(value, dict) and value:
+            if not isinstance(data.get(key), dict):
+                data[key] = {}
+            _merge(data[key], value, now, merge)
+        else:
+            data[key] = _transform(data.get(key), value, now)
+
+
+# the order of values of different types, as in Firestore
+def _type_order(value: Any) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, bytes):
+        return 5
+    if isinstance(value, tuple):  # document paths
+        return 6
+    if isinstance(value, list):
+        return 8
+    return 9
+
+
+def _comparable(value: Any) -> Any:
+    if isinstance(value, list):
+        return (_type_order(value), [_comparable(v) for v in value])
+    if isinstance(value, dict):
+        return (_type_order(value), sorted((k, _comparable(v)) for k, v in value.items()))
+    if isinstance(value, datetime) and value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (_type_order(value), value)
+
+
+class _Descending:
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any) -> None:
+        self.value = value
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _Descending) and self.value == other.value
+
+    def __lt__(self, other: "_Descending") -> bool:
+        return other.value < self.value
+
+    def __gt__(self, other: "_Descending") -> bool:
+        return other.value > self.value
+
+
+def _sort_key(values: List[Any], orders: Tuple[Tuple[str, str], ...]) -> tuple:
+    return tuple(
+        _Descending(_comparable(value)) if direction == DESCENDING else _comparable(value)
+        for value, (_, direction) in zip(values, orders)
+    )
+
+
+def _matches(data: dict, path: Path, filter: FieldFilter) -> bool:
+    op, expected = filter.op_string, filter.value
+    try:
+        value = _get_order_value(data, path, filter.field_path)
+    except KeyError:
+        return False
+    if isinstance(expected, MemoryDocumentReference):
+        expected = expected._path
+
+    if op == "==":
+        return value == expected
+    if op == "!=":
+        return value is not None and value != expected
+    if op == "in":
+        return value in expected
+    if op == "not-in":
+        return value is not None and value not in expected
+    if op == "array_contains":
+        return isinstance(value, list) and expected in value
+    if op == "array_contains_any":
+        return isinstance(value, list) and any(v in value for v in expected)
+    if op in ("<", "<=", ">", ">="):
+        if _type_order(value) != _type_order(expected):
+            return False
+        a, b = _comparable(value), _comparable(expected)
+        return {"<": a < b, "<=": a <= b, ">": a > b, ">=": a >= b}[op]
+    raise NotImplementedError(f"Unsupported operator: {op}")
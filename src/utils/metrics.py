@@ -0,0 +1,101 @@
+"""
+Lightweight in-process metrics, rendered in the Prometheus text exposition format.
+
+Updating a metric is a dict lookup and an addition, so instrumentation can stay on in production.
+Metrics are per process: each worker exposes its own values.
+"""
+
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def _format_labels(self, values: LabelValues, extra: str = "") -> str:
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, description, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(labels)} {value}" for labels, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """A gauge whose value is computed when the metrics are collected."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, collect: Callable[[], float]) -> None:
+        super().__init__(name, description)
+        self.collect = collect
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.collect()}"]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, description: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        # per label values: the count of each bucket (and of +Inf), and the sum of observations
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        if label_values not in self.values:
+            self.values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self.values[label_values]
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(labels)} {total[0]}")
+            lines.append(f"{self.name}_count{self._format_labels(labels)} {cumulative}")
+        return lines
+
+
+registry: List[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
@@ -0,0 +1,99 @@
+"""
+In-process materialized view of the public studies, served by /public_studies.
+"""
+
+import asyncio
+import hashlib
+import time
+from bisect import bisect_right
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from quart import Quart, current_app
+
+from src.api_utils import (STUDY_LIST_KEYS, decode_page_token, encode_page_token,
+                           get_display_names, get_studies)
+from src.utils import custom_logging
+
+logger = custom_logging.setup_logging(__name__)
+
+
+@dataclass(frozen=True)
+class Body:
+    data: bytes
+    etag: str
+
+
+def _order(study: dict) -> Tuple[datetime, str]:
+    return study["created"], study["study_id"]
+
+
+def _summary(study: dict) -> dict:
+    return {key: value for key, value in study.items() if key in STUDY_LIST_KEYS or key == "owner_name"}
+
+
+class PublicStudiesView:
+    """
+    The public studies, with their owner names joined, and the JSON bodies of /public_studies
+    (with and without the free-text fields) and their ETags precomputed.
+
+    The view is loaded on first use. Once it is older than `max_age` seconds, it is reloaded
+    in the background, while requests keep being served from the previous version.
+    """
+
+    def __init__(self, max_age: float) -> None:
+        self.max_age = max_age
+        # ordered by creation time, for pagination
+        self.studies: List[dict] = []
+        self.bodies: Dict[bool, Body] = {}
+        self.loaded_at = float("-inf")
+        self._loading: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age > 0
+
+    async def refresh(self) -> None:
+        if time.monotonic() - self.loaded_at < self.max_age:
+            return
+        if self._loading is None:
+            self._loading = asyncio.create_task(self._load(current_app._get_current_object()))  # type: ignore
+            # failures are logged by _load, and only raised to the requests waiting for the first load
+            self._loading.add_done_callback(lambda task: task.cancelled() or task.exception())
+        if not self.bodies:
+            await asyncio.shield(self._loading)
+
+    def body(self, summary: bool = False) -> Body:
+        return self.bodies[summary]
+
+    def page(self, page_size: int, page_token: str = "", summary: bool = False) -> Tuple[List[dict], str]:
+        start = bisect_right(self.studies, decode_page_token(page_token), key=_order) if page_token else 0
+        studies = self.studies[start : start + page_size]
+        next_page_token = encode_page_token(*_order(studies[-1])) if start + page_size < len(self.studies) else ""
+        return [_summary(study) for study in studies] if summary else studies, next_page_token
+
+    async def _load(self, app: Quart) -> None:
+        try:
+            async with app.app_context():
+                studies = await get_studies(private_filter=False)
+                display_names = await get_display_names(study["owner"] for study in studies)
+                for study in studies:
+                    study["owner_name"] = display_names.get(study["owner"], study["owner"])
+
+                self.bodies = {
+                    False: self._make_body(studies),
+                    True: self._make_body([_summary(study) for study in studies]),
+                }
+                self.studies = sorted((study for study in studies if study.get("created")), key=_order)
+                self.loaded_at = time.monotonic()
+        except Exception:
+            logger.exception("Failed to load public studies:")
+            raise
+        finally:
+            self._loading = None
+
+    @staticmethod
+    def _make_body(studies: List[dict]) -> Body:
+        data = current_app.json.dumps({"studies": studies}, separators=(",", ":")).encode()
+        return Body(data, hashlib.blake2b(data, digest_size=16).hexdigest())
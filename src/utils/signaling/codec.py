@@ -0,0 +1,58 @@
+"""
+Codec for signaling frames.
+
+Text frames carry a JSON object. Clients that negotiate the binary subprotocol
+exchange binary frames instead: a one-byte header, followed by the JSON object,
+which is deflated when the header is COMPRESSED. Large handshake artifacts
+(certificates, credentials) are thus compressed, while small ICE candidates
+are not worth the CPU time. Independently of the framing, permessage-deflate
+is negotiated by hypercorn for clients that offer it.
+"""
+
+import zlib
+from typing import Union
+
+import orjson
+
+from src.utils import constants
+
+BINARY_SUBPROTOCOL = "sfkit-signaling.binary"
+
+UNCOMPRESSED = 0
+COMPRESSED = 1
+
+
+def dumps(msg: dict) -> str:
+    return orjson.dumps(msg).decode()
+
+
+def loads(frame: Union[str, bytes]) -> dict:
+    if isinstance(frame, bytes):
+        header, body = frame[:1], frame[1:]
+        if header == bytes([COMPRESSED]):
+            body = _inflate(body, constants.SIGNALING_MAX_FRAME_SIZE)
+        elif header != bytes([UNCOMPRESSED]):
+            raise ValueError(f"Invalid binary frame header: {header!r}")
+        frame = body
+    msg = orjson.loads(frame)
+    if not isinstance(msg, dict):
+        raise ValueError("Signaling frame must be a JSON object")
+    return msg
+
+
+def _inflate(body: bytes, max_size: int) -> bytes:
+    """Decompresses a frame, without inflating more than `max_size` bytes of it (e.g. of a zip bomb)."""
+    decompressor = zlib.decompressobj()
+    inflated = decompressor.decompress(body, max_size)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Signaling frame is larger than {max_size} bytes")
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError("Invalid compressed signaling frame")
+    return inflated
+
+
+def to_binary(frame: str, compression_threshold: int) -> bytes:
+    body = frame.encode()
+    if len(body) >= compression_threshold:
+        return bytes([COMPRESSED]) + zlib.compress(body)
+    return bytes([UNCOMPRESSED]) + body
@@ -0,0 +1,93 @@
+"""
+Bounded outbound queues for signaling websockets.
+
+Each connected party gets its own Outbox with a writer task, so that a slow
+or stalled websocket only delays the messages addressed to that party,
+and never the receive loops of the other parties of the study.
+"""
+
+import asyncio
+from enum import Enum
+from typing import Awaitable, Callable, Optional
+
+from src.utils import custom_logging
+
+logger = custom_logging.setup_logging(__name__)
+
+
+class OverflowPolicy(Enum):
+    # discard the oldest queued message to make room for the new one
+    DROP_OLDEST = "drop-oldest"
+    # wait for room in the queue, and drop the new message on timeout
+    BLOCK = "block"
+    # drop the new message and disconnect the slow party
+    DISCONNECT = "disconnect"
+
+
+class Outbox:
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        maxsize: int,
+        policy: OverflowPolicy,
+        block_timeout: float,
+    ) -> None:
+        self.send = send
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self._writer: Optional[asyncio.Task] = None
+        self._owner: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def start(self) -> None:
+        # the task of the connection that owns this outbox is cancelled under the DISCONNECT policy
+        self._owner = asyncio.current_task()
+        self._writer = asyncio.create_task(self._write())
+
+    async def close(self) -> None:
+        self.closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+
+    async def put(self, msg: str) -> None:
+        if self.closed:
+            self.dropped += 1
+            return
+
+        if not self.queue.full():
+            self.queue.put_nowait(msg)
+        elif self.policy == OverflowPolicy.DROP_OLDEST:
+            self.queue.get_nowait()
+            self.dropped += 1
+            self.queue.put_nowait(msg)
+        elif self.policy == OverflowPolicy.BLOCK:
+            try:
+                await asyncio.wait_for(self.queue.put(msg), timeout=self.block_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                logger.warning("Dropped message after waiting %.1fs for a full outbox", self.block_timeout)
+        else:
+            self.dropped += 1
+            logger.warning("Disconnecting party with a full outbox")
+            await self.close()
+            if self._owner is not None:
+                self._owner.cancel()
+
+    async def _write(self) -> None:
+        while True:
+            msg = await self.queue.get()
+            try:
+                await self.send(msg)
+                self.sent += 1
+            except Exception as e:
+                logger.error("Failed to send message, closing outbox: %s", e)
+                self.dropped += 1 + self.queue.qsize()
+                self.closed = True
+                return
@@ -0,0 +1,533 @@
+"""
+Relay backends for the /api/ice signaling websocket.
+
+A relay routes messages between the parties of a study and implements
+the "all parties connected" rendezvous. The local relay keeps everything
+in the memory of the current process, so all parties of a study must be
+connected to the same worker. The broker relay goes through pub/sub
+channels keyed by study and PID, so parties can be spread across workers.
+"""
+
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from enum import Enum
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+import redis.asyncio as aioredis
+
+from src.utils import constants, custom_logging
+from src.utils.signaling.session import PID, AwayParty, Deliver, StudySession
+
+logger = custom_logging.setup_logging(__name__)
+
+Listener = Callable[[str], Awaitable[None]]
+
+
+class Registration(Enum):
+    # the party is already connected
+    CONFLICT = "conflict"
+    NEW = "new"
+    # the party reconnected within the resumption window,
+    # and the messages addressed to it in the meantime have been replayed
+    RESUMED = "resumed"
+
+
+class Relay(ABC):
+    def __init__(self, resume_ttl: float, resume_buffer_size: int) -> None:
+        self.resume_ttl = resume_ttl
+        self.resume_buffer_size = resume_buffer_size
+
+    @abstractmethod
+    async def register(self, study_id: str, pid: PID, deliver: Deliver) -> Registration:
+        """
+        Registers a party of a study, so that messages targeting it are passed to `deliver`.
+        A registration that fails or is cancelled (e.g. when its client disconnects) is undone.
+        """
+
+    @abstractmethod
+    async def unregister(self, study_id: str, pid: PID, resumable: bool = False) -> None:
+        """
+        Unregisters a party of a study. If `resumable`, messages addressed to the party
+        are buffered until it reconnects, for up to `resume_ttl` seconds.
+        """
+
+    @abstractmethod
+    async def send(self, study_id: str, target_pid: PID, frame: str) -> bool:
+        """
+        Routes an encoded message to a party of a study.
+
+        :return: False if the target party is neither connected nor resumable.
+        """
+
+    @abstractmethod
+    async def wait_for_parties(self, study_id: str, num_parties: int, timeout: Optional[float] = None) -> None:
+        """
+        Waits until `num_parties` parties of a study are connected.
+
+        :raises asyncio.TimeoutError: if they are not connected within `timeout` seconds.
+        """
+
+    @abstractmethod
+    def waiting(self, study_id: str) -> int:
+        """:return: the number of connections of this process waiting for the other parties of a study."""
+
+    @abstractmethod
+    async def parties(self, study_id: str) -> Set[PID]:
+        ...
+
+    @abstractmethod
+    async def reset(self, study_id: str) -> None:
+        ...
+
+
+class LocalRelay(Relay):
+    def __init__(self, resume_ttl: float, resume_buffer_size: int) -> None:
+        super().__init__(resume_ttl, resume_buffer_size)
+        self.sessions: Dict[str, StudySession] = {}
+
+    async def register(self, study_id: str, pid: PID, deliver: Deliver) -> Registration:
+        session = self.sessions.setdefault(study_id, StudySession())
+        if pid in session.parties:
+            return Registration.CONFLICT
+        await session.join(pid, deliver)
+
+        away = session.away_party(pid)
+        if away is None:
+            return Registration.NEW
+        try:
+            while away.buffer:
+                await deliver(away.buffer[0])
+                away.buffer.popleft()
+        except BaseException:
+            # the party stays away, with the messages that were not replayed
+            await session.leave(pid)
+            raise
+        del session.away_parties[pid]
+        return Registration.RESUMED
+
+    async def unregister(self, study_id: str, pid: PID, resumable: bool = False) -> None:
+        session = self.sessions.get(study_id)
+        if session is None:
+            return
+        await session.leave(pid)
+        if resumable and self.resume_ttl > 0:
+            session.away_parties[pid] = AwayParty(
+                time.monotonic() + self.resume_ttl, deque(maxlen=self.resume_buffer_size)
+            )
+            # drop the session once its away parties expire, if nobody comes back
+            asyncio.get_running_loop().call_later(self.resume_ttl, self._discard_if_empty, study_id, session)
+        self._discard_if_empty(study_id, session)
+
+    async def send(self, study_id: str, target_pid: PID, frame: str) -> bool:
+        session = self.sessions.get(study_id)
+        if session is None:
+            return False
+        deliver = session.parties.get(target_pid)
+        if deliver is not None:
+            await deliver(frame)
+            return True
+        away = session.away_party(target_pid)
+        if away is not None:
+            away.buffer.append(frame)
+            return True
+        return False
+
+    async def wait_for_parties(self, study_id: str, num_parties: int, timeout: Optional[float] = None) -> None:
+        session = self.sessions.setdefault(study_id, StudySession())
+        try:
+            await session.wait(num_parties, timeout)
+        finally:
+            self._discard_if_empty(study_id, session)
+
+    def waiting(self, study_id: str) -> int:
+        session = self.sessions.get(study_id)
+        return session.waiting if session else 0
+
+    async def parties(self, study_id: str) -> Set[PID]:
+        session = self.sessions.get(study_id)
+        return set(session.parties) if session else set()
+
+    async def reset(self, study_id: str) -> None:
+        self.sessions.pop(study_id, None)
+
+    def _discard_if_empty(self, study_id: str, session: StudySession) -> None:
+        if self.sessions.get(study_id) is session and session.is_empty():
+            del self.sessions[study_id]
+
+
+class Broker(ABC):
+    """
+    Minimal pub/sub and presence primitives needed by the BrokerRelay.
+    """
+
+    @abstractmethod
+    async def publish(self, channel: str, data: str) -> int:
+        """:return: the number of subscribers that received the data."""
+
+    @abstractmethod
+    async def subscribe(self, channel: str, listener: Listener) -> None:
+        ...
+
+    @abstractmethod
+    async def unsubscribe(self, channel: str) -> None:
+        ...
+
+    @abstractmethod
+    async def claim(self, key: str, member: str, ttl: float) -> bool:
+        """
+        Adds a member to a presence set for `ttl` seconds.
+
+        :return: False if the member is already present.
+        """
+
+    @abstractmethod
+    async def refresh(self, key: str, member: str, ttl: float) -> None:
+        ...
+
+    @abstractmethod
+    async def release(self, key: str, member: str) -> None:
+        ...
+
+    @abstractmethod
+    async def members(self, key: str) -> Set[str]:
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    async def push(self, key: str, data: str, maxlen: int, ttl: float) -> None:
+        """Appends data to a list, keeping at most its `maxlen` latest items for `ttl` seconds."""
+
+    @abstractmethod
+    async def drain(self, key: str) -> List[str]:
+        """Removes and returns all items of a list."""
+
+
+class LoopbackBroker(Broker):
+    """
+    In-memory stand-in for a message broker, used for tests and local development.
+    """
+
+    def __init__(self) -> None:
+        self.listeners: Dict[str, Listener] = {}
+        self.presence: Dict[str, Dict[str, float]] = {}
+        self.lists: Dict[str, Deque[str]] = {}
+
+    async def publish(self, channel: str, data: str) -> int:
+        listener = self.listeners.get(channel)
+        if listener is None:
+            return 0
+        await listener(data)
+        return 1
+
+    async def subscribe(self, channel: str, listener: Listener) -> None:
+        self.listeners[channel] = listener
+
+    async def unsubscribe(self, channel: str) -> None:
+        self.listeners.pop(channel, None)
+
+    async def claim(self, key: str, member: str, ttl: float) -> bool:
+        members = self._live_members(key)
+        if member in members:
+            return False
+        members[member] = time.monotonic() + ttl
+        return True
+
+    async def refresh(self, key: str, member: str, ttl: float) -> None:
+        members = self._live_members(key)
+        if member in members:
+            members[member] = time.monotonic() + ttl
+
+    async def release(self, key: str, member: str) -> None:
+        self._live_members(key).pop(member, None)
+
+    async def members(self, key: str) -> Set[str]:
+        return set(self._live_members(key))
+
+    async def delete(self, key: str) -> None:
+        self.presence.pop(key, None)
+        self.lists.pop(key, None)
+
+    async def push(self, key: str, data: str, maxlen: int, ttl: float) -> None:
+        self.lists.setdefault(key, deque(maxlen=maxlen)).append(data)
+
+    async def drain(self, key: str) -> List[str]:
+        return list(self.lists.pop(key, ()))
+
+    def _live_members(self, key: str) -> Dict[str, float]:
+        now = time.monotonic()
+        members = self.presence.setdefault(key, {})
+        for member in [m for m, expiry in members.items() if expiry <= now]:
+            del members[member]
+        return members
+
+
+class RedisBroker(Broker):
+    """
+    Redis-backed broker. Presence sets are sorted sets scored by expiry time,
+    and all channels of a worker share a single pub/sub connection.
+    Its reader hands each message off to the listener of its channel without waiting for it,
+    so that a party slow to take its messages does not hold up the other channels.
+    """
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self._client: Optional[aioredis.Redis] = None
+        self._pubsub: Optional[aioredis.client.PubSub] = None
+        self._reader: Optional[asyncio.Task] = None
+        self.listeners: Dict[str, Listener] = {}
+        # the latest delivery to each channel, which the next one waits for to keep messages in order
+        self._deliveries: Dict[str, asyncio.Task] = {}
+
+    @property
+    def client(self) -> aioredis.Redis:
+        if self._client is None:
+            self._client = aioredis.from_url(self.url, decode_responses=True)
+        return self._client
+
+    async def publish(self, channel: str, data: str) -> int:
+        return await self.client.publish(channel, data)
+
+    async def subscribe(self, channel: str, listener: Listener) -> None:
+        if self._pubsub is None:
+            self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.listeners[channel] = listener
+        await self._pubsub.subscribe(channel)
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read())
+
+    async def unsubscribe(self, channel: str) -> None:
+        self.listeners.pop(channel, None)
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(channel)
+
+    async def claim(self, key: str, member: str, ttl: float) -> bool:
+        now = time.time()
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, "-inf", now)
+            pipe.zadd(key, {member: now + ttl}, nx=True)
+            pipe.expire(key, int(ttl) + 1)
+            _, added, _ = await pipe.execute()
+        return bool(added)
+
+    async def refresh(self, key: str, member: str, ttl: float) -> None:
+        await self.client.zadd(key, {member: time.time() + ttl}, xx=True)
+        await self.client.expire(key, int(ttl) + 1)
+
+    async def release(self, key: str, member: str) -> None:
+        await self.client.zrem(key, member)
+
+    async def members(self, key: str) -> Set[str]:
+        return set(await self.client.zrangebyscore(key, time.time(), "+inf"))
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(key)
+
+    async def push(self, key: str, data: str, maxlen: int, ttl: float) -> None:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, data)
+            pipe.ltrim(key, -maxlen, -1)
+            pipe.expire(key, int(ttl) + 1)
+            await pipe.execute()
+
+    async def drain(self, key: str) -> List[str]:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            items, _ = await pipe.execute()
+        return items
+
+    async def _read(self) -> None:
+        assert self._pubsub is not None
+        while self.listeners:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+            except Exception:
+                logger.exception("Failed to read from the signaling broker:")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            channel = message["channel"]
+            listener = self.listeners.get(channel)
+            if listener is not None:
+                delivery = asyncio.create_task(
+                    self._deliver(channel, listener, message["data"], self._deliveries.get(channel))
+                )
+                self._deliveries[channel] = delivery
+                delivery.add_done_callback(lambda task, channel=channel: self._delivered(channel, task))
+
+    @staticmethod
+    async def _deliver(channel: str, listener: Listener, data: str, previous: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await listener(data)
+        except Exception:
+            logger.exception("Failed to handle message on channel %s:", channel)
+
+    def _delivered(self, channel: str, delivery: asyncio.Task) -> None:
+        if self._deliveries.get(channel) is delivery:
+            del self._deliveries[channel]
+
+
+class BrokerRelay(Relay):
+    """
+    Routes messages through a Broker, so that the parties of a study
+    can be connected to different workers or instances.
+    """
+
+    # how long a party stays present if its worker dies without unregistering it
+    PRESENCE_TTL = 60.0
+
+    def __init__(self, broker: Broker, resume_ttl: float, resume_buffer_size: int) -> None:
+        super().__init__(resume_ttl, resume_buffer_size)
+        self.broker = broker
+        self.keepalives: Dict[str, asyncio.Task] = {}
+        # presence events of each study, for the connections of this worker waiting on it
+        self.waiters: Dict[str, Set[asyncio.Event]] = {}
+        # latest number of participants of each study with waiting connections
+        self.num_parties: Dict[str, int] = {}
+
+    @staticmethod
+    def _party_channel(study_id: str, pid: PID) -> str:
+        return f"sfkit:ice:{study_id}:party:{pid}"
+
+    @staticmethod
+    def _presence_channel(study_id: str) -> str:
+        return f"sfkit:ice:{study_id}:presence"
+
+    @staticmethod
+    def _parties_key(study_id: str) -> str:
+        return f"sfkit:ice:{study_id}:parties"
+
+    @staticmethod
+    def _away_parties_key(study_id: str) -> str:
+        return f"sfkit:ice:{study_id}:away"
+
+    @staticmethod
+    def _buffer_key(study_id: str, pid: PID) -> str:
+        return f"sfkit:ice:{study_id}:buffer:{pid}"
+
+    async def register(self, study_id: str, pid: PID, deliver: Deliver) -> Registration:
+        key = self._parties_key(study_id)
+        if not await self.broker.claim(key, str(pid), self.PRESENCE_TTL):
+            return Registration.CONFLICT
+
+        resuming = False
+        try:
+            channel = self._party_channel(study_id, pid)
+            self.keepalives[channel] = asyncio.create_task(self._keepalive(key, str(pid)))
+            await self.broker.subscribe(channel, deliver)
+            await self.broker.publish(self._presence_channel(study_id), str(pid))
+
+            away_key = self._away_parties_key(study_id)
+            if str(pid) not in await self.broker.members(away_key):
+                return Registration.NEW
+            # subscribe before draining, so that no message is lost in between
+            resuming = True
+            await self.broker.release(away_key, str(pid))
+            for frame in await self.broker.drain(self._buffer_key(study_id, pid)):
+                await deliver(frame)
+            return Registration.RESUMED
+        except BaseException:
+            # the party can still resume later, although the messages drained so far are lost
+            await self.unregister(study_id, pid, resumable=resuming)
+            raise
+
+    async def unregister(self, study_id: str, pid: PID, resumable: bool = False) -> None:
+        channel = self._party_channel(study_id, pid)
+        if keepalive := self.keepalives.pop(channel, None):
+            keepalive.cancel()
+        await self.broker.unsubscribe(channel)
+        if resumable and self.resume_ttl > 0:
+            await self.broker.claim(self._away_parties_key(study_id), str(pid), self.resume_ttl)
+        await self.broker.release(self._parties_key(study_id), str(pid))
+
+    async def send(self, study_id: str, target_pid: PID, frame: str) -> bool:
+        receivers = await self.broker.publish(self._party_channel(study_id, target_pid), frame)
+        if receivers > 0:
+            return True
+        if str(target_pid) in await self.broker.members(self._away_parties_key(study_id)):
+            await self.broker.push(
+                self._buffer_key(study_id, target_pid), frame, self.resume_buffer_size, self.resume_ttl
+            )
+            return True
+        return False
+
+    async def wait_for_parties(self, study_id: str, num_parties: int, timeout: Optional[float] = None) -> None:
+        arrived = asyncio.Event()
+        waiters = self.waiters.setdefault(study_id, set())
+        if not waiters:
+            await self.broker.subscribe(self._presence_channel(study_id), self._presence_listener(study_id))
+        waiters.add(arrived)
+        # let the waiters of other workers know about the latest number of participants
+        self.num_parties[study_id] = num_parties
+        await self.broker.publish(self._presence_channel(study_id), f"n={num_parties}")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while len(await self.parties(study_id)) < self.num_parties.get(study_id, num_parties):
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise asyncio.TimeoutError()
+                arrived.clear()
+                try:
+                    # re-check periodically, in case a presence notification was missed
+                    await asyncio.wait_for(arrived.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            waiters.discard(arrived)
+            if not waiters:
+                del self.waiters[study_id]
+                self.num_parties.pop(study_id, None)
+                await self.broker.unsubscribe(self._presence_channel(study_id))
+
+    def waiting(self, study_id: str) -> int:
+        return len(self.waiters.get(study_id, ()))
+
+    def _presence_listener(self, study_id: str) -> Listener:
+        async def listener(data: str) -> None:
+            # either a PID that has just connected, or the number of participants
+            if data.startswith("n="):
+                self.num_parties[study_id] = int(data[2:])
+            for arrived in self.waiters.get(study_id, ()):
+                arrived.set()
+
+        return listener
+
+    async def parties(self, study_id: str) -> Set[PID]:
+        return {int(pid) for pid in await self.broker.members(self._parties_key(study_id))}
+
+    async def reset(self, study_id: str) -> None:
+        away_key = self._away_parties_key(study_id)
+        for pid in await self.broker.members(away_key):
+            await self.broker.delete(self._buffer_key(study_id, int(pid)))
+        await self.broker.delete(away_key)
+        await self.broker.delete(self._parties_key(study_id))
+
+    async def _keepalive(self, key: str, member: str) -> None:
+        while True:
+            await asyncio.sleep(self.PRESENCE_TTL / 3)
+            try:
+                await self.broker.refresh(key, member, self.PRESENCE_TTL)
+            except Exception:
+                logger.exception("Failed to refresh presence of party %s in %s:", member, key)
+
+
+def create_relay() -> Relay:
+    # buffered messages are replayed into the outbox of the party before its writer can send any of them,
+    # so a larger buffer would overflow the outbox and lose (or disconnect) them
+    resume_buffer_size = min(constants.SIGNALING_RESUME_BUFFER_SIZE, constants.SIGNALING_QUEUE_SIZE)
+    if resume_buffer_size < constants.SIGNALING_RESUME_BUFFER_SIZE:
+        logger.warning("Limiting SIGNALING_RESUME_BUFFER_SIZE to SIGNALING_QUEUE_SIZE (%d)", resume_buffer_size)
+    resume = constants.SIGNALING_RESUME_TTL, resume_buffer_size
+    if constants.SIGNALING_RELAY == "redis":
+        logger.info("Using Redis signaling relay at %s", constants.SIGNALING_REDIS_URL)
+        return BrokerRelay(RedisBroker(constants.SIGNALING_REDIS_URL), *resume)
+    elif constants.SIGNALING_RELAY == "loopback":
+        return BrokerRelay(LoopbackBroker(), *resume)
+    return LocalRelay(*resume)
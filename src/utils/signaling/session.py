@@ -0,0 +1,77 @@
+"""
+In-process state of the signaling session of one study.
+"""
+
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+PID = int
+Deliver = Callable[[str], Awaitable[None]]
+
+
+@dataclass
+class AwayParty:
+    deadline: float
+    buffer: Deque[str] = field(default_factory=deque)
+
+
+class StudySession:
+    """
+    Tracks which parties of a study are connected, away (disconnected but resumable)
+    or waiting for the others, and implements the "all parties connected" rendezvous.
+
+    Unlike a fixed-size barrier, the number of expected parties follows the latest
+    participant list, parties can leave before the session starts, and waits can time out.
+    """
+
+    def __init__(self) -> None:
+        self.parties: Dict[PID, Deliver] = {}
+        self.away_parties: Dict[PID, AwayParty] = {}
+        self.num_parties = 0
+        self.waiting = 0
+        self.started = False
+        self._changed = asyncio.Condition()
+
+    def is_empty(self) -> bool:
+        self.expire_away_parties()
+        return not self.parties and not self.away_parties and not self.waiting
+
+    async def join(self, pid: PID, deliver: Deliver) -> None:
+        self.parties[pid] = deliver
+        await self._notify()
+
+    async def leave(self, pid: PID) -> None:
+        self.parties.pop(pid, None)
+        await self._notify()
+
+    async def wait(self, num_parties: int, timeout: Optional[float] = None) -> None:
+        self.num_parties = num_parties
+        self.waiting += 1
+        try:
+            async with self._changed:
+                self._changed.notify_all()
+                await asyncio.wait_for(self._changed.wait_for(self._is_ready), timeout)
+                self.started = True
+        finally:
+            self.waiting -= 1
+
+    def away_party(self, pid: PID) -> Optional[AwayParty]:
+        away = self.away_parties.get(pid)
+        if away is not None and away.deadline <= time.monotonic():
+            del self.away_parties[pid]
+            return None
+        return away
+
+    def expire_away_parties(self) -> None:
+        for pid in list(self.away_parties):
+            self.away_party(pid)
+
+    def _is_ready(self) -> bool:
+        return self.started or len(self.parties) >= self.num_parties
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
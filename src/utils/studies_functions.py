@@ -16,12 +16,13 @@ from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Email, Mail
 from werkzeug.exceptions import BadRequest
 
-from src.api_utils import APIException, fetch_study
-from src.auth import get_service_account_headers
+from src.api_utils import APIException, fetch_study, flush_unit_of_work, get_study_dict, unit_of_work
+from src.auth import get_service_account_headers, set_auth_key
 from src.utils import constants, custom_logging
 from src.utils.generic_functions import is_create_vm
 from src.utils.google_cloud.google_cloud_compute import GoogleCloudCompute, format_instance_name
 from src.utils.google_cloud.google_cloud_iam import GoogleCloudIAM
+from src.utils.study_mutation import StudyMutation
 
 logger = custom_logging.setup_logging(__name__)
 
@@ -86,37 +87,25 @@ async def make_auth_key(study_id: str, user_id: str) -> str:
     _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id)
 
     auth_key = secrets.token_hex(16)
-    doc_ref_dict["personal_parameters"][user_id]["AUTH_KEY"]["value"] = auth_key
-    await doc_ref.set(doc_ref_dict)
+    await StudyMutation().set("personal_parameters", user_id, "AUTH_KEY", "value", value=auth_key).commit(doc_ref)
 
-    await current_app.config["DATABASE"].collection("users").document("auth_keys").set(
-        {
-            auth_key: {
-                "study_id": study_id,
-                "title": doc_ref_dict["title"],
-                "username": user_id,
-            }
-        },
-        merge=True,
-    )
+    await set_auth_key(auth_key, study_id, doc_ref_dict["title"], user_id)
 
     return auth_key
 
 
 async def setup_gcp(doc_ref: AsyncDocumentReference, role: str) -> None:
-    await generate_ports(doc_ref, role)
+    # a single read of the study, and a single write of its ports and first task
+    async with unit_of_work():
+        await generate_ports(doc_ref, role)
 
-    doc_ref_dict = (await doc_ref.get()).to_dict() or {}
-    study_id = doc_ref_dict["study_id"]
-    user: str = doc_ref_dict["participants"][int(role)]
-    user_parameters: dict = doc_ref_dict["personal_parameters"][user]
+        doc_ref_dict = await get_study_dict(doc_ref)
+        study_id = doc_ref_dict["study_id"]
+        user: str = doc_ref_dict["participants"][int(role)]
+        user_parameters: dict = doc_ref_dict["personal_parameters"][user]
 
-    if "tasks" not in doc_ref_dict:
-        doc_ref_dict["tasks"] = {}
-    if user not in doc_ref_dict["tasks"]:
-        doc_ref_dict["tasks"][user] = []
-    doc_ref_dict["tasks"][user].append("Setting up networking and creating VM instance")
-    await doc_ref.set(doc_ref_dict)
+        task = "Setting up networking and creating VM instance"
+        await StudyMutation().array_union("tasks", user, values=[task]).commit(doc_ref)
 
     gcloudCompute = GoogleCloudCompute(study_id, user_parameters["GCP_PROJECT"]["value"])
 
@@ -148,15 +137,11 @@ async def setup_gcp(doc_ref: AsyncDocumentReference, role: str) -> None:
         )
     except:
         logger.exception("An error occurred during GCP setup:")
-        doc_ref_dict["status"][
-            user
-        ] = "FAILED - sfkit failed to set up your networking and VM instance. Please restart the study and double-check your parameters and configuration. If the problem persists, please contact us."
-        await doc_ref.set(doc_ref_dict)
+        status = "FAILED - sfkit failed to set up your networking and VM instance. Please restart the study and double-check your parameters and configuration. If the problem persists, please contact us."
+        await StudyMutation().set("status", user, value=status).commit(doc_ref)
         return
     else:
-        doc_ref_dict = (await doc_ref.get()).to_dict() or {}
-        doc_ref_dict["tasks"][user].append("Configuring your VM instance")
-        await doc_ref.set(doc_ref_dict)
+        await StudyMutation().array_union("tasks", user, values=["Configuring your VM instance"]).commit(doc_ref)
         return
 
 
@@ -202,15 +187,14 @@ async def submit_terra_workflow(study_id: str, _role: str) -> None:
 
 
 async def generate_ports(doc_ref: AsyncDocumentReference, role: str) -> None:
-    doc_ref_dict = (await doc_ref.get()).to_dict() or {}
+    doc_ref_dict = await get_study_dict(doc_ref)
     user: str = doc_ref_dict["participants"][int(role)]
 
     base: int = 8000 + 200 * int(role)
     ports = [base + 20 * r for r in range(len(doc_ref_dict["participants"]))]
     ports_str = ",".join([str(p) for p in ports])
 
-    doc_ref_dict["personal_parameters"][user]["PORTS"]["value"] = ports_str
-    await doc_ref.set(doc_ref_dict, merge=True)
+    await StudyMutation().set("personal_parameters", user, "PORTS", "value", value=ports_str).commit(doc_ref)
 
 
 def sanitize_path(path: str) -> str:
@@ -285,9 +269,11 @@ async def update_status_and_start_setup(doc_ref, doc_ref_dict, study_id):
     for role in range(1, len(participants)):
         user = participants[role]
         statuses[user] = "setting up your vm instance"
-        await doc_ref.set({"status": statuses}, merge=True)
+        await StudyMutation().set("status", user, value=statuses[user]).commit(doc_ref)
 
         if is_create_vm(doc_ref_dict, user):
+            # setup_gcp reads the study from Firestore, in the background
+            await flush_unit_of_work()
             asyncio.create_task(setup_gcp(doc_ref, str(role)))
 
         time.sleep(1)
@@ -0,0 +1,223 @@
+"""
+Streams of the changes to the status, tasks and parameters of studies, served by /study_events,
+so that clients learn about them without polling the whole study document.
+
+Each study streamed by this process has one StudyWatcher, shared by all of its subscribers, which reads the study
+every STUDY_EVENTS_POLL_INTERVAL seconds and whenever this process writes it, and sends what changed to each of them.
+The async Firestore client has no snapshot listeners, and these reads are shared with the other reads of the study.
+"""
+
+import asyncio
+import json
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+from google.cloud.firestore import AsyncDocumentReference
+
+from src.api_utils import get_study, study_write_listeners
+from src.utils import constants, custom_logging, metrics
+
+logger = custom_logging.setup_logging(__name__)
+
+STREAMED_FIELDS = ("status", "tasks", "parameters", "personal_parameters")
+# how many events can wait to be sent to a subscriber; one that falls further behind is disconnected,
+# and gets the events it missed when it resumes its stream
+SUBSCRIBER_QUEUE_SIZE = 100
+# keeps idle connections (and the proxies in between) open, and detects clients that went away
+HEARTBEAT = ": heartbeat\n\n"
+
+
+@dataclass(frozen=True)
+class Event:
+    type: str  # "snapshot", "change" or "deleted"
+    version: str = ""
+    data: Any = None
+
+    def encode(self) -> str:
+        """Encodes the event in the text/event-stream format, with its version as its ID."""
+        lines = [f"event: {self.type}"]
+        if self.version:
+            lines.append(f"id: {self.version}")
+        lines.append(f"data: {json.dumps(self.data, separators=(',', ':'), default=str)}")
+        return "\n".join(lines) + "\n\n"
+
+
+def diff(old: Any, new: Any, path: Tuple[str, ...] = ()) -> List[dict]:
+    """The changes from `old` to `new`: the paths of the fields that are set, with their new values, or deleted."""
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        return [] if old == new else [{"path": list(path), "value": new}]
+    changes = []
+    for key, value in new.items():
+        if key in old:
+            changes += diff(old[key], value, (*path, key))
+        else:
+            changes.append({"path": [*path, key], "value": value})
+    changes += [{"path": [*path, key], "deleted": True} for key in old if key not in new]
+    return changes
+
+
+class Subscriber:
+    def __init__(self, user_id: str) -> None:
+        self.user_id = user_id
+        # None ends the stream
+        self.queue: asyncio.Queue[Optional[Event]] = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+
+    def send(self, event: Event) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.warning(f"Disconnecting {self.user_id} from the events of a study, as it fell behind")
+            self.close()
+
+    def close(self, last_event: Optional[Event] = None) -> None:
+        # the events that were not sent are sent again when the client resumes its stream
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        if last_event:
+            self.queue.put_nowait(last_event)
+        self.queue.put_nowait(None)
+
+
+class StudyWatcher:
+    """
+    Follows the changes to a study while it has subscribers. It keeps the versions of the study that it saw last,
+    with their changes, for the subscribers that resume, until STUDY_EVENTS_RESUME_TTL seconds after the last one left.
+    """
+
+    def __init__(self, doc_ref: AsyncDocumentReference) -> None:
+        self.doc_ref = doc_ref
+        self.subscribers: Set[Subscriber] = set()
+        self.version: Optional[str] = None
+        self.fields: Dict[str, Any] = {}
+        self.participants: List[str] = []
+        self.history: Deque[Tuple[str, List[dict]]] = deque(maxlen=constants.STUDY_EVENTS_HISTORY_SIZE)
+        self._wake = asyncio.Event()
+        self._subscribed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, user_id: str, doc_ref_dict: dict, version: Optional[str], last_version: str) -> Subscriber:
+        """
+        Subscribes a user to the changes of the study, given the study as the user was authorized to read it.
+        The subscriber first gets the changes since `last_version`, or the streamed fields if those are not known.
+        """
+        if self.version is None:
+            self._update(doc_ref_dict, version)
+        elif not self.subscribers:
+            # the study may have changed while no one was subscribed
+            self.wake()
+        subscriber = Subscriber(user_id)
+        self.subscribers.add(subscriber)
+        self._subscribed.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+        versions = [seen for seen, _ in self.history]
+        if last_version in versions:
+            for seen, changes in list(self.history)[versions.index(last_version) + 1 :]:
+                if changes:
+                    subscriber.send(Event("change", seen, {"version": seen, "changes": changes}))
+        elif self.version:
+            subscriber.send(Event("snapshot", self.version, {"version": self.version, "study": self.fields}))
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self.subscribers.discard(subscriber)
+        if not self.subscribers:
+            self._subscribed.clear()
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    async def _run(self) -> None:
+        while True:
+            if not self.subscribers:
+                try:
+                    await asyncio.wait_for(self._subscribed.wait(), constants.STUDY_EVENTS_RESUME_TTL)
+                except asyncio.TimeoutError:
+                    if not self.subscribers:
+                        break
+            try:
+                await asyncio.wait_for(self._wake.wait(), constants.STUDY_EVENTS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if not self.subscribers:
+                continue
+
+            try:
+                doc_ref_dict, version = await get_study(self.doc_ref)
+            except Exception:
+                logger.exception(f"Failed to read study {self.doc_ref.id} for its event streams:")
+                continue
+            if not doc_ref_dict:
+                for subscriber in self.subscribers:
+                    subscriber.close(Event("deleted"))
+                self.subscribers.clear()
+                break
+            self._update(doc_ref_dict, version)
+            if not self.subscribers:
+                self._subscribed.clear()
+
+        if watchers.get(self.doc_ref.id) is self:
+            del watchers[self.doc_ref.id]
+
+    def _update(self, doc_ref_dict: dict, version: Optional[str]) -> None:
+        if version is None or version == self.version:
+            return
+        fields = {field: doc_ref_dict[field] for field in STREAMED_FIELDS if field in doc_ref_dict}
+        changes = diff(self.fields, fields) if self.version else []
+        self.version, self.fields, self.participants = version, fields, doc_ref_dict.get("participants", [])
+        self.history.append((version, changes))
+
+        for subscriber in list(self.subscribers):
+            if subscriber.user_id not in self.participants:
+                self.subscribers.discard(subscriber)
+                subscriber.close()
+            elif changes:
+                subscriber.send(Event("change", version, {"version": version, "changes": changes}))
+
+
+# by study ID
+watchers: Dict[str, StudyWatcher] = {}
+
+
+def _wake_watcher(study_id: str) -> None:
+    if watcher := watchers.get(study_id):
+        watcher.wake()
+
+
+study_write_listeners.append(_wake_watcher)
+
+
+async def stream(
+    doc_ref: AsyncDocumentReference, user_id: str, doc_ref_dict: dict, version: Optional[str], last_version: str = ""
+) -> AsyncIterator[str]:
+    """
+    Streams the changes to a study to a participant, as server-sent events, with heartbeats in between.
+    The stream ends when the study is deleted or the user is no longer one of its participants.
+    """
+    if doc_ref.id not in watchers:
+        watchers[doc_ref.id] = StudyWatcher(doc_ref)
+    watcher = watchers[doc_ref.id]
+    subscriber = watcher.subscribe(user_id, doc_ref_dict, version, last_version)
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), constants.STUDY_EVENTS_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                yield HEARTBEAT
+                continue
+            if event is None:
+                break
+            yield event.encode()
+    finally:
+        watcher.unsubscribe(subscriber)
+
+
+metrics.Gauge("sfkit_study_events_studies", "Studies whose changes this process streams", lambda: len(watchers))
+metrics.Gauge(
+    "sfkit_study_events_subscribers",
+    "Clients this process streams the changes of studies to",
+    lambda: sum(len(watcher.subscribers) for watcher in watchers.values()),
+)
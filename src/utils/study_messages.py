@@ -0,0 +1,119 @@
+"""
+Study messages, stored one per document in the `messages` subcollection of their study,
+so that the study document does not grow with the chat history.
+"""
+
+import hashlib
+import json
+from collections import Counter
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+from google.cloud import firestore
+from google.cloud.firestore import AsyncDocumentReference
+from google.cloud.firestore_v1.field_path import FieldPath
+from quart import current_app
+
+from src.api_utils import decode_page_token, encode_page_token, invalidate_study
+from src.utils import custom_logging
+from src.utils.generic_functions import MAX_BATCH_WRITES, BatchWriter
+
+logger = custom_logging.setup_logging(__name__)
+
+MESSAGES_COLLECTION = "messages"
+MESSAGES_PAGE_SIZE = 50
+TIME_FORMAT = "%m/%d/%Y %H:%M"
+
+
+def _to_message(doc) -> dict:
+    message = doc.to_dict() or {}
+    return {"sender": message.get("sender", ""), "time": message.get("time", ""), "body": message.get("body", "")}
+
+
+async def add_message(doc_ref: AsyncDocumentReference, sender: str, body: str) -> dict:
+    created = datetime.now(timezone.utc)
+    message = {"sender": sender, "time": created.strftime(TIME_FORMAT), "body": body}
+    await doc_ref.collection(MESSAGES_COLLECTION).add(message | {"created": created})
+    return message
+
+
+async def get_messages(doc_ref: AsyncDocumentReference, page_size: int, page_token: str = "") -> Tuple[List[dict], str]:
+    """
+    Fetches a page of the messages of a study, newest first.
+
+    :param page_token: the continuation token of the previous page, if any.
+    :return: the messages, and the continuation token of the next (older) page ("" for the last page).
+    """
+    query = (
+        doc_ref.collection(MESSAGES_COLLECTION)
+        .order_by("created", direction=firestore.Query.DESCENDING)
+        .order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+    )
+    if page_token:
+        created, message_id = decode_page_token(page_token)
+        query = query.start_after({"created": created, FieldPath.document_id(): message_id})
+
+    docs = [doc async for doc in query.limit(page_size + 1).stream()]
+    if len(docs) <= page_size:
+        return [_to_message(doc) for doc in docs], ""
+    docs = docs[:page_size]
+    return [_to_message(doc) for doc in docs], encode_page_token(docs[-1].get("created"), docs[-1].id)
+
+
+async def archive_messages(doc_ref: AsyncDocumentReference, archive_ref: AsyncDocumentReference) -> None:
+    """
+    Moves the messages of a study to the `messages` subcollection of its archived copy (e.g. in deleted_studies),
+    a batch at a time, as deleting a document does not delete its subcollections.
+    """
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    collection = doc_ref.collection(MESSAGES_COLLECTION)
+    archive = archive_ref.collection(MESSAGES_COLLECTION)
+    writer = BatchWriter(db)
+    while True:
+        # a batch worth of writes, as each message takes two
+        docs = [doc async for doc in collection.limit(MAX_BATCH_WRITES // 2).stream()]
+        if not docs:
+            return
+        for doc in docs:
+            await writer.set(archive.document(doc.id), doc.to_dict() or {})
+            await writer.delete(collection.document(doc.id))
+        await writer.commit()
+
+
+def _legacy_message_id(key: Tuple[str, str, str], occurrence: int) -> str:
+    """
+    The ID of a migrated message, from its content rather than its position in the array,
+    as instances of the previous version keep appending to the array after a migration (e.g. during a deploy).
+    """
+    return "legacy-" + hashlib.blake2b(json.dumps([*key, occurrence]).encode(), digest_size=16).hexdigest()
+
+
+async def migrate_messages(doc_ref: AsyncDocumentReference, doc_ref_dict: dict) -> None:
+    """
+    Moves the messages of a study that still stores them in its `messages` array into the subcollection.
+    Migrated messages get deterministic IDs, so that concurrent migrations do not duplicate them.
+    """
+    messages = doc_ref_dict.pop(MESSAGES_COLLECTION, None)
+    if messages is None:
+        return
+
+    logger.info(f"Migrating {len(messages)} messages of study {doc_ref.id}")
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    collection = doc_ref.collection(MESSAGES_COLLECTION)
+    # identical messages (e.g. sent twice in the same minute) are told apart by their order
+    occurrences: Counter = Counter()
+    writer = BatchWriter(db)
+    for message in messages:
+        try:
+            created = datetime.strptime(message.get("time", ""), TIME_FORMAT).replace(tzinfo=timezone.utc)
+        except ValueError:
+            created = datetime.fromtimestamp(0, timezone.utc)
+        key = (message.get("sender", ""), message.get("time", ""), message.get("body", ""))
+        message_id = _legacy_message_id(key, occurrences[key])
+        occurrences[key] += 1
+        await writer.set(collection.document(message_id), message | {"created": created})
+    # only the migrated messages, as others may have been appended since they were read
+    removal = firestore.ArrayRemove(messages) if messages else firestore.DELETE_FIELD
+    await writer.update(doc_ref, {MESSAGES_COLLECTION: removal})
+    await writer.commit()
+    invalidate_study(doc_ref.id)
@@ -0,0 +1,51 @@
+from typing import Any, Dict, List
+
+from google.cloud import firestore
+from google.cloud.firestore import AsyncDocumentReference, AsyncTransaction
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from src.api_utils import current_unit_of_work, invalidate_study
+
+
+class StudyMutation:
+    """
+    Field-level changes to a study document.
+
+    Only the changed fields are written, and arrays are changed with union/remove transforms,
+    so that concurrent changes to other fields (e.g. the status of another participant) do not conflict.
+    Path segments are quoted as needed, since user IDs and emails are used as map keys.
+    Within a unit of work (e.g. a request), commit() stages the changes, to be written with the others.
+    """
+
+    def __init__(self) -> None:
+        self.updates: Dict[str, Any] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.updates)
+
+    def set(self, *path: str, value: Any) -> "StudyMutation":
+        self.updates[FieldPath(*path).to_api_repr()] = value
+        return self
+
+    def delete(self, *path: str) -> "StudyMutation":
+        return self.set(*path, value=firestore.DELETE_FIELD)
+
+    def array_union(self, *path: str, values: List[Any]) -> "StudyMutation":
+        return self.set(*path, value=firestore.ArrayUnion(values))
+
+    def array_remove(self, *path: str, values: List[Any]) -> "StudyMutation":
+        return self.set(*path, value=firestore.ArrayRemove(values))
+
+    async def commit(self, doc_ref: AsyncDocumentReference) -> None:
+        if not self.updates:
+            return
+        if unit_of_work := current_unit_of_work():
+            await unit_of_work.stage(doc_ref, self.updates)
+        else:
+            await doc_ref.update(self.updates)
+            invalidate_study(doc_ref.id)
+
+    def commit_in(self, transaction: AsyncTransaction, doc_ref: AsyncDocumentReference) -> None:
+        """Adds the changes to a transaction, whose caller invalidates the cached study once it commits."""
+        if self.updates:
+            transaction.update(doc_ref, self.updates)
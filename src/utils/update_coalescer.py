@@ -0,0 +1,52 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, List, Set, Tuple, TypeVar
+
+from google.cloud.firestore import AsyncDocumentReference
+
+U = TypeVar("U")
+R = TypeVar("R")
+
+
+class UpdateCoalescer(Generic[U, R]):
+    """
+    Collects the updates to a document that arrive within `window` seconds of the first one,
+    and commits them together with `commit`, which returns the result of each update, in order.
+    Each caller gets the result of its own update, or the exception of the whole batch.
+    `commit` must handle the errors of single updates itself (see update_study), so that one bad update
+    does not fail the others; the batch then only fails on errors that all of its updates would get.
+    """
+
+    def __init__(
+        self, window: float, commit: Callable[[AsyncDocumentReference, List[U]], Awaitable[List[R]]]
+    ) -> None:
+        self.window = window
+        self.commit = commit
+        # updates waiting for the next commit, by document ID
+        self._pending: Dict[str, List[Tuple[U, asyncio.Future]]] = {}
+        # the event loop only keeps weak references to tasks
+        self._flushes: Set[asyncio.Task] = set()
+
+    async def submit(self, doc_ref: AsyncDocumentReference, update: U) -> R:
+        future = asyncio.get_running_loop().create_future()
+        if doc_ref.id not in self._pending:
+            self._pending[doc_ref.id] = []
+            flush = asyncio.create_task(self._flush(doc_ref))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+        self._pending[doc_ref.id].append((update, future))
+        # a caller that goes away does not cancel the updates of the others
+        return await asyncio.shield(future)
+
+    async def _flush(self, doc_ref: AsyncDocumentReference) -> None:
+        await asyncio.sleep(self.window)
+        pending = self._pending.pop(doc_ref.id)
+        try:
+            results = await self.commit(doc_ref, [update for update, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+                # retrieved here, in case its caller went away
+                future.exception()
+        else:
+            for (_, future), result in zip(pending, results):
+                future.set_result(result)
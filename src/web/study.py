@@ -6,16 +6,21 @@ from google.cloud import firestore
 from quart import Blueprint, Response, current_app, jsonify, request, send_file
 from werkzeug.exceptions import BadRequest, Conflict
 
-from src.api_utils import (ID_KEY, add_user_to_db, fetch_study, validate_json,
-                           validate_uuid)
-from src.auth import authenticate, authenticate_on_terra, get_cp0_id
+from src.api_utils import (ID_KEY, add_user_to_db, fetch_study, fetch_study_with_version,
+                           get_display_names, invalidate_display_name, invalidate_study,
+                           validate_json, validate_uuid)
+from src.auth import authenticate, authenticate_on_terra, delete_auth_key, get_cp0_id
 from src.signaling import reset_study_websockets
 from src.utils import constants, custom_logging
+from src.utils.etags import conditional_response, make_etag
 from src.utils.google_cloud.google_cloud_compute import (GoogleCloudCompute,
                                                          format_instance_name)
 from src.utils.schemas.create_study import create_study_schema
 from src.utils.schemas.parameters import parameters_schema
 from src.utils.schemas.study_information import study_information_schema
+from src.utils.study_events import stream as stream_study_events
+from src.utils.study_messages import MESSAGES_PAGE_SIZE, archive_messages, get_messages, migrate_messages
+from src.utils.study_mutation import StudyMutation
 from src.utils.studies_functions import (make_auth_key,
                                          study_title_already_exists)
 
@@ -27,23 +32,67 @@ bp = Blueprint("study", __name__, url_prefix="/api")
 @authenticate
 async def study(user_id) -> Response:
     study_id = validate_uuid(request.args.get("study_id"))
-    db, _, doc_ref_dict = await fetch_study(study_id, user_id)
+    _, doc_ref, doc_ref_dict, version = await fetch_study_with_version(study_id, user_id, cached=True)
+    await migrate_messages(doc_ref, doc_ref_dict)
 
     try:
-        display_names = (await db.collection("users").document("display_names").get()).to_dict() or {}
+        display_names = await get_display_names(
+            [doc_ref_dict["owner"]]
+            + doc_ref_dict["participants"]
+            + list(doc_ref_dict["requested_participants"].keys())
+            + doc_ref_dict["invited_participants"]
+        )
     except:
         logger.exception("Failed to fetch display names:")
         raise BadRequest()
 
-    doc_ref_dict["owner_name"] = display_names.get(doc_ref_dict["owner"], doc_ref_dict["owner"])
+    doc_ref_dict["owner_name"] = display_names[doc_ref_dict["owner"]]
     doc_ref_dict["display_names"] = {
-        participant: display_names.get(participant, participant)
+        participant: display_names[participant]
         for participant in doc_ref_dict["participants"]
         + list(doc_ref_dict["requested_participants"].keys())
         + doc_ref_dict["invited_participants"]
     }
 
-    return jsonify({"study": doc_ref_dict})
+    # the latest messages, oldest first, and the page token of the older ones (see /study_messages)
+    messages, doc_ref_dict["messages_page_token"] = await get_messages(doc_ref, MESSAGES_PAGE_SIZE)
+    doc_ref_dict["messages"] = messages[::-1]
+
+    # the response also shows the display names and messages, which are not part of the study document
+    etag = (
+        make_etag(
+            study_id,
+            version,
+            doc_ref_dict["display_names"],
+            doc_ref_dict["owner_name"],
+            doc_ref_dict["messages"],
+            doc_ref_dict["messages_page_token"],
+        )
+        if version
+        else None
+    )
+    return conditional_response(etag, lambda: jsonify({"study": doc_ref_dict}))
+
+
+@bp.route("/study_events", methods=["GET"])
+@authenticate
+async def study_events(user_id) -> Response:
+    """
+    Streams the changes to the status, tasks and parameters of a study as server-sent events (see study_events),
+    instead of clients polling the study. Clients resume their stream from the last version they got,
+    with the Last-Event-ID header or the `version` argument.
+    """
+    study_id = validate_uuid(request.args.get("study_id"))
+    _, doc_ref, doc_ref_dict, version = await fetch_study_with_version(study_id, user_id)
+    last_version = request.headers.get("Last-Event-ID") or request.args.get("version", "")
+
+    response = Response(
+        stream_study_events(doc_ref, user_id, doc_ref_dict, version, last_version), mimetype="text/event-stream"
+    )
+    # the stream lasts as long as the client stays connected
+    response.timeout = None
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
 
 # TODO: use asyncio to delete in parallel. This requires making the google_cloud_compute functions async. Using multiple processing failed because inside daemon. Threads failed because of GIL.
@@ -65,14 +114,16 @@ async def restart_study(user_id) -> Response:
                 google_cloud_compute.delete_firewall("")
         logger.info("Successfully Deleted gcp instances and firewalls")
 
+    mutation = StudyMutation()
     for participant in doc_ref_dict["participants"]:
-        doc_ref_dict["status"][participant] = "ready to begin protocol" if participant == get_cp0_id() else ""
-        doc_ref_dict["personal_parameters"][participant]["PUBLIC_KEY"]["value"] = ""
-        doc_ref_dict["personal_parameters"][participant]["IP_ADDRESS"]["value"] = ""
-    doc_ref_dict["tasks"] = {key: [] for key in doc_ref_dict["tasks"].keys()}
-    await doc_ref.set(doc_ref_dict)
+        mutation.set("status", participant, value="ready to begin protocol" if participant == get_cp0_id() else "")
+        mutation.set("personal_parameters", participant, "PUBLIC_KEY", "value", value="")
+        mutation.set("personal_parameters", participant, "IP_ADDRESS", "value", value="")
+    for key in doc_ref_dict["tasks"].keys():
+        mutation.set("tasks", key, value=[])
+    await mutation.commit(doc_ref)
 
-    reset_study_websockets(study_id)
+    await reset_study_websockets(study_id)
 
     return jsonify({"message": "Successfully restarted study"})
 
@@ -148,17 +199,19 @@ async def delete_study(user_id) -> Response:
 
     for participant in doc_ref_dict["personal_parameters"].values():
         if (auth_key := participant.get("AUTH_KEY").get("value")) != "":
-            doc_ref_auth_keys = db.collection("users").document("auth_keys")
-            await doc_ref_auth_keys.update({auth_key: firestore.DELETE_FIELD})
+            await delete_auth_key(auth_key)
     for participant in doc_ref_dict["participants"]:
         doc_ref_user = db.collection("users").document(participant)
         doc_ref_user_dict = (await doc_ref_user.get()).to_dict() or {}
         if doc_ref_user_dict.get("display_name") == "Anonymous":
             await doc_ref_user.delete()
-            # TODO: delete user from display_names. This will require reworking the user_ids, as they need to start with a letter and have no hyphens for firestore field names
+            invalidate_display_name(participant)
 
-    await db.collection("deleted_studies").document(study_id).set(doc_ref_dict)
+    archive_ref = db.collection("deleted_studies").document(study_id)
+    await archive_ref.set(doc_ref_dict)
+    await archive_messages(doc_ref, archive_ref)
     await doc_ref.delete()
+    invalidate_study(study_id)
 
     return jsonify({"message": "Successfully deleted study"})
 
@@ -180,6 +233,7 @@ async def study_information(user_id) -> Response:
             },
             merge=True,
         )
+        invalidate_study(study_id)
 
         return jsonify({"message": "Study information updated successfully"})
     except:
@@ -194,20 +248,23 @@ async def parameters(user_id) -> Response:
     study_id = validate_uuid(request.args.get("study_id"))
     _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id)
     try:
+        mutation = StudyMutation()
         for p, value in data.items():
             if p in doc_ref_dict["parameters"]:
-                doc_ref_dict["parameters"][p]["value"] = value
+                mutation.set("parameters", p, "value", value=value)
             elif p in doc_ref_dict["advanced_parameters"]:
-                doc_ref_dict["advanced_parameters"][p]["value"] = value
+                mutation.set("advanced_parameters", p, "value", value=value)
             elif "NUM_INDS" in p:
                 participant = p.split("NUM_INDS")[1]
-                doc_ref_dict["personal_parameters"][participant]["NUM_INDS"]["value"] = value
+                if "NUM_INDS" not in doc_ref_dict["personal_parameters"][participant]:
+                    raise KeyError(p)
+                mutation.set("personal_parameters", participant, "NUM_INDS", "value", value=value)
             elif p in doc_ref_dict["personal_parameters"][user_id]:
-                doc_ref_dict["personal_parameters"][user_id][p]["value"] = value
+                mutation.set("personal_parameters", user_id, p, "value", value=value)
                 if p == "NUM_CPUS":
-                    doc_ref_dict["personal_parameters"][user_id]["NUM_THREADS"]["value"] = value
+                    mutation.set("personal_parameters", user_id, "NUM_THREADS", "value", value=value)
 
-        await doc_ref.set(doc_ref_dict, merge=True)
+        await mutation.commit(doc_ref)
 
         return jsonify({"message": "Parameters updated successfully"})
     except:
@@ -219,7 +276,7 @@ async def parameters(user_id) -> Response:
 @authenticate
 async def download_auth_key(user_id) -> Response:
     study_id = validate_uuid(request.args.get("study_id"))
-    _, _, doc_ref_dict = await fetch_study(study_id, user_id)
+    _, _, doc_ref_dict = await fetch_study(study_id, user_id, cached=True)
     auth_key = doc_ref_dict["personal_parameters"][user_id]["AUTH_KEY"]["value"] or await make_auth_key(
         study_id, user_id
     )
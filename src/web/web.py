@@ -2,26 +2,44 @@ import asyncio
 import io
 import os
 import zipfile
-from datetime import datetime, timezone
 
 from firebase_admin import auth as firebase_auth
-from quart import Blueprint, Response, current_app, jsonify, request, send_file
-from werkzeug.exceptions import BadRequest, Conflict, Forbidden
-
-from src.api_utils import fetch_study, get_display_names, get_studies, validate_json, validate_uuid
+from quart import Blueprint, Response, current_app, jsonify, request, send_file, stream_with_context
+from werkzeug.exceptions import BadRequest, Conflict, Forbidden, HTTPException
+
+from src.api_utils import (
+    fetch_study,
+    MAX_PAGE_SIZE,
+    STUDY_LIST_KEYS,
+    STUDY_SUMMARY_KEYS,
+    get_display_names,
+    get_legacy_display_names,
+    get_public_studies_page,
+    get_studies,
+    get_user_studies,
+    invalidate_display_name,
+    validate_json,
+    validate_uuid,
+)
 from src.auth import authenticate, authenticate_on_terra, get_user_email
 from src.utils import constants, custom_logging
-from src.utils.generic_functions import add_notification, remove_notification
+from src.utils.etags import conditional_response
+from src.utils.generic_functions import archive_notification
 from src.utils.google_cloud.google_cloud_secret_manager import get_firebase_api_key
 from src.utils.google_cloud.google_cloud_storage import download_blob_to_bytes
+from src.utils.public_studies import PublicStudiesView
 from src.utils.schemas.profile import profile_schema
 from src.utils.schemas.send_message import send_message_schema
 from src.utils.schemas.update_notifications import update_notifications_schema
 from src.utils.studies_functions import check_conditions, update_status_and_start_setup
+from src.utils.study_messages import MESSAGES_PAGE_SIZE, add_message, get_messages, migrate_messages
+from src.utils.study_mutation import StudyMutation
 
 logger = custom_logging.setup_logging(__name__)
 bp = Blueprint("web", __name__, url_prefix="/api")
 
+public_studies_view = PublicStudiesView(constants.PUBLIC_STUDIES_MAX_AGE)
+
 
 @bp.route("/createCustomToken", methods=["POST"])
 @authenticate
@@ -46,25 +64,91 @@ async def create_custom_token(user_id) -> Response:
 @bp.route("/public_studies", methods=["GET"])
 @authenticate_on_terra
 async def public_studies(user_id="") -> Response:
+    # ?fields=summary leaves out the free-text fields, for list views
+    summary = request.args.get("fields") == "summary"
+    if public_studies_view.enabled:
+        return await _serve_public_studies_view(summary)
+
+    keys = STUDY_LIST_KEYS if summary else STUDY_SUMMARY_KEYS
+    if "stream" in request.args:
+        return _stream_public_studies(keys)
+
+    page_size = request.args.get("page_size", type=int)
+    page_token = request.args.get("page_token", "")
+    next_page_token = None
     try:
-        public_studies = await get_studies(private_filter=False)
-        display_names = await get_display_names()
+        if page_size is None and not page_token:
+            public_studies = await get_studies(private_filter=False, keys=keys)
+        else:
+            page_size = min(max(page_size or MAX_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+            public_studies, next_page_token = await get_public_studies_page(page_size, page_token, keys)
+        await _add_owner_names(public_studies)
+    except HTTPException:
+        raise
     except:
         logger.exception(f"Failed to fetch public studies:")
         raise BadRequest("Failed to fetch public studies")
 
-    for study in public_studies:
+    if next_page_token is None:
+        return jsonify({"studies": public_studies})
+    return jsonify({"studies": public_studies, "next_page_token": next_page_token})
+
+
+async def _serve_public_studies_view(summary: bool) -> Response:
+    try:
+        await public_studies_view.refresh()
+    except:
+        raise BadRequest("Failed to fetch public studies")
+
+    page_size = request.args.get("page_size", type=int)
+    page_token = request.args.get("page_token", "")
+    if page_size is not None or page_token:
+        page_size = min(max(page_size or MAX_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+        studies, next_page_token = public_studies_view.page(page_size, page_token, summary)
+        return jsonify({"studies": studies, "next_page_token": next_page_token})
+
+    # the whole set (streamed or not) is served from the precomputed body,
+    # which clients can revalidate with its ETag
+    body = public_studies_view.body(summary)
+    return conditional_response(body.etag, lambda: Response(body.data, mimetype="application/json"), "no-cache")
+
+
+async def _add_owner_names(studies: list) -> None:
+    display_names = await get_display_names(study["owner"] for study in studies)
+    for study in studies:
         study["owner_name"] = display_names.get(study["owner"], study["owner"])
 
-    return jsonify({"studies": public_studies})
+
+def _stream_public_studies(keys: list) -> Response:
+    """
+    Streams all public studies as a JSON object, a page at a time,
+    so that the response starts before all of them are read.
+    """
+
+    @stream_with_context
+    async def generate():
+        yield '{"studies": ['
+        page_token, separator = "", ""
+        while True:
+            studies, page_token = await get_public_studies_page(MAX_PAGE_SIZE, page_token, keys)
+            await _add_owner_names(studies)
+            for study in studies:
+                yield separator + current_app.json.dumps(study)
+                separator = ","
+            if not page_token:
+                break
+        yield "]}"
+
+    return Response(generate(), mimetype="application/json")
 
 
 @bp.route("/my_studies", methods=["GET"])
 @authenticate
 async def my_studies(user_id) -> Response:
     try:
-        my_studies = await get_studies()
-        display_names = await get_display_names()
+        email = await get_user_email(user_id)
+        my_studies = await get_user_studies(user_id, email)
+        display_names = await get_display_names(study["owner"] for study in my_studies)
     except:
         logger.exception("Failed to fetch my studies:")
         raise BadRequest("Failed to fetch my studies")
@@ -72,10 +156,6 @@ async def my_studies(user_id) -> Response:
     for study in my_studies:
         study["owner_name"] = display_names.get(study["owner"], study["owner"])
 
-    email = await get_user_email(user_id)
-    my_studies = [
-        study for study in my_studies if user_id in study["participants"] or email in study["invited_participants"]
-    ]
     return jsonify({"studies": my_studies})
 
 
@@ -83,12 +163,15 @@ async def my_studies(user_id) -> Response:
 @authenticate
 async def profile(user_id: str, target_user_id: str = "") -> Response:
     db = current_app.config["DATABASE"]
-    display_names = (await db.collection("users").document("display_names").get()).to_dict() or {}
-    profile = (await db.collection("users").document(target_user_id).get()).to_dict() or {}
 
     if request.method == "GET":
         try:
-            profile["displayName"] = display_names.get(target_user_id, target_user_id)
+            profile = (await db.collection("users").document(target_user_id).get()).to_dict() or {}
+            profile["displayName"] = (
+                profile.get("display_name")
+                or (await get_legacy_display_names([target_user_id])).get(target_user_id)
+                or target_user_id
+            )
             profile = {key: profile[key] for key in ["about", "displayName", "email"] if key in profile}
             return jsonify({"profile": profile})
         except:
@@ -100,11 +183,11 @@ async def profile(user_id: str, target_user_id: str = "") -> Response:
 
         data = validate_json(await request.get_json(), schema=profile_schema)
         try:
-            display_names[target_user_id] = data["displayName"]
-            await db.collection("users").document("display_names").set(display_names)
-
-            profile["about"] = data["about"]
-            await db.collection("users").document(target_user_id).set(profile)
+            # only the profile fields, so that concurrent writes to the rest of the document (e.g. notifications) are kept
+            await db.collection("users").document(target_user_id).set(
+                {"display_name": data["displayName"], "about": data["about"]}, merge=True
+            )
+            invalidate_display_name(target_user_id)
 
             return jsonify({"message": "Profile updated successfully"})
         except:
@@ -127,7 +210,7 @@ async def start_protocol(user_id) -> Response:
             return jsonify({"message": "Protocol would have started successfully"})
 
         statuses[user_id] = "ready to begin sfkit"
-        await doc_ref.set({"status": statuses}, merge=True)
+        await StudyMutation().set("status", user_id, value=statuses[user_id]).commit(doc_ref)
 
     if "" in statuses.values():
         logger.info("Not all participants are ready.")
@@ -147,25 +230,31 @@ async def send_message(user_id) -> Response:
     if not message or not study_id:
         raise BadRequest("Missing required fields")
 
-    _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id)
-
-    new_message = {
-        "sender": user_id,
-        "time": datetime.now(timezone.utc).strftime("%m/%d/%Y %H:%M"),
-        "body": message,
-    }
+    _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id, cached=True)
+    await migrate_messages(doc_ref, doc_ref_dict)
 
-    doc_ref_dict["messages"] = doc_ref_dict.get("messages", []) + [new_message]
-    await doc_ref.set(doc_ref_dict)
+    new_message = await add_message(doc_ref, user_id, message)
 
     return jsonify({"message": "Message sent successfully", "data": new_message})
 
 
+@bp.route("/study_messages", methods=["GET"])
+@authenticate
+async def study_messages(user_id) -> Response:
+    study_id = validate_uuid(request.args.get("study_id"))
+    _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id, cached=True)
+    await migrate_messages(doc_ref, doc_ref_dict)
+
+    page_size = min(max(request.args.get("page_size", MESSAGES_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    messages, next_page_token = await get_messages(doc_ref, page_size, request.args.get("page_token", ""))
+    return jsonify({"messages": messages, "next_page_token": next_page_token})
+
+
 @bp.route("/download_results_file", methods=("GET",))
 @authenticate
 async def download_results_file(user_id) -> Response:
     study_id = validate_uuid(request.args.get("study_id"))
-    _, _, doc_ref_dict = await fetch_study(study_id, user_id)
+    _, _, doc_ref_dict = await fetch_study(study_id, user_id, cached=True)
 
     role: str = str(doc_ref_dict["participants"].index(user_id))
     shared = f"{study_id}/p{role}"
@@ -204,7 +293,7 @@ async def download_results_file(user_id) -> Response:
 @authenticate
 async def fetch_plot_file(user_id) -> Response:
     study_id = validate_uuid((await request.get_json()).get("study_id"))
-    _, _, doc_ref_dict = await fetch_study(study_id, user_id)
+    _, _, doc_ref_dict = await fetch_study(study_id, user_id, cached=True)
     role: str = str(doc_ref_dict["participants"].index(user_id))
 
     if "GWAS" in doc_ref_dict["study_type"]:
@@ -231,6 +320,5 @@ async def fetch_plot_file(user_id) -> Response:
 async def update_notifications(user_id) -> Response:
     data = validate_json(await request.get_json(), schema=update_notifications_schema)
 
-    await remove_notification(data.get("notification", ""), user_id)
-    await add_notification(data.get("notification", ""), user_id, "old_notifications")
+    await archive_notification(data.get("notification", ""), user_id)
     return Response(status=200)
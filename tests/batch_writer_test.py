@@ -0,0 +1,31 @@
+import asyncio
+
+from src.utils.generic_functions import MAX_BATCH_WRITES, BatchWriter
+from src.utils.memory_firestore import MemoryClient
+
+
+def _commits(db: MemoryClient) -> int:
+    return sum(count for (_, operation), count in db.operations.items() if operation == "Commit")
+
+
+def test_batch_writer_commits_full_batches():
+    async def run():
+        db = MemoryClient()
+        writer = BatchWriter(db)
+        for i in range(MAX_BATCH_WRITES + 1):
+            await writer.set(db.collection("users").document(str(i)), {"i": i})
+        assert _commits(db) == 1
+
+        await writer.delete(db.collection("users").document("0"))
+        await writer.update(db.collection("users").document("1"), {"i": -1})
+        await writer.commit()
+        assert _commits(db) == 2
+        # nothing left to commit
+        await writer.commit()
+        assert _commits(db) == 2
+
+        assert not (await db.collection("users").document("0").get()).exists
+        assert (await db.collection("users").document("1").get()).to_dict() == {"i": -1}
+        assert len([doc async for doc in db.collection("users").stream()]) == MAX_BATCH_WRITES
+
+    asyncio.run(run())
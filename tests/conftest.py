@@ -0,0 +1,8 @@
+from unittest import mock
+
+import requests
+
+# src.auth fetches the public keys of Azure AD B2C when it is imported, which the tests do without
+with mock.patch.object(requests, "get") as get:
+    get.return_value.json.return_value = {"keys": []}
+    import src  # noqa: F401
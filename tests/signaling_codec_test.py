@@ -0,0 +1,27 @@
+import zlib
+
+import pytest
+
+from src.utils import constants
+from src.utils.signaling import codec
+
+
+def test_binary_frames_round_trip():
+    frame = codec.dumps({"type": "candidate", "data": "x" * 2000})
+    for compression_threshold in (1, 10000):
+        assert codec.loads(codec.to_binary(frame, compression_threshold)) == codec.loads(frame)
+
+
+def test_compressed_frame_larger_than_max_frame_size(monkeypatch):
+    monkeypatch.setattr(constants, "SIGNALING_MAX_FRAME_SIZE", 1024)
+    frame = codec.to_binary(codec.dumps({"type": "candidate", "data": "x" * 1024}), 1)
+    with pytest.raises(ValueError):
+        codec.loads(frame)
+
+
+def test_truncated_compressed_frame():
+    frame = codec.to_binary(codec.dumps({"type": "candidate", "data": "x" * 2000}), 1)
+    with pytest.raises(ValueError):
+        codec.loads(frame[:-4])
+    with pytest.raises(ValueError):
+        codec.loads(frame + zlib.compress(b"{}"))
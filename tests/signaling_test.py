@@ -0,0 +1,271 @@
+import asyncio
+import uuid
+
+import pytest
+from quart import Quart
+from quart.testing.connections import WebsocketDisconnectError
+
+from src import signaling
+from src.auth import AUTH_HEADER
+from src.utils import constants
+from src.utils.signaling.outbox import Outbox, OverflowPolicy
+from src.utils.signaling.relay import BrokerRelay, LocalRelay, LoopbackBroker, Registration
+
+TIMEOUT = 5
+
+
+@pytest.fixture(params=["local", "loopback"])
+def app(request, monkeypatch) -> Quart:
+    """An app serving /api/ice, with study participants and auth keys stood in for (auth keys are usernames)."""
+    studies = {}
+
+    async def fetch_study(study_id: str, user_id: str = "", cached: bool = False):
+        return None, None, studies[study_id]
+
+    async def get_cli_user(ws) -> dict:
+        return {"username": ws.headers[AUTH_HEADER]}
+
+    relay = LocalRelay(60, 10) if request.param == "local" else BrokerRelay(LoopbackBroker(), 60, 10)
+    monkeypatch.setattr(constants, "TERRA", "")
+    monkeypatch.setattr(signaling, "fetch_study", fetch_study)
+    monkeypatch.setattr(signaling, "get_cli_user", get_cli_user)
+    monkeypatch.setattr(signaling, "relay", relay)
+
+    app = Quart(__name__)
+    app.register_blueprint(signaling.bp)
+    app.config["STUDIES"] = studies
+    return app
+
+
+def _add_study(app: Quart, num_parties: int) -> str:
+    study_id = str(uuid.uuid4())
+    app.config["STUDIES"][study_id] = {"participants": [f"user-{pid}" for pid in range(num_parties)]}
+    return study_id
+
+
+def _connect(client, study_id: str, pid: int):
+    return client.websocket("/api/ice", headers={AUTH_HEADER: f"user-{pid}", signaling.STUDY_ID_HEADER: study_id})
+
+
+async def _wait_for_parties(study_id: str, parties: set) -> None:
+    async def wait():
+        while await signaling.relay.parties(study_id) != parties:
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(wait(), TIMEOUT)
+
+
+async def _receive(ws) -> dict:
+    return await asyncio.wait_for(ws.receive_json(), TIMEOUT)
+
+
+def test_rendezvous(app):
+    async def run():
+        study_id = _add_study(app, 2)
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            async with _connect(client, study_id, 0) as ws0, _connect(client, study_id, 1) as ws1:
+                await _wait_for_parties(study_id, {0, 1})
+                await ws0.send_json({"type": "candidate", "data": "c0", "targetPID": 1, "sourcePID": 1})
+                await ws1.send_json({"type": "credential", "data": "c1", "targetPID": 0})
+
+                assert await _receive(ws1) == {
+                    "type": "candidate",
+                    "data": "c0",
+                    "studyID": study_id,
+                    "sourcePID": 0,
+                    "targetPID": 1,
+                }
+                assert (await _receive(ws0))["data"] == "c1"
+
+    asyncio.run(run())
+
+
+def test_resume(app):
+    async def run():
+        study_id = _add_study(app, 2)
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            async with _connect(client, study_id, 0) as ws0:
+                async with _connect(client, study_id, 1) as ws1:
+                    await _wait_for_parties(study_id, {0, 1})
+                    await ws1.send_json({"type": "candidate", "data": "hello", "targetPID": 0})
+                    assert (await _receive(ws0))["data"] == "hello"
+                await _wait_for_parties(study_id, {0})
+
+                # buffered until party 1 comes back
+                await ws0.send_json({"type": "candidate", "data": "while away", "targetPID": 1})
+                await asyncio.sleep(0.1)
+                async with _connect(client, study_id, 1) as ws1:
+                    assert (await _receive(ws1))["data"] == "while away"
+                    await ws0.send_json({"type": "candidate", "data": "after", "targetPID": 1})
+                    assert (await _receive(ws1))["data"] == "after"
+
+    asyncio.run(run())
+
+
+def test_duplicate_pid(app):
+    async def run():
+        study_id = _add_study(app, 2)
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            async with _connect(client, study_id, 0) as ws0:
+                await _wait_for_parties(study_id, {0})
+                async with _connect(client, study_id, 0) as duplicate:
+                    error = await _receive(duplicate)
+                    assert error["type"] == "error" and "already connected" in error["data"]
+                    with pytest.raises(WebsocketDisconnectError):
+                        await _receive(duplicate)
+
+                # the first connection keeps its registration
+                assert await signaling.relay.parties(study_id) == {0}
+                async with _connect(client, study_id, 1) as ws1:
+                    await ws1.send_json({"type": "candidate", "data": "hello", "targetPID": 0})
+                    assert (await _receive(ws0))["data"] == "hello"
+
+    asyncio.run(run())
+
+
+def test_cancelled_registration():
+    class StalledBroker(LoopbackBroker):
+        stalled = True
+
+        async def publish(self, channel: str, data: str) -> int:
+            if self.stalled:
+                await asyncio.sleep(TIMEOUT)
+            return await super().publish(channel, data)
+
+    async def deliver(frame: str) -> None:
+        pass
+
+    async def run():
+        broker = StalledBroker()
+        relay = BrokerRelay(broker, 60, 10)
+        registration = asyncio.create_task(relay.register("study", 0, deliver))
+        await asyncio.sleep(0.1)
+        registration.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await registration
+
+        # nothing is left of the party, which can thus connect again
+        assert not relay.keepalives and not broker.listeners
+        assert await relay.parties("study") == set()
+        broker.stalled = False
+        assert await relay.register("study", 0, deliver) == Registration.NEW
+        await relay.unregister("study", 0)
+
+    asyncio.run(run())
+
+
+def test_cancelled_resumption_keeps_the_messages_not_replayed():
+    async def run():
+        relay = LocalRelay(60, 10)
+        received = []
+
+        async def deliver(frame: str) -> None:
+            received.append(frame)
+
+        async def stalled(frame: str) -> None:
+            await asyncio.sleep(TIMEOUT)
+
+        await relay.register("study", 0, deliver)
+        await relay.unregister("study", 0, resumable=True)
+        for frame in ("a", "b"):
+            assert await relay.send("study", 0, frame)
+
+        registration = asyncio.create_task(relay.register("study", 0, stalled))
+        await asyncio.sleep(0.1)
+        registration.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await registration
+
+        assert await relay.register("study", 0, deliver) == Registration.RESUMED
+        assert received == ["a", "b"]
+
+    asyncio.run(run())
+
+
+class _StalledSocket:
+    """Sends nothing until it is released."""
+
+    def __init__(self) -> None:
+        self.sent = []
+        self.released = asyncio.Event()
+
+    async def send(self, frame: str) -> None:
+        await self.released.wait()
+        self.sent.append(frame)
+
+
+async def _drain(outbox: Outbox) -> None:
+    while outbox.depth:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.01)
+
+
+def test_outbox_drop_oldest():
+    async def run():
+        socket = _StalledSocket()
+        outbox = Outbox(socket.send, maxsize=2, policy=OverflowPolicy.DROP_OLDEST, block_timeout=0)
+        outbox.start()
+        await outbox.put("0")
+        # the writer waits on "0", with room for two more
+        await asyncio.sleep(0.01)
+        for frame in ("1", "2", "3"):
+            await outbox.put(frame)
+
+        socket.released.set()
+        await _drain(outbox)
+        assert socket.sent == ["0", "2", "3"]
+        assert outbox.dropped == 1
+        await outbox.close()
+
+    asyncio.run(run())
+
+
+def test_outbox_block():
+    async def run():
+        socket = _StalledSocket()
+        outbox = Outbox(socket.send, maxsize=1, policy=OverflowPolicy.BLOCK, block_timeout=0.1)
+        outbox.start()
+        await outbox.put("0")
+        await asyncio.sleep(0.01)
+        await outbox.put("1")
+        # dropped after waiting for room
+        await outbox.put("2")
+        assert outbox.dropped == 1
+
+        # taken as soon as there is room
+        put = asyncio.create_task(outbox.put("3"))
+        socket.released.set()
+        await put
+        await _drain(outbox)
+        assert socket.sent == ["0", "1", "3"]
+        await outbox.close()
+
+    asyncio.run(run())
+
+
+def test_outbox_disconnect():
+    async def run():
+        socket = _StalledSocket()
+        outbox = Outbox(socket.send, maxsize=1, policy=OverflowPolicy.DISCONNECT, block_timeout=0)
+
+        async def connection() -> None:
+            outbox.start()
+            await asyncio.sleep(TIMEOUT)
+
+        owner = asyncio.create_task(connection())
+        await asyncio.sleep(0.01)
+        for frame in ("0", "1"):
+            await outbox.put(frame)
+            await asyncio.sleep(0.01)
+        await outbox.put("2")
+
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        assert outbox.closed and outbox.dropped == 1
+        await outbox.put("3")
+        assert outbox.dropped == 2
+
+    asyncio.run(run())
@@ -0,0 +1,36 @@
+import asyncio
+
+from src import api_utils
+from src.utils.cache import MISSING
+from src.utils.memory_firestore import MemoryClient
+
+
+def test_read_started_before_a_write_does_not_fill_the_caches(monkeypatch):
+    monkeypatch.setattr(api_utils.recent_study_reads, "ttl", 5)
+
+    async def run():
+        db = MemoryClient(latency=0.02)
+        doc_ref = db.collection("studies").document("study")
+        await doc_ref.set({"x": 1})
+
+        read = asyncio.create_task(api_utils.get_study(doc_ref, cached=True))
+        await asyncio.sleep(0.005)
+        await doc_ref.update({"x": 2})
+        api_utils.invalidate_study("study")
+
+        assert (await read)[0] == {"x": 1}
+        assert api_utils.study_cache.get("study") is MISSING
+        assert api_utils.recent_study_reads.get("study") is MISSING
+        assert (await api_utils.get_study(doc_ref, cached=True))[0] == {"x": 2}
+        assert api_utils.study_cache.get("study")[0] == {"x": 2}
+
+        # writes are only tracked while the study is being read
+        assert api_utils._study_writes == {}
+        api_utils.invalidate_study("study")
+        assert api_utils._study_writes == {}
+
+    try:
+        asyncio.run(run())
+    finally:
+        api_utils.study_cache.clear()
+        api_utils.recent_study_reads.clear()
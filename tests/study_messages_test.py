@@ -0,0 +1,91 @@
+import asyncio
+
+from google.cloud import firestore
+from quart import Quart
+
+from src.utils.memory_firestore import MemoryClient
+from src.utils.study_messages import archive_messages, get_messages, migrate_messages
+
+
+def _legacy_message(body: str) -> dict:
+    return {"sender": "a", "time": "01/02/2024 10:00", "body": body}
+
+
+async def _migrate(doc_ref) -> None:
+    await migrate_messages(doc_ref, (await doc_ref.get()).to_dict())
+
+
+async def _bodies(doc_ref) -> list:
+    messages, _ = await get_messages(doc_ref, 1000)
+    return sorted(message["body"] for message in messages)
+
+
+def test_migrate_messages_twice():
+    async def run():
+        app = Quart(__name__)
+        app.config["DATABASE"] = db = MemoryClient()
+        doc_ref = db.collection("studies").document("study")
+        await doc_ref.set({"messages": [_legacy_message("first"), _legacy_message("second")]})
+        async with app.app_context():
+            await _migrate(doc_ref)
+            assert (await doc_ref.get()).to_dict()["messages"] == []
+
+            # appended by an instance of the previous version, to the array that a later migration deleted
+            await doc_ref.update({"messages": firestore.DELETE_FIELD})
+            await doc_ref.set({"messages": [_legacy_message("third")]}, merge=True)
+            await _migrate(doc_ref)
+            assert await _bodies(doc_ref) == ["first", "second", "third"]
+
+            # a migration of a copy read before the others finished does not duplicate messages
+            await migrate_messages(doc_ref, {"messages": [_legacy_message("first"), _legacy_message("second")]})
+            assert await _bodies(doc_ref) == ["first", "second", "third"]
+
+    asyncio.run(run())
+
+
+def test_migrate_identical_messages():
+    async def run():
+        app = Quart(__name__)
+        app.config["DATABASE"] = db = MemoryClient()
+        doc_ref = db.collection("studies").document("study")
+        await doc_ref.set({"messages": [_legacy_message("hi"), _legacy_message("hi")]})
+        async with app.app_context():
+            await _migrate(doc_ref)
+            assert await _bodies(doc_ref) == ["hi", "hi"]
+
+    asyncio.run(run())
+
+
+def test_migrate_keeps_messages_appended_during_the_migration():
+    async def run():
+        app = Quart(__name__)
+        app.config["DATABASE"] = db = MemoryClient()
+        doc_ref = db.collection("studies").document("study")
+        await doc_ref.set({"messages": [_legacy_message("first")]})
+        doc_ref_dict = (await doc_ref.get()).to_dict()
+        await doc_ref.set({"messages": [_legacy_message("first"), _legacy_message("second")]}, merge=True)
+        async with app.app_context():
+            await migrate_messages(doc_ref, doc_ref_dict)
+            assert (await doc_ref.get()).to_dict()["messages"] == [_legacy_message("second")]
+            await _migrate(doc_ref)
+            assert await _bodies(doc_ref) == ["first", "second"]
+            await _migrate(doc_ref)
+            assert "messages" not in (await doc_ref.get()).to_dict()
+
+    asyncio.run(run())
+
+
+def test_archive_messages():
+    async def run():
+        app = Quart(__name__)
+        app.config["DATABASE"] = db = MemoryClient()
+        doc_ref = db.collection("studies").document("study")
+        archive_ref = db.collection("deleted_studies").document("study")
+        await doc_ref.set({"messages": [_legacy_message(str(i)) for i in range(300)]})
+        async with app.app_context():
+            await _migrate(doc_ref)
+            await archive_messages(doc_ref, archive_ref)
+            assert await _bodies(doc_ref) == []
+            assert len(await _bodies(archive_ref)) == 300
+
+    asyncio.run(run())
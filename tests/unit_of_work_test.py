@@ -0,0 +1,116 @@
+from google.cloud import firestore
+
+from src.api_utils import _apply_update, _apply_updates, _merge_updates
+
+
+def test_merge_replaces_pending_fields_of_a_map():
+    merged = _merge_updates({"status.a": "ready", "tasks.a": []}, {"status": {"b": ""}})
+    assert merged == {"tasks.a": [], "status": {"b": ""}}
+
+
+def test_merge_into_a_map_pending_as_a_whole():
+    merged = _merge_updates({"status": {"a": "ready"}}, {"status.b": "", "status.a": "done"})
+    assert merged == {"status": {"a": "done", "b": ""}}
+
+
+def test_merge_into_a_value_pending_as_a_whole_that_is_not_a_map():
+    assert _merge_updates({"status": "ready"}, {"status.a": ""}) is None
+
+
+def test_merge_set_then_delete():
+    assert _merge_updates({"status.a": "ready"}, {"status.a": firestore.DELETE_FIELD}) == {
+        "status.a": firestore.DELETE_FIELD
+    }
+    assert _merge_updates({"status": {"a": "ready", "b": ""}}, {"status.a": firestore.DELETE_FIELD}) == {
+        "status": {"b": ""}
+    }
+
+
+def test_merge_delete_then_set():
+    assert _merge_updates({"status.a": firestore.DELETE_FIELD}, {"status.a": "ready"}) == {"status.a": "ready"}
+
+
+def test_merge_array_unions_on_the_same_field():
+    pending = {"tasks.a": firestore.ArrayUnion(["1", "2"])}
+    merged = _merge_updates(pending, {"tasks.a": firestore.ArrayUnion(["2", "3"])})
+    assert merged == {"tasks.a": firestore.ArrayUnion(["1", "2", "3"])}
+
+
+def test_merge_array_remove_after_array_union():
+    assert _merge_updates({"tasks.a": firestore.ArrayUnion(["1"])}, {"tasks.a": firestore.ArrayRemove(["1"])}) is None
+
+
+def test_merge_array_transform_after_set():
+    merged = _merge_updates({"tasks.a": ["1", "2"]}, {"tasks.a": firestore.ArrayRemove(["1"])})
+    assert merged == {"tasks.a": ["2"]}
+    merged = _merge_updates({"tasks.a": ["1"]}, {"tasks.a": firestore.ArrayUnion(["1", "2"])})
+    assert merged == {"tasks.a": ["1", "2"]}
+
+
+def test_merge_array_transform_after_delete():
+    assert _merge_updates({"tasks.a": firestore.DELETE_FIELD}, {"tasks.a": firestore.ArrayUnion(["1"])}) is None
+
+
+def test_merge_array_transform_replacing_a_map():
+    assert _merge_updates({"tasks.a": ["1"]}, {"tasks": firestore.ArrayUnion(["1"])}) is None
+
+
+def test_merge_has_the_same_outcome_as_the_updates_in_turn():
+    study = {"status": {"a": "ready"}, "tasks": {"a": ["1"]}}
+    pending = {"status.a": "done", "tasks.a": firestore.ArrayUnion(["2"])}
+    updates = {"status": {"b": ""}, "tasks.a": firestore.ArrayUnion(["3"])}
+
+    in_turn = {"status": {"a": "ready"}, "tasks": {"a": ["1"]}}
+    for changes in (pending, updates):
+        for path, value in changes.items():
+            assert _apply_update(in_turn, tuple(path.split(".")), value)
+
+    merged = _merge_updates(pending, updates)
+    assert merged is not None
+    for path, value in merged.items():
+        assert _apply_update(study, tuple(path.split(".")), value)
+    assert study == in_turn == {"status": {"b": ""}, "tasks": {"a": ["1", "2", "3"]}}
+
+
+def test_apply_set_then_delete():
+    data = {"status": {"a": "ready"}}
+    assert _apply_update(data, ("personal_parameters", "a", "NUM_CPUS"), {"value": "4"})
+    assert _apply_update(data, ("status", "a"), firestore.DELETE_FIELD)
+    assert data == {"status": {}, "personal_parameters": {"a": {"NUM_CPUS": {"value": "4"}}}}
+
+
+def test_apply_delete_of_a_missing_field():
+    data = {"status": "ready"}
+    assert _apply_update(data, ("status", "a"), firestore.DELETE_FIELD)
+    assert _apply_update(data, ("tasks", "a"), firestore.DELETE_FIELD)
+    assert data == {"status": "ready"}
+
+
+def test_apply_array_transforms():
+    data = {"tasks": {"a": ["1"]}}
+    assert _apply_update(data, ("tasks", "a"), firestore.ArrayUnion(["1", "2"]))
+    assert _apply_update(data, ("tasks", "b"), firestore.ArrayUnion(["1"]))
+    assert _apply_update(data, ("tasks", "a"), firestore.ArrayRemove(["1", "3"]))
+    assert data == {"tasks": {"a": ["2"], "b": ["1"]}}
+
+
+def test_apply_does_not_share_values_with_the_update():
+    value = {"value": ["1"]}
+    data: dict = {}
+    assert _apply_update(data, ("parameters", "A"), value)
+    value["value"].append("2")
+    assert data == {"parameters": {"A": {"value": ["1"]}}}
+
+
+def test_apply_updates_clears_the_version():
+    studies = {"s": ({"status": {"a": ""}}, True, "v1")}
+    _apply_updates(studies, "s", {"status.a": "ready", "tasks.a": firestore.ArrayUnion(["1"])})
+    assert studies == {"s": ({"status": {"a": "ready"}, "tasks": {"a": ["1"]}}, True, None)}
+
+
+def test_apply_updates_forgets_studies_it_cannot_update():
+    studies = {"s": ({"count": 1}, True, "v1")}
+    _apply_updates(studies, "s", {"count": firestore.Increment(1)})
+    assert studies == {}
+    _apply_updates(studies, "other", {"count": 1})
+    assert studies == {}